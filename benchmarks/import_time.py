@@ -0,0 +1,105 @@
+"""Benchmark the time to import chimedb.node
+
+Imports the package in fresh interpreters and reports the median import
+time.  Fails (exit status 1) if the import is slower than `--max-ms`, or
+if it pulls in any of the modules which are meant to be loaded lazily.
+
+Usage: python benchmarks/import_time.py [--runs N] [--max-ms MS] [--json]
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+
+# Modules which importing chimedb.node must not load
+LAZY_MODULES = ("peewee", "chimedb.core", "chimedb.node.orm", "subprocess")
+
+# Run in a fresh interpreter: time the import and list any lazy modules
+# which were loaded
+_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import chimedb.node
+elapsed = time.perf_counter() - start
+print(json.dumps({{
+    "seconds": elapsed,
+    "loaded": [name for name in {0!r} if name in sys.modules],
+}}))
+"""
+
+
+def measure(runs):
+    """Import chimedb.node in `runs` fresh interpreters.
+
+    Returns
+    -------
+    times : list of float
+        The import time of each run, in seconds.
+    loaded : list of strings
+        The lazy modules which were loaded by the import.
+    """
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        [root] + [path for path in [env.get("PYTHONPATH")] if path]
+    )
+
+    times = list()
+    loaded = set()
+    for _ in range(runs):
+        output = subprocess.check_output(
+            [sys.executable, "-c", _PROBE.format(LAZY_MODULES)], env=env
+        )
+        result = json.loads(output)
+        times.append(result["seconds"])
+        loaded.update(result["loaded"])
+
+    return times, sorted(loaded)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--runs", type=int, default=10, help="number of imports")
+    parser.add_argument(
+        "--max-ms", type=float, default=50.0, help="maximum median import time"
+    )
+    parser.add_argument("--json", action="store_true", help="print JSON")
+    args = parser.parse_args()
+
+    times, loaded = measure(args.runs)
+    median_ms = statistics.median(times) * 1000
+    failed = median_ms > args.max_ms or bool(loaded)
+
+    if args.json:
+        print(
+            json.dumps(
+                {
+                    "median_ms": median_ms,
+                    "min_ms": min(times) * 1000,
+                    "max_ms": max(times) * 1000,
+                    "runs": args.runs,
+                    "eagerly_loaded": loaded,
+                    "ok": not failed,
+                },
+                indent=2,
+            )
+        )
+    else:
+        print(
+            "import chimedb.node: median {0:.2f} ms over {1} runs "
+            "(min {2:.2f}, max {3:.2f})".format(
+                median_ms, args.runs, min(times) * 1000, max(times) * 1000
+            )
+        )
+        if loaded:
+            print("Imported eagerly: {0}".format(", ".join(loaded)))
+        if median_ms > args.max_ms:
+            print("Slower than {0} ms".format(args.max_ms))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,233 @@
+"""Benchmark node database operations on a synthetic fleet
+
+Builds a synthetic fleet with chimedb.node.synthetic (components, nodes,
+MACs, RMAs and years of history) in a temporary SQLite database, or in
+PostgreSQL if a database URL is given with --database or in
+$CHIMEDB_BENCH_DATABASE, and times the main lookups and writes.  The
+results are printed as JSON, so runs on different commits can be
+compared.
+
+Usage: python benchmarks/node_ops.py [--items N] [--history N] [--output FILE]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import peewee as pw
+from playhouse.db_url import connect as connect_url
+
+from chimedb.node import api, history, lookup
+from chimedb.node.orm import (
+    NodeItem,
+    NodeMAC,
+    NodeAssembled,
+    NodeRMA,
+    NodeHistory,
+    NodeSnapshot,
+)
+from chimedb.node.synthetic import build_fleet
+
+MODELS = (NodeItem, NodeMAC, NodeAssembled, NodeRMA, NodeHistory, NodeSnapshot)
+
+
+def timed(func, repeat):
+    """Call `func` `repeat` times; return timing statistics in seconds."""
+    times = list()
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+
+    return {
+        "runs": repeat,
+        "min": min(times),
+        "median": statistics.median(times),
+        "mean": statistics.mean(times),
+    }
+
+
+def run_benchmarks(repeat, lookups, seed=0):
+    """Time the operations against the database; return a dict of results."""
+    rng = random.Random(seed)
+    serials = [
+        row[0]
+        for row in NodeItem.select(NodeItem.serial).order_by(NodeItem.id).tuples()
+    ]
+    sample = [rng.choice(serials) for _ in range(lookups)]
+    item_ids = [rng.randint(1, len(serials)) for _ in range(lookups)]
+    busiest = (
+        NodeHistory.select(NodeHistory.node)
+        .where(NodeHistory.node.is_null(False))
+        .group_by(NodeHistory.node)
+        .order_by(pw.fn.COUNT(NodeHistory.id).desc())
+        .limit(1)
+        .scalar()
+    )
+    first, last = (
+        NodeHistory.select(
+            pw.fn.MIN(NodeHistory.timestamp), pw.fn.MAX(NodeHistory.timestamp)
+        )
+        .tuples()
+        .get()
+    )
+    first = NodeHistory.timestamp.python_value(first)
+    last = NodeHistory.timestamp.python_value(last)
+    middle = first + (last - first) / 2
+
+    batch = [0]
+
+    def ingest():
+        batch[0] += 1
+        api.create_components(
+            [
+                {"type": "GPU", "serial": "bench-{0}-{1}".format(batch[0], index)}
+                for index in range(1000)
+            ]
+        )
+
+    operations = [
+        (
+            "serial_lookup",
+            lambda: [lookup.find_item(serial) for serial in sample],
+            lookups,
+        ),
+        ("item_to_node", lambda: [lookup.find_node(id_) for id_ in item_ids], lookups),
+        ("item_to_node_bulk", lambda: lookup.find_nodes(item_ids), 1),
+        ("rack_render", lambda: lookup.node_contents(), 1),
+        ("rack_render_dicts", lambda: lookup.node_contents(dicts=True), 1),
+        (
+            "history_pagination",
+            lambda: sum(1 for _ in history.iter_history(node=busiest, page_size=50)),
+            1,
+        ),
+        ("history_pagination_all", lambda: sum(1 for _ in history.iter_history()), 1),
+        ("snapshot_middle", lambda: history.snapshot(middle), 1),
+        ("snapshot_now", lambda: history.snapshot(), 1),
+        ("bulk_ingest_1000", ingest, 1),
+    ]
+
+    results = dict()
+    for name, func, count in operations:
+        result = timed(func, repeat)
+        if count > 1:
+            result["per_op"] = result["median"] / count
+            result["ops"] = count
+        results[name] = result
+        print("{0}: {1:.4f} s".format(name, result["median"]), file=sys.stderr)
+
+    return results
+
+
+def _git_commit():
+    try:
+        return (
+            subprocess.check_output(
+                ["git", "rev-parse", "HEAD"],
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+                stderr=subprocess.DEVNULL,
+            )
+            .decode()
+            .strip()
+        )
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--items", type=int, default=10000, help="number of components")
+    parser.add_argument("--years", type=float, default=3, help="years of history")
+    parser.add_argument(
+        "--swaps", type=float, default=4, help="component swaps per node per year"
+    )
+    parser.add_argument(
+        "--history",
+        type=int,
+        help="number of history rows, instead of setting --swaps",
+    )
+    parser.add_argument("--repeat", type=int, default=5, help="runs of each timing")
+    parser.add_argument(
+        "--lookups", type=int, default=200, help="lookups per serial/item timing"
+    )
+    parser.add_argument(
+        "--database",
+        default=os.environ.get("CHIMEDB_BENCH_DATABASE"),
+        help="database URL, e.g. postgresql://localhost/bench; it must be "
+        "empty (default: a temporary SQLite file)",
+    )
+    parser.add_argument("--output", help="write the JSON results to this file")
+    args = parser.parse_args()
+
+    temp_dir = None
+    if args.database is None:
+        temp_dir = tempfile.mkdtemp(prefix="chimedb-node-bench-")
+        args.database = "sqlite:///" + os.path.join(temp_dir, "bench.db")
+    db = connect_url(args.database)
+    db.bind(MODELS)
+    # The tables are dropped afterwards, so never touch existing ones
+    existing = [model.__name__ for model in MODELS if model.table_exists()]
+    if existing:
+        print(
+            "Database already has tables {0}; use an empty one".format(existing),
+            file=sys.stderr,
+        )
+        return 1
+    db.create_tables(MODELS)
+
+    try:
+        start = time.perf_counter()
+        sizes = build_fleet(
+            items=args.items,
+            years=args.years,
+            swaps_per_node_year=args.swaps,
+            history=args.history,
+        )
+        build_time = time.perf_counter() - start
+        print(
+            "Built fleet in {0:.1f} s: {1}".format(build_time, sizes), file=sys.stderr
+        )
+
+        results = run_benchmarks(args.repeat, args.lookups)
+    finally:
+        db.drop_tables(MODELS)
+        db.close()
+        if temp_dir is not None:
+            os.unlink(os.path.join(temp_dir, "bench.db"))
+            os.rmdir(temp_dir)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "time": datetime.datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "peewee": pw.__version__,
+            "database": type(db).__name__,
+            "items": args.items,
+            "years": args.years,
+            "repeat": args.repeat,
+            "sizes": sizes,
+            "build_seconds": build_time,
+        },
+        "results": results,
+    }
+
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
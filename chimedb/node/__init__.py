@@ -1,7 +1,51 @@
-"""GPU node hardware tracking"""
-from .orm import NodeItem, NodeMAC, NodeAssembled, NodeHistory, NodeRMA
+"""GPU node hardware tracking
 
-from ._version import get_versions
+The table models (`NodeItem`, `NodeMAC`, ...) and `__version__` are
+loaded on first access, so that importing the package doesn't import
+peewee and chimedb.core, or run git to compute the version.
+"""
 
-__version__ = get_versions()["version"]
-del get_versions
+# The models of chimedb.node.orm available from the package
+_MODELS = (
+    "NodeItem",
+    "NodeMAC",
+    "NodeAssembled",
+    "NodeHistory",
+    "NodeRMA",
+    "NodeSlot",
+    "NodeSnapshot",
+)
+
+# Reported if versioneer can't determine the version
+_FALLBACK_VERSION = "0+unknown"
+
+
+def _get_version():
+    """Compute the package version with versioneer."""
+    try:
+        from ._version import get_versions
+
+        return get_versions()["version"]
+    except Exception:
+        return _FALLBACK_VERSION
+
+
+def __getattr__(name):
+    if name == "__version__":
+        value = _get_version()
+    elif name in _MODELS:
+        from . import orm
+
+        value = getattr(orm, name)
+    else:
+        raise AttributeError(
+            "module {0!r} has no attribute {1!r}".format(__name__, name)
+        )
+
+    # Cache it, so that __getattr__ isn't called again for this name
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    return sorted(set(globals()) | set(_MODELS) | {"__version__"})
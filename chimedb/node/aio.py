@@ -0,0 +1,154 @@
+"""Asyncio interface to the node database
+
+The peewee models block while they wait for the database, which would
+stall an event loop.  `AsyncNodeDB` runs the lookups and the write
+operations of `chimedb.node.api` in a bounded pool of worker threads
+instead.  Peewee keeps a separate connection for each thread, so each
+worker opens its own connection on first use and keeps it.
+
+The database must be connected (e.g. with `chimedb.core.connect`)
+before any calls are made.  Closing the AsyncNodeDB (or leaving its
+`async with` block) closes the workers' connections.
+
+Examples
+--------
+>>> import asyncio
+>>> import chimedb.core
+>>> from chimedb.node.aio import AsyncNodeDB
+>>> chimedb.core.connect()
+>>> async def check(serials):
+...     async with AsyncNodeDB(max_workers=4) as nodedb:
+...         return await asyncio.gather(
+...             *[nodedb.find_nodes_by_serial([s]) for s in serials]
+...         )
+"""
+from . import api, history, lookup
+from .mac import locate_mac
+from .orm import NodeItem
+
+from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import functools
+import threading
+
+# Seconds each worker waits for the others while closing the connections
+CLOSE_TIMEOUT = 60
+
+
+def _in_executor(func):
+    """Make an async method which runs `func` in the worker pool."""
+
+    @functools.wraps(func)
+    async def method(self, *args, **kwargs):
+        return await self.run(func, *args, **kwargs)
+
+    method.__doc__ = "Run `{0}.{1}` in the worker pool.\n\n{2}".format(
+        func.__module__, func.__name__, func.__doc__ or ""
+    )
+    return method
+
+
+class AsyncNodeDB(object):
+    """Asynchronous access to the node database through a thread pool.
+
+    Parameters
+    ----------
+    max_workers : int, optional
+        The number of worker threads, and so the maximum number of
+        database connections and of queries in progress at once.
+        Further calls wait for a free worker.
+    cache : NodeCache, optional
+        If given, the item, node and MAC lookups go through this cache.
+    """
+
+    def __init__(self, max_workers=8, cache=None):
+        self._max_workers = max_workers
+        self._executor = ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="chimedb-node"
+        )
+        self._closed = False
+        self.cache = cache
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.aclose()
+
+    def close(self):
+        """Shut down the worker pool once queued calls have finished.
+
+        Each worker closes its database connection before it exits.  This
+        blocks until the queued calls are done; from a coroutine, use
+        `aclose` instead.
+        """
+        if self._closed:
+            return
+        self._closed = True
+
+        # Queued after the pending calls.  The barrier makes each worker
+        # take exactly one, so that every worker's connection is closed.
+        barrier = threading.Barrier(self._max_workers)
+
+        def close_connection():
+            try:
+                NodeItem._meta.database.close()
+            finally:
+                try:
+                    barrier.wait(CLOSE_TIMEOUT)
+                except threading.BrokenBarrierError:
+                    pass
+
+        for _ in range(self._max_workers):
+            self._executor.submit(close_connection)
+        self._executor.shutdown(wait=True)
+
+    async def aclose(self):
+        """Shut down the worker pool without blocking the event loop."""
+        await asyncio.get_running_loop().run_in_executor(None, self.close)
+
+    async def run(self, func, *args, **kwargs):
+        """Run the blocking `func(*args, **kwargs)` in the worker pool."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            self._executor, functools.partial(func, *args, **kwargs)
+        )
+
+    # Reads
+
+    def _find_item(self, serial, item_type=None):
+        if self.cache is not None:
+            return self.cache.item_by_serial(serial, item_type)
+        return lookup.find_item(serial, item_type)
+
+    async def find_item(self, serial, item_type=None):
+        """Return the NodeItem with the given serial (and type), or None."""
+        return await self.run(self._find_item, serial, item_type)
+
+    def _locate_mac(self, mac):
+        if self.cache is not None:
+            return self.cache.mac(mac)
+        return locate_mac(mac)
+
+    async def locate_mac(self, mac):
+        """Return the `chimedb.node.mac.MACRecord` for a MAC address, or None."""
+        return await self.run(self._locate_mac, mac)
+
+    find_node = _in_executor(lookup.find_node)
+    find_nodes = _in_executor(lookup.find_nodes)
+    find_nodes_by_serial = _in_executor(lookup.find_nodes_by_serial)
+    node_slots = _in_executor(lookup.node_slots)
+    empty_slots = _in_executor(lookup.empty_slots)
+    node_contents = _in_executor(lookup.node_contents)
+    history_for = _in_executor(history.history_for)
+    snapshot = _in_executor(history.snapshot)
+
+    # Writes
+
+    create_components = _in_executor(api.create_components)
+    create_node = _in_executor(api.create_node)
+    install_component = _in_executor(api.install_component)
+    remove_component = _in_executor(api.remove_component)
+    swap_component = _in_executor(api.swap_component)
+    update_item = _in_executor(api.update_item)
+    update_node = _in_executor(api.update_node)
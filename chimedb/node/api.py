@@ -1,24 +1,948 @@
 """High-level API for modifying the Hardware tracking database
 """
-from .orm import NodeItem, NodeMAC, NodeAssembled, NodeHistory, NodeRMA
+from .orm import NodeItem, NodeMAC, NodeAssembled, NodeHistory, NodeRMA, NODE_SLOTS
+from .cache import bump_generation
+from .history import TYPE_SLOTS
+from .instrument import instrumented
+from .mac import format_mac, parse_mac
+from .migrate import check_schema
+from .slots import add_node_slots, slot_query, sync_slot
+
+from chimedb.core.exceptions import ValidationError
 
 from enum import Enum
+import functools
 
+import peewee as pw
+import datetime
 
-# add to rack
-# remove from rack
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# Number of rows written per multi-row INSERT by the bulk operations
+BULK_CHUNK_SIZE = 100
 
-# add a component to node
-# remove component from node (+ optional RMA)
 
-# change location of thing
+class ConflictError(ValidationError):
+    """A row was changed by someone else since it was read.
+
+    Raised when a compare-and-set update finds that the row version, or
+    the contents of a node slot, no longer match what was expected.
+    Retrying after re-reading the row (see `retry_on_conflict`) is
+    usually the right response.
+    """
+
+
+# add to rack
+# remove from rack
 
 # add note to history with no changes
 
 # component sent out for RMA
 # component returned from RMA
 
-# create new component
 # discard component
 
-# new node
+
+def _write_operation(func):
+    """Decorator for the API functions which write to the database.
+
+    Checks first that the database has been migrated (see
+    `chimedb.node.migrate.check_schema`), invalidates the caches in this
+    process (see `chimedb.node.cache`) once the function returns, whether
+    or not it succeeded, and measures its queries (see
+    `chimedb.node.instrument`).
+    """
+    measured = instrumented(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        check_schema()
+        try:
+            return measured(*args, **kwargs)
+        finally:
+            bump_generation()
+
+    return wrapper
+
+
+@_write_operation
+def create_components(rows, note=None, chunk_size=BULK_CHUNK_SIZE):
+    """Create a batch of new components.
+
+    The NodeItem rows, their NodeMAC rows and the accompanying 'ADD'
+    NodeHistory records are written with multi-row INSERTs, `chunk_size`
+    components at a time, inside a single transaction.  Rows which can't
+    be created (because of a duplicate serial number or MAC address) are
+    reported back without aborting the rest of the batch, as are rows with
+    an invalid type, status, MAC type or MAC address.
+
+    Parameters
+    ----------
+    rows : iterable of dict
+        The components to create.  Each dict may contain the keys 'type',
+        'model', 'serial', 'status' and 'location', with the same meaning
+        as the corresponding NodeItem fields, plus 'macs': a dict mapping
+        a NodeMAC `mac_type` to the MAC address of the component, as an
+        integer or in any form accepted by `chimedb.node.mac.parse_mac`.
+    note : string, optional
+        The note to attach to the history records.  If not given, a note
+        is generated automatically for each component.
+    chunk_size : int, optional
+        The number of components written per INSERT.
+
+    Returns
+    -------
+    ids : list
+        For each input row, the id of the new NodeItem, or None if the
+        row could not be created.
+    failures : dict
+        Maps the index of each row which could not be created to a string
+        describing the reason.
+    """
+    rows = list(rows)
+    ids = [None] * len(rows)
+    failures = dict()
+
+    # Serials and MACs already claimed by earlier rows in this batch
+    seen_serials = set()
+    seen_macs = set()
+
+    timestamp = datetime.datetime.now()
+
+    with NodeItem._meta.database.atomic():
+        for chunk in pw.chunked(range(len(rows)), chunk_size):
+            pending = dict()
+            for index in chunk:
+                try:
+                    item, macs = _normalise_component(rows[index])
+                except ValueError as e:
+                    failures[index] = str(e)
+                    continue
+
+                reason = _check_duplicate(item, macs, seen_serials, seen_macs)
+                if reason is not None:
+                    failures[index] = reason
+                    continue
+
+                pending[index] = (item, macs)
+
+            _reject_existing(pending, failures)
+            _insert_components(pending, ids, failures, note, timestamp)
+
+    _logger.debug(
+        "Created {0} of {1} components ({2} failed)".format(
+            len(rows) - len(failures), len(rows), len(failures)
+        )
+    )
+
+    return ids, failures
+
+
+def _check_enum(field, value):
+    """Raise ValueError if `value` isn't allowed in the EnumField `field`."""
+    if value not in field.enum_list:
+        raise ValueError(
+            "bad {0} {1!r}: must be one of {2}".format(
+                field.name, value, ", ".join(field.enum_list)
+            )
+        )
+
+
+def _normalise_component(row):
+    """Split an input row into NodeItem fields and a list of MAC rows.
+
+    Every field is filled in, so that all the rows of a multi-row
+    INSERT have the same columns.  Raises ValueError if a type, status,
+    MAC type or MAC address is invalid.
+    """
+    item = {
+        "type": row.get("type", NodeItem.type.default),
+        "model": row.get("model"),
+        "serial": row.get("serial"),
+        "status": row.get("status", NodeItem.status.default),
+        "location": row.get("location", ""),
+    }
+    _check_enum(NodeItem.type, item["type"])
+    _check_enum(NodeItem.status, item["status"])
+
+    macs = list()
+    for mac_type, value in row.get("macs", dict()).items():
+        _check_enum(NodeMAC.mac_type, mac_type)
+        try:
+            value = parse_mac(value)
+        except ValueError:
+            raise ValueError("bad {0} MAC address: {1!r}".format(mac_type, value))
+        macs.append({"value": value, "mac_type": mac_type})
+
+    return item, macs
+
+
+def _check_duplicate(item, macs, seen_serials, seen_macs):
+    """Check a component against those earlier in the same batch.
+
+    Returns a string describing the problem, or None if there isn't one.
+    If there's no problem, the serial and MACs are added to the seen sets.
+    """
+    if item["serial"] is not None:
+        key = (item["type"], item["serial"])
+        if key in seen_serials:
+            return "duplicate {0} serial {1} in batch".format(*key)
+
+    values = [mac["value"] for mac in macs]
+    for value in values:
+        if value in seen_macs or values.count(value) > 1:
+            return "duplicate MAC {0} in batch".format(format_mac(value))
+
+    if item["serial"] is not None:
+        seen_serials.add(key)
+    seen_macs.update(values)
+
+    return None
+
+
+def _reject_existing(pending, failures):
+    """Remove pending components which clash with rows already in the database.
+
+    Serials and MACs for the whole chunk are checked with one query each.
+    """
+    serials = set(item["serial"] for item, _ in pending.values())
+    serials.discard(None)
+    existing_serials = set()
+    if serials:
+        existing_serials = set(
+            NodeItem.select(NodeItem.type, NodeItem.serial)
+            .where(NodeItem.serial.in_(list(serials)))
+            .tuples()
+        )
+
+    values = [mac["value"] for _, macs in pending.values() for mac in macs]
+    existing_macs = set()
+    if values:
+        existing_macs = set(
+            value
+            for (value,) in NodeMAC.select(NodeMAC.value)
+            .where(NodeMAC.value.in_(values))
+            .tuples()
+        )
+
+    for index, (item, macs) in list(pending.items()):
+        if (item["type"], item["serial"]) in existing_serials:
+            failures[index] = "{0} serial {1} already exists".format(
+                item["type"], item["serial"]
+            )
+            del pending[index]
+            continue
+
+        for mac in macs:
+            if mac["value"] in existing_macs:
+                failures[index] = "MAC {0} already exists".format(
+                    format_mac(mac["value"])
+                )
+                del pending[index]
+                break
+
+
+def _insert_components(pending, ids, failures, note, timestamp):
+    """Write one chunk of components to the database.
+
+    The whole chunk is first tried with multi-row INSERTs.  If that fails
+    with an integrity error (because of a concurrent writer) or a data
+    error (a value the database won't store), the chunk is retried row by
+    row so that only the offending rows are rejected.
+    """
+    if not pending:
+        return
+
+    db = NodeItem._meta.database
+    try:
+        with db.atomic():
+            new_ids = _bulk_insert_items(pending)
+            mac_rows = list()
+            history_rows = list()
+            for index, (item, macs) in pending.items():
+                for mac in macs:
+                    mac_rows.append(dict(mac, item=new_ids[index]))
+                history_rows.append(
+                    _add_history_row(new_ids[index], item, note, timestamp)
+                )
+            if mac_rows:
+                NodeMAC.insert_many(mac_rows).execute()
+            NodeHistory.insert_many(history_rows).execute()
+    except (pw.IntegrityError, pw.DataError):
+        _logger.debug("Bulk insert failed; retrying chunk row by row")
+        for index, (item, macs) in pending.items():
+            try:
+                with db.atomic():
+                    new_id = NodeItem.insert(**item).execute()
+                    if macs:
+                        NodeMAC.insert_many(
+                            [dict(mac, item=new_id) for mac in macs]
+                        ).execute()
+                    NodeHistory.insert(
+                        **_add_history_row(new_id, item, note, timestamp)
+                    ).execute()
+            except (pw.IntegrityError, pw.DataError) as e:
+                failures[index] = str(e)
+            else:
+                ids[index] = new_id
+    else:
+        for index, new_id in new_ids.items():
+            ids[index] = new_id
+
+
+def _bulk_insert_items(pending):
+    """Insert the NodeItems for a chunk, returning a dict of their new ids.
+
+    Items with serial numbers are inserted together and their ids are then
+    read back with a single query on the serial.  Items without serial
+    numbers can't be found that way, so they are inserted one at a time.
+    """
+    new_ids = dict()
+
+    with_serial = dict()
+    for index, (item, _) in pending.items():
+        if item["serial"] is None:
+            new_ids[index] = NodeItem.insert(**item).execute()
+        else:
+            with_serial[(item["type"], item["serial"])] = index
+
+    if with_serial:
+        NodeItem.insert_many(
+            [pending[index][0] for index in with_serial.values()]
+        ).execute()
+        query = NodeItem.select(NodeItem.id, NodeItem.type, NodeItem.serial).where(
+            NodeItem.serial.in_([serial for _, serial in with_serial])
+        )
+        for id_, type_, serial in query.tuples():
+            index = with_serial.get((type_, serial))
+            if index is not None:
+                new_ids[index] = id_
+
+    return new_ids
+
+
+def _add_history_row(item_id, item, note, timestamp):
+    """Return the field dict for the 'ADD' history record of a new component."""
+    if note is None:
+        autonote = True
+        note = "New {0}: model {1}, serial {2}".format(
+            item["type"], item["model"], item["serial"]
+        )
+    else:
+        autonote = False
+
+    return {
+        "operation": "ADD",
+        "node": None,
+        "item": item_id,
+        "rma": None,
+        "slot": None,
+        "timestamp": timestamp,
+        "autonote": autonote,
+        "note": note,
+    }
+
+
+@_write_operation
+def create_node(serial, node_type="GPU", note=None):
+    """Create a new, empty, assembled node.
+
+    Parameters
+    ----------
+    serial : string
+        The node serial number.
+    node_type : string, optional
+        'GPU' or 'FRB'.
+    note : string, optional
+        The note for the history record.  If not given, one is generated.
+
+    Returns
+    -------
+    node : NodeAssembled
+        The new node.
+    """
+    if note is None:
+        autonote = True
+        note = "New {0} node {1}".format(node_type, serial)
+    else:
+        autonote = False
+
+    with NodeAssembled._meta.database.atomic():
+        node = NodeAssembled.create(serial=serial, node_type=node_type)
+        add_node_slots(node)
+        NodeHistory.create(operation="NOP", node=node, autonote=autonote, note=note)
+
+    return node
+
+
+def _slot_field(slot):
+    """Return the NodeAssembled field for `slot`, checking that it exists."""
+    if slot not in NODE_SLOTS:
+        raise ValueError("unknown slot: {0}".format(slot))
+    return getattr(NodeAssembled, slot)
+
+
+def _check_installable(slot, item_id):
+    """Check that a component can be installed into `slot`.
+
+    Must be called inside the transaction which installs the component,
+    before it reads anything else.  The component's row is read with
+    SELECT ... FOR UPDATE, where the database supports it, so that a
+    concurrent install of the same component waits for this transaction
+    and then sees its result.
+
+    Raises
+    ------
+    ValidationError
+        The component doesn't exist, its type doesn't fit `slot`, or it
+        is already installed in a node.
+    """
+    query = NodeItem.select(NodeItem.type).where(NodeItem.id == item_id)
+    db = NodeItem._meta.database
+    if getattr(db, "obj", db).for_update:
+        query = query.for_update()
+    item_type = query.scalar()
+    if item_type is None:
+        raise ValidationError("no item with id {0}".format(item_id))
+
+    # The type enum has no rack slot type, so anything may be racked
+    prefix = TYPE_SLOTS.get(item_type)
+    if slot != "rack_slot" and (prefix is None or not slot.startswith(prefix)):
+        raise ValidationError(
+            "can't install {0} item {1} in slot {2}".format(item_type, item_id, slot)
+        )
+
+    # The slot columns are only unique individually, so look in all of them
+    installed = slot_query(lambda field: field == item_id).tuples().first()
+    if installed is not None:
+        raise ValidationError(
+            "item {0} is already installed in {1} of node {2}".format(
+                item_id, installed[1], installed[0]
+            )
+        )
+
+
+@_write_operation
+def install_component(node, slot, item, note=None, version=None):
+    """Install a component into an empty slot of a node.
+
+    The slot is only updated if it is still empty, so two concurrent
+    installs into the same slot can't both succeed.
+
+    Parameters
+    ----------
+    node : NodeAssembled or integer
+        The node, or its id.
+    slot : string
+        The name of the slot.  Must be one of `NODE_SLOTS`.
+    item : NodeItem or integer
+        The component to install, or its id.
+    note : string, optional
+        The note for the history record.  If not given, one is generated.
+    version : integer, optional
+        If given, the expected row version of the node.
+
+    Raises
+    ------
+    ConflictError
+        The slot isn't empty, or the node version isn't `version`.
+    ValidationError
+        The node or component doesn't exist, the component's type doesn't
+        fit the slot, or it is already installed in a node.
+    """
+    _slot_field(slot)
+    node_id = getattr(node, "id", node)
+    item_id = getattr(item, "id", item)
+
+    if note is None:
+        autonote = True
+        note = "Installed item {0} in {1}".format(item_id, slot)
+    else:
+        autonote = False
+
+    with NodeAssembled._meta.database.atomic():
+        _check_installable(slot, item_id)
+        _set_slot(node_id, slot, None, item_id, version)
+        NodeHistory.create(
+            operation="ADD",
+            node=node_id,
+            item=item_id,
+            slot=slot,
+            autonote=autonote,
+            note=note,
+        )
+
+
+def _set_slot(node_id, slot, old_item, new_item, version=None):
+    """Change `slot` of a node from `old_item` to `new_item`.
+
+    This is a compare-and-set: the slot is only changed if it still holds
+    `old_item` (which may be None for an empty slot) and, if `version` is
+    given, the node's row version is still `version`.  Concurrent changes
+    to the same slot therefore can't both succeed.  The node's version is
+    incremented and the NodeSlot index is updated to match.
+
+    Raises
+    ------
+    ConflictError
+        The slot doesn't hold `old_item`, or the node version isn't
+        `version`.
+    ValidationError
+        `new_item` is already installed elsewhere, or the node doesn't
+        exist.  A new item must first be checked with
+        `_check_installable`; this only catches the clashes which the
+        unique indexes detect.
+    """
+    field = _slot_field(slot)
+    if old_item is None:
+        condition = field.is_null()
+    else:
+        condition = field == old_item
+    if version is not None:
+        condition &= NodeAssembled.version == version
+
+    try:
+        updated = (
+            NodeAssembled.update(
+                {field: new_item, NodeAssembled.version: NodeAssembled.version + 1}
+            )
+            .where((NodeAssembled.id == node_id) & condition)
+            .execute()
+        )
+    except pw.IntegrityError:
+        raise ValidationError(
+            "item {0} is already installed in a node".format(new_item)
+        )
+
+    if not updated:
+        # Work out why, for the error message
+        row = (
+            NodeAssembled.select(field, NodeAssembled.version)
+            .where(NodeAssembled.id == node_id)
+            .tuples()
+            .first()
+        )
+        if row is None:
+            raise ValidationError("no node with id {0}".format(node_id))
+        if version is not None and row[1] != version:
+            raise ConflictError(
+                "node {0} has version {1}, expected {2}".format(
+                    node_id, row[1], version
+                )
+            )
+        if old_item is None:
+            raise ConflictError(
+                "slot {0} of node {1} is not empty".format(slot, node_id)
+            )
+        raise ConflictError(
+            "slot {0} of node {1} does not hold item {2}".format(
+                slot, node_id, old_item
+            )
+        )
+
+    try:
+        sync_slot(node_id, slot, new_item)
+    except pw.IntegrityError:
+        raise ValidationError(
+            "item {0} is already installed in a node".format(new_item)
+        )
+
+
+def _send_to_rma(item_id, rma, timestamp):
+    """Mark a component as sent for RMA and create its NodeRMA record.
+
+    Parameters
+    ----------
+    item_id : integer
+        The component.
+    rma : dict or True
+        The NodeRMA fields ('number', 'company', 'send_time').  True
+        creates a record with no number or company.
+    timestamp : datetime
+        The default send time.
+
+    Returns
+    -------
+    rma_id : integer
+        The id of the new NodeRMA record.
+    """
+    fields = dict(rma) if isinstance(rma, dict) else dict()
+    fields.setdefault("send_time", timestamp)
+
+    NodeItem.update(
+        {NodeItem.status: "RMA", NodeItem.version: NodeItem.version + 1}
+    ).where(NodeItem.id == item_id).execute()
+    return NodeRMA.insert(item=item_id, **fields).execute()
+
+
+@_write_operation
+def remove_component(node, slot, rma=None, note=None, version=None, old_item=None):
+    """Remove the component from a slot of a node.
+
+    Parameters
+    ----------
+    node : NodeAssembled or integer
+        The node, or its id.
+    slot : string
+        The name of the slot.  Must be one of `NODE_SLOTS`.
+    rma : dict or True, optional
+        If given, the removed component is also sent out for RMA: its
+        status is set to 'RMA' and a NodeRMA record is created with the
+        fields in the dict ('number', 'company', 'send_time').
+    note : string, optional
+        The note for the history record.  If not given, one is generated.
+    version : integer, optional
+        If given, the expected row version of the node.
+    old_item : NodeItem or integer, optional
+        The component expected in the slot.  If given, the removal fails
+        unless the slot holds this component, as for `swap_component`.
+
+    Returns
+    -------
+    item_id : integer
+        The id of the removed component.
+
+    Raises
+    ------
+    ConflictError
+        The slot doesn't hold `old_item`, was changed by someone else
+        during the removal, or the node version isn't `version`.
+    ValidationError
+        The node doesn't exist or the slot is empty.
+    """
+    _slot_field(slot)
+    node_id = getattr(node, "id", node)
+    timestamp = datetime.datetime.now()
+
+    with NodeAssembled._meta.database.atomic():
+        if old_item is None:
+            item_id = _slot_contents(node_id, slot)
+            if item_id is None:
+                raise ValidationError(
+                    "slot {0} of node {1} is empty".format(slot, node_id)
+                )
+        else:
+            item_id = getattr(old_item, "id", old_item)
+
+        # Only clears the slot if it still holds the item we just read
+        _set_slot(node_id, slot, item_id, None, version)
+
+        rma_id = None if rma is None else _send_to_rma(item_id, rma, timestamp)
+
+        if note is None:
+            autonote = True
+            note = "Removed item {0} from {1}".format(item_id, slot)
+            if rma_id is not None:
+                note += " for RMA"
+        else:
+            autonote = False
+        NodeHistory.create(
+            operation="DEL",
+            node=node_id,
+            item=item_id,
+            rma=rma_id,
+            slot=slot,
+            timestamp=timestamp,
+            autonote=autonote,
+            note=note,
+        )
+
+    return item_id
+
+
+def _slot_contents(node_id, slot):
+    """Return the id of the item in `slot` of a node, or None if it's empty."""
+    field = _slot_field(slot)
+    return NodeAssembled.select(field).where(NodeAssembled.id == node_id).scalar()
+
+
+@_write_operation
+def swap_component(
+    node, slot, new_item, rma=None, old_item=None, note=None, version=None
+):
+    """Replace the component in a slot of a node with another.
+
+    This is the usual field repair: pull the failed part, optionally send
+    it for RMA, and install a spare.  Everything happens in one
+    transaction: one compare-and-set UPDATE of the slot, the RMA updates
+    if requested, and one multi-row INSERT of the two history records.
+
+    The slot is only changed if it still holds the old component, so two
+    people can't swap the same slot at once, and the new component can't
+    be installed if it's already in a node.
+
+    Parameters
+    ----------
+    node : NodeAssembled or integer
+        The node, or its id.
+    slot : string
+        The name of the slot.  Must be one of `NODE_SLOTS`.
+    new_item : NodeItem or integer
+        The component to install, or its id.
+    rma : dict or True, optional
+        If given, the removed component is sent out for RMA, as for
+        `remove_component`.
+    old_item : NodeItem or integer, optional
+        The component expected in the slot.  If given, the swap fails
+        unless the slot holds this component; this saves a query and
+        protects against acting on stale information.  If not given,
+        the current contents of the slot are replaced.
+    note : string, optional
+        The note for the history records.  If not given, notes are
+        generated.
+    version : integer, optional
+        If given, the expected row version of the node.
+
+    Returns
+    -------
+    old_id : integer
+        The id of the removed component.
+
+    Raises
+    ------
+    ConflictError
+        The slot doesn't hold `old_item`, or the node version isn't
+        `version`.
+    ValidationError
+        The slot is empty, `new_item` is `old_item`, doesn't fit the slot
+        or is already installed in a node.
+    """
+    _slot_field(slot)
+    node_id = getattr(node, "id", node)
+    new_id = getattr(new_item, "id", new_item)
+    if old_item is not None and getattr(old_item, "id", old_item) == new_id:
+        raise ValidationError("can't swap item {0} with itself".format(new_id))
+    timestamp = datetime.datetime.now()
+
+    with NodeAssembled._meta.database.atomic():
+        # This also rejects swapping the installed item with itself
+        _check_installable(slot, new_id)
+        if old_item is None:
+            old_id = _slot_contents(node_id, slot)
+            if old_id is None:
+                raise ValidationError(
+                    "slot {0} of node {1} is empty".format(slot, node_id)
+                )
+        else:
+            old_id = getattr(old_item, "id", old_item)
+
+        _set_slot(node_id, slot, old_id, new_id, version)
+
+        rma_id = None if rma is None else _send_to_rma(old_id, rma, timestamp)
+
+        if note is None:
+            autonote = True
+            del_note = "Replaced item {0} in {1} with item {2}".format(
+                old_id, slot, new_id
+            )
+            if rma_id is not None:
+                del_note += "; sent for RMA"
+            add_note = "Installed item {0} in {1}, replacing item {2}".format(
+                new_id, slot, old_id
+            )
+        else:
+            autonote = False
+            del_note = add_note = note
+
+        row = {
+            "node": node_id,
+            "slot": slot,
+            "timestamp": timestamp,
+            "autonote": autonote,
+        }
+        NodeHistory.insert_many(
+            [
+                dict(row, operation="DEL", item=old_id, rma=rma_id, note=del_note),
+                dict(row, operation="ADD", item=new_id, rma=None, note=add_note),
+            ]
+        ).execute()
+
+    return old_id
+
+
+def _update_versioned(model, instance, version, fields):
+    """Compare-and-set update of a versioned row.
+
+    Returns the new version.  Raises ConflictError if the row's version
+    isn't `version` (when given) and ValidationError if it doesn't exist.
+    """
+    id_ = getattr(instance, "id", instance)
+    if version is None and isinstance(instance, model):
+        version = instance.version
+
+    condition = model.id == id_
+    if version is not None:
+        condition &= model.version == version
+
+    values = {getattr(model, name): value for name, value in fields.items()}
+    values[model.version] = model.version + 1
+    if not model.update(values).where(condition).execute():
+        current = model.select(model.version).where(model.id == id_).scalar()
+        if current is None:
+            raise ValidationError("no {0} with id {1}".format(model.__name__, id_))
+        raise ConflictError(
+            "{0} {1} has version {2}, expected {3}".format(
+                model.__name__, id_, current, version
+            )
+        )
+
+    if version is None:
+        return model.select(model.version).where(model.id == id_).scalar()
+    return version + 1
+
+
+def _describe_changes(fields):
+    """Return an automatic note describing a change of fields."""
+    return ", ".join(
+        "{0} = {1}".format(name, value) for name, value in sorted(fields.items())
+    )
+
+
+@_write_operation
+def update_item(item, version=None, note=None, **fields):
+    """Change the fields of a component, detecting conflicting updates.
+
+    The update is `UPDATE ... WHERE id = ? AND version = ?`, so it fails
+    rather than overwriting a change made by someone else since `item`
+    was read.  A 'NOP' history record noting the change is written.
+
+    Parameters
+    ----------
+    item : NodeItem or integer
+        The component.  If a NodeItem, its `version` is the expected
+        version unless `version` is given.
+    version : integer, optional
+        The expected row version.  If neither this nor a NodeItem is
+        given, the update is unconditional.
+    note : string, optional
+        The note for the history record.  If not given, one is generated.
+    **fields
+        The new values of any of 'model', 'serial', 'status' and
+        'location'.
+
+    Returns
+    -------
+    version : integer
+        The new row version.
+
+    Raises
+    ------
+    ValueError
+        A field can't be updated, or `status` isn't a valid status.
+    ConflictError
+        The component's version isn't the expected one.
+    ValidationError
+        The component doesn't exist, or the new serial is already used by
+        another component of the same type.
+    """
+    unknown = set(fields) - set(["model", "serial", "status", "location"])
+    if unknown:
+        raise ValueError("can't update NodeItem fields: " + ", ".join(sorted(unknown)))
+    if "status" in fields:
+        _check_enum(NodeItem.status, fields["status"])
+
+    item_id = getattr(item, "id", item)
+    if note is None:
+        autonote = True
+        note = "Updated item {0}: {1}".format(item_id, _describe_changes(fields))
+    else:
+        autonote = False
+
+    with NodeItem._meta.database.atomic():
+        try:
+            new_version = _update_versioned(NodeItem, item, version, fields)
+        except pw.IntegrityError as e:
+            raise ValidationError("can't update item {0}: {1}".format(item_id, e))
+        NodeHistory.create(operation="NOP", item=item_id, autonote=autonote, note=note)
+
+    return new_version
+
+
+@_write_operation
+def update_node(node, version=None, note=None, **fields):
+    """Change the fields of a node, detecting conflicting updates.
+
+    As for `update_item`.  Slots can't be changed this way: use
+    `install_component`, `remove_component` or `swap_component`.
+
+    Parameters
+    ----------
+    node : NodeAssembled or integer
+        The node.  If a NodeAssembled, its `version` is the expected
+        version unless `version` is given.
+    version : integer, optional
+        The expected row version.
+    note : string, optional
+        The note for the history record.  If not given, one is generated.
+    **fields
+        The new values of 'serial' and/or 'node_type'.
+
+    Returns
+    -------
+    version : integer
+        The new row version.
+
+    Raises
+    ------
+    ValueError
+        A field can't be updated, or `node_type` isn't a valid type.
+    ConflictError
+        The node's version isn't the expected one.
+    ValidationError
+        The node doesn't exist, or the update violates a constraint.
+    """
+    unknown = set(fields) - set(["serial", "node_type"])
+    if unknown:
+        raise ValueError(
+            "can't update NodeAssembled fields: " + ", ".join(sorted(unknown))
+        )
+    if "node_type" in fields:
+        _check_enum(NodeAssembled.node_type, fields["node_type"])
+
+    node_id = getattr(node, "id", node)
+    if note is None:
+        autonote = True
+        note = "Updated node {0}: {1}".format(node_id, _describe_changes(fields))
+    else:
+        autonote = False
+
+    with NodeAssembled._meta.database.atomic():
+        try:
+            new_version = _update_versioned(NodeAssembled, node, version, fields)
+        except pw.IntegrityError as e:
+            raise ValidationError("can't update node {0}: {1}".format(node_id, e))
+        NodeHistory.create(operation="NOP", node=node_id, autonote=autonote, note=note)
+
+    return new_version
+
+
+def retry_on_conflict(attempts=3):
+    """Decorator retrying a function which raises ConflictError.
+
+    The function must re-read whatever it depends on each time it is
+    called, otherwise the retry will just conflict again.
+
+    Parameters
+    ----------
+    attempts : int, optional
+        The maximum number of calls.  The last ConflictError is re-raised
+        if they all fail.
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            for attempt in range(attempts):
+                try:
+                    return func(*args, **kwargs)
+                except ConflictError:
+                    if attempt == attempts - 1:
+                        raise
+                    _logger.debug("Conflict in {0}; retrying".format(func.__name__))
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,155 @@
+"""Parallel audit of hardware discovery dumps
+
+Parsing the discovery output of every node in the fleet is CPU-bound, so
+`run_audit` spreads it over a pool of worker processes.  The expected
+state is loaded from the database once, in the calling process, as a
+`chimedb.node.discovery.ExpectedState`.  It is handed to each worker once,
+through the pool initializer, rather than with every task; the workers
+then parse and check reports without touching the database, and the
+results are yielded as each node finishes.
+
+A discovery dump is a directory with a subdirectory for each node, named
+after the node serial, holding any of the files in `DUMP_FILES`.
+"""
+from .discovery import ExpectedState, NodeDiff, parse_report
+
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+import os
+import xml.etree.ElementTree as ElementTree
+
+# The file in each node's dump directory holding each kind of document
+DUMP_FILES = {
+    "dmidecode": "dmidecode.txt",
+    "lshw": "lshw.json",
+    "nvidia_smi": "nvidia-smi.xml",
+    "ip_link": "ip-link.txt",
+}
+
+# The expected state in a worker process, set by _init_worker
+_state = None
+
+
+def _init_worker(state):
+    global _state
+    _state = state
+
+
+def _audit_node(node, documents=None, paths=None):
+    """Parse and check one node's report in a worker process.
+
+    The documents are given either as text or as the paths of files to
+    read, so that the worker, rather than the parent, does the reading.
+    """
+    try:
+        if paths is not None:
+            documents = dict()
+            for name, path in paths.items():
+                with open(path) as f:
+                    documents[name] = f.read()
+        report = parse_report(node, **documents)
+    except (OSError, ValueError, ElementTree.ParseError) as e:
+        return NodeDiff(node, _state.node_ids.get(node), error=str(e))
+
+    return _state.diff(report)
+
+
+def dump_reports(directory):
+    """List the node reports in a discovery dump.
+
+    Parameters
+    ----------
+    directory : string
+        The dump directory.
+
+    Yields
+    ------
+    node, paths : string, dict
+        The node serial, and a dict mapping `parse_report` argument names
+        to the paths of the files present for the node.
+    """
+    for node in sorted(os.listdir(directory)):
+        node_dir = os.path.join(directory, node)
+        if not os.path.isdir(node_dir):
+            continue
+
+        paths = dict()
+        for name, filename in DUMP_FILES.items():
+            path = os.path.join(node_dir, filename)
+            if os.path.exists(path):
+                paths[name] = path
+        if paths:
+            yield node, paths
+
+
+def run_audit(reports, state=None, max_workers=None, paths=False):
+    """Check node reports against the database in parallel.
+
+    Parameters
+    ----------
+    reports : iterable of (node, dict)
+        The node serial and its documents, as keyword arguments for
+        `chimedb.node.discovery.parse_report`.  If `paths` is True, the
+        dict values are instead the paths of the files to read, as yielded
+        by `dump_reports`.
+    state : ExpectedState, optional
+        The state to check against.  By default, the state of the whole
+        fleet is loaded from the database before any work starts.
+    max_workers : int, optional
+        The number of worker processes.  Defaults to the number of CPUs.
+    paths : bool, optional
+        Whether the reports give file paths rather than text.
+
+    Yields
+    ------
+    diff : NodeDiff
+        The result for each node, in the order they finish.  Nodes which
+        match the database give an empty (false) NodeDiff.
+    """
+    if state is None:
+        state = ExpectedState.load()
+    if max_workers is None:
+        max_workers = os.cpu_count() or 1
+
+    with ProcessPoolExecutor(
+        max_workers=max_workers, initializer=_init_worker, initargs=(state,)
+    ) as executor:
+        # Keep a bounded number of tasks queued, so that a large dump isn't
+        # all read into memory before the first results come back
+        limit = 4 * max_workers
+        pending = set()
+        for node, documents in reports:
+            if paths:
+                future = executor.submit(_audit_node, node, paths=documents)
+            else:
+                future = executor.submit(_audit_node, node, documents)
+            pending.add(future)
+
+            if len(pending) >= limit:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+def audit_dump(directory, state=None, max_workers=None):
+    """Check a discovery dump against the database in parallel.
+
+    Parameters
+    ----------
+    directory : string
+        The dump directory; see `dump_reports`.
+    state, max_workers
+        As for `run_audit`.
+
+    Yields
+    ------
+    diff : NodeDiff
+        The result for each node, in the order they finish.
+    """
+    return run_audit(
+        dump_reports(directory), state=state, max_workers=max_workers, paths=True
+    )
@@ -0,0 +1,181 @@
+"""Opt-in read-through cache for node database lookups
+
+A `NodeCache` holds the results of lookups of components, nodes and MAC
+addresses.  Every write made through `chimedb.node.api` writes a
+NodeHistory record, so the cache checks it is still valid with a single
+`SELECT MAX(id) FROM NodeHistory` rather than re-running the lookups; if
+the maximum has changed, the whole cache is dropped.  Writes made by
+`chimedb.node.api` in this process also bump a local generation counter,
+which drops the cache without waiting for the next check.
+
+Cached model instances are shared between callers and must be treated
+as read-only.  The cache's lock is not held while the database is
+queried, so lookups from several threads run concurrently; two threads
+missing on the same key both run the lookup.
+"""
+from .lookup import find_item, find_node
+from .mac import locate_mac, parse_mac
+from .orm import NodeItem, NodeAssembled, NodeHistory
+
+from collections import OrderedDict
+import peewee as pw
+import threading
+import time
+
+# Incremented by every write made through chimedb.node.api in this process
+_generation = 0
+
+
+def bump_generation():
+    """Invalidate all NodeCaches in this process.
+
+    Called by the write operations in `chimedb.node.api`.
+    """
+    global _generation
+    _generation += 1
+
+
+class NodeCache(object):
+    """A size-bounded LRU cache of node database lookups.
+
+    Parameters
+    ----------
+    maxsize : int, optional
+        The maximum number of cached lookups.  The least recently used
+        are discarded first.
+    max_age : float, optional
+        The number of seconds between checks of NodeHistory for changes
+        made by other processes.  0 checks on every lookup.
+    """
+
+    def __init__(self, maxsize=4096, max_age=1.0):
+        self.maxsize = maxsize
+        self.max_age = max_age
+
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        # Incremented whenever the cache is dropped, so that lookups which
+        # started before then don't store their (possibly stale) results
+        self._epoch = 0
+        self._token = None
+        self._generation = _generation
+        self._checked = None
+
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def clear(self):
+        """Drop everything in the cache."""
+        with self._lock:
+            self._data.clear()
+            self._epoch += 1
+
+    def stats(self):
+        """Return a dict of cache statistics.
+
+        The keys are 'hits', 'misses', 'invalidations', 'size' and
+        'maxsize'.
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidations": self.invalidations,
+            "size": len(self._data),
+            "maxsize": self.maxsize,
+        }
+
+    def _validate(self):
+        """Drop the cache if the database may have changed."""
+        now = time.monotonic()
+        with self._lock:
+            if self._generation != _generation:
+                self._generation = _generation
+                self._checked = None
+
+            if self._checked is not None and now - self._checked < self.max_age:
+                return
+            # Other threads skip the check until this one has made it
+            self._checked = now
+
+        try:
+            token = NodeHistory.select(pw.fn.MAX(NodeHistory.id)).scalar()
+        except Exception:
+            with self._lock:
+                self._checked = None
+            raise
+
+        with self._lock:
+            if token != self._token:
+                if self._data:
+                    self.invalidations += 1
+                self._data.clear()
+                self._epoch += 1
+                self._token = token
+
+    def _get(self, key, loader):
+        """Return the cached value for `key`, calling `loader` on a miss."""
+        self._validate()
+
+        with self._lock:
+            try:
+                value = self._data[key]
+            except KeyError:
+                pass
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+
+            self.misses += 1
+            epoch = self._epoch
+
+        value = loader()
+
+        with self._lock:
+            if self._epoch == epoch:
+                self._data[key] = value
+                while len(self._data) > self.maxsize:
+                    self._data.popitem(last=False)
+
+        return value
+
+    def item(self, id_):
+        """Return the NodeItem with the given id, or None."""
+        return self._get(
+            ("item", id_), lambda: NodeItem.get_or_none(NodeItem.id == id_)
+        )
+
+    def item_by_serial(self, serial, item_type=None):
+        """Return the NodeItem with the given serial (and type), or None.
+
+        See `chimedb.node.lookup.find_item`.
+        """
+        return self._get(
+            ("serial", serial, item_type), lambda: find_item(serial, item_type)
+        )
+
+    def node(self, id_):
+        """Return the NodeAssembled with the given id, or None."""
+        return self._get(
+            ("node", id_), lambda: NodeAssembled.get_or_none(NodeAssembled.id == id_)
+        )
+
+    def node_of(self, item):
+        """Return (node, slot) for the node holding a component.
+
+        See `chimedb.node.lookup.find_node`.
+        """
+        id_ = getattr(item, "id", item)
+        return self._get(("node_of", id_), lambda: find_node(id_))
+
+    def mac(self, mac):
+        """Return the MACRecord for a MAC address, or None.
+
+        See `chimedb.node.mac.locate_mac`.
+        """
+        value = parse_mac(mac)
+        return self._get(("mac", value), lambda: locate_mac(value))
@@ -0,0 +1,340 @@
+"""Command-line maintenance tools for the node hardware tracker
+
+Run as `chimedb-node <command>`; see `chimedb-node --help` for the list
+of commands.
+"""
+import argparse
+import sys
+
+import chimedb.core as db
+
+
+def _slots_rebuild(args):
+    """Repopulate the NodeSlot index from NodeAssembled."""
+    from .slots import rebuild_slot_index
+
+    db.connect(read_write=True)
+    count = rebuild_slot_index()
+    print("NodeSlot rebuilt: {0} slots".format(count))
+
+    return 0
+
+
+def _slots_verify(args):
+    """Check the NodeSlot index against NodeAssembled."""
+    from .slots import slot_index_enabled, verify_slot_index
+
+    db.connect()
+    if not slot_index_enabled():
+        print("NodeSlot table not present")
+        return 1
+
+    missing, extra = verify_slot_index()
+    for node, slot, item in sorted(missing, key=str):
+        print("missing: node {0} {1} = {2}".format(node, slot, item))
+    for node, slot, item in sorted(extra, key=str):
+        print("extra: node {0} {1} = {2}".format(node, slot, item))
+
+    if missing or extra:
+        print("NodeSlot out of sync: run `chimedb-node slots rebuild`")
+        return 1
+
+    print("NodeSlot in sync")
+    return 0
+
+
+def _migrate(args):
+    """Add declared columns and indexes missing from the database."""
+    from .migrate import migrate
+
+    db.connect(read_write=not args.dry_run)
+    changed, skipped = migrate(dry_run=args.dry_run)
+    for name in changed:
+        print("{0}: {1}".format("would add" if args.dry_run else "added", name))
+    for name in skipped:
+        print("skipped: {0}".format(name))
+
+    return 1 if skipped else 0
+
+
+def _checkpoint_create(args):
+    """Store a checkpoint of the current node contents."""
+    from .history import store_checkpoint
+
+    db.connect(read_write=True)
+    history_id = store_checkpoint()
+    if history_id is None:
+        print("No changes since the last checkpoint")
+    else:
+        print("Stored checkpoint at history id {0}".format(history_id))
+
+    if args.thin:
+        return _checkpoint_thin(args)
+    return 0
+
+
+def _checkpoint_thin(args):
+    """Delete old checkpoints according to the retention policy."""
+    from .history import thin_checkpoints
+
+    dry_run = getattr(args, "dry_run", False)
+    db.connect(read_write=not dry_run)
+    deleted = thin_checkpoints(dry_run=dry_run)
+    print(
+        "{0} {1} checkpoints".format(
+            "Would delete" if dry_run else "Deleted", len(deleted)
+        )
+    )
+
+    return 0
+
+
+def _dhcp(args):
+    """Write a DHCP host file; exit status 0 if it changed, 1 if not."""
+    from .dhcp import write_hosts
+
+    db.connect()
+    mac_types = args.mac_type or None
+    diff = write_hosts(args.path, args.format, mac_types=mac_types)
+    if not diff:
+        return 1
+
+    if args.diff:
+        sys.stdout.writelines(diff)
+    return 0
+
+
+def _audit(args):
+    """Check a discovery dump; exit status 1 if anything differs."""
+    from .audit import audit_dump
+
+    db.connect()
+    status = 0
+    for diff in audit_dump(args.directory, max_workers=args.workers):
+        if diff:
+            status = 1
+            for line in diff.summary():
+                print(line)
+            sys.stdout.flush()
+
+    return status
+
+
+def _export(args):
+    """Export the node database to Parquet or CSV files."""
+    from .export import export_all
+
+    db.connect()
+    counts = export_all(args.directory, args.format, batch_size=args.batch_size)
+    for name, count in counts.items():
+        print("{0}: {1} rows".format(name, count))
+
+    return 0
+
+
+def _restore(args):
+    """Load the node tables from an export directory."""
+    from .restore import restore
+
+    db.connect(read_write=True)
+    counts = restore(
+        args.directory,
+        args.format,
+        replace=args.replace,
+        chunk_size=args.chunk_size,
+        single_transaction=not args.commit_chunks,
+        defer_indexes=not args.keep_indexes,
+        disable_checks=args.disable_checks,
+    )
+    for name, count in counts.items():
+        print("{0}: {1} rows".format(name, count))
+
+    return 0
+
+
+def _rma(args):
+    """Print RMA turnaround, open RMAs and failure rates."""
+    from .rma import failure_rates, open_rma_summary, turnaround
+
+    db.connect()
+    print("Turnaround (days): company, count, mean, median, p90")
+    for row in turnaround():
+        print(
+            "  {0}: {1} {2:.1f} {3:.1f} {4:.1f}".format(
+                row.company, row.count, row.mean, row.median, row.p90
+            )
+        )
+
+    print("Open longer than {0} days: company, count, oldest".format(args.days))
+    for row in open_rma_summary(older_than=args.days):
+        print("  {0}: {1} {2}".format(row.company, row.count, row.oldest))
+
+    print("Failure rate: model, RMAs, installed, rate")
+    for row in failure_rates():
+        rate = "-" if row.rate is None else "{0:.3f}".format(row.rate)
+        print("  {0}: {1} {2} {3}".format(row.model, row.failures, row.installed, rate))
+
+    return 0
+
+
+def _metrics(args):
+    """Serve the node database gauges for Prometheus."""
+    from .metrics import MetricsExporter, serve
+
+    db.connect()
+    exporter = MetricsExporter(ttl=args.ttl)
+    if args.once:
+        sys.stdout.write(exporter.render())
+        return 0
+
+    try:
+        serve(exporter, port=args.port, address=args.address)
+    except KeyboardInterrupt:
+        pass
+
+    return 0
+
+
+def _parser():
+    """Return the argument parser for the command line."""
+    parser = argparse.ArgumentParser(
+        prog="chimedb-node", description="CHIME node hardware database maintenance"
+    )
+    commands = parser.add_subparsers(dest="command", metavar="command")
+    commands.required = True
+
+    slots = commands.add_parser("slots", help="maintain the NodeSlot index")
+    slot_commands = slots.add_subparsers(dest="slot_command", metavar="action")
+    slot_commands.required = True
+    slot_commands.add_parser("rebuild", help=_slots_rebuild.__doc__).set_defaults(
+        func=_slots_rebuild
+    )
+    slot_commands.add_parser("verify", help=_slots_verify.__doc__).set_defaults(
+        func=_slots_verify
+    )
+
+    migrate = commands.add_parser("migrate", help=_migrate.__doc__)
+    migrate.add_argument(
+        "--dry-run", action="store_true", help="only list the changes to make"
+    )
+    migrate.set_defaults(func=_migrate)
+
+    checkpoint = commands.add_parser(
+        "checkpoint", help="maintain the NodeSnapshot checkpoints"
+    )
+    checkpoint_commands = checkpoint.add_subparsers(
+        dest="checkpoint_command", metavar="action"
+    )
+    checkpoint_commands.required = True
+    create = checkpoint_commands.add_parser("create", help=_checkpoint_create.__doc__)
+    create.add_argument(
+        "--thin", action="store_true", help="also delete old checkpoints"
+    )
+    create.set_defaults(func=_checkpoint_create)
+    thin = checkpoint_commands.add_parser("thin", help=_checkpoint_thin.__doc__)
+    thin.add_argument(
+        "--dry-run", action="store_true", help="only count the checkpoints to delete"
+    )
+    thin.set_defaults(func=_checkpoint_thin)
+
+    dhcp = commands.add_parser("dhcp", help=_dhcp.__doc__)
+    dhcp.add_argument("format", choices=["dnsmasq", "isc", "ethers"])
+    dhcp.add_argument("path", help="the file to write")
+    dhcp.add_argument(
+        "--mac-type",
+        action="append",
+        choices=["NIC0", "NIC1", "NIC2", "NIC3", "IPMI"],
+        help="only include this MAC type (may be repeated)",
+    )
+    dhcp.add_argument("--diff", action="store_true", help="print the changes")
+    dhcp.set_defaults(func=_dhcp)
+
+    audit = commands.add_parser("audit", help=_audit.__doc__)
+    audit.add_argument("directory", help="the discovery dump directory")
+    audit.add_argument(
+        "--workers", type=int, default=None, help="the number of worker processes"
+    )
+    audit.set_defaults(func=_audit)
+
+    export = commands.add_parser("export", help=_export.__doc__)
+    export.add_argument("directory", help="the output directory")
+    export.add_argument(
+        "--format",
+        choices=["parquet", "csv"],
+        default=None,
+        help="the output format (default: parquet if pyarrow is installed)",
+    )
+    export.add_argument(
+        "--batch-size", type=int, default=50000, help="rows read at a time"
+    )
+    export.set_defaults(func=_export)
+
+    restore = commands.add_parser("restore", help=_restore.__doc__)
+    restore.add_argument("directory", help="the export directory")
+    restore.add_argument(
+        "--format",
+        choices=["parquet", "csv"],
+        default=None,
+        help="the input format (default: whichever is present)",
+    )
+    restore.add_argument(
+        "--replace", action="store_true", help="delete the existing rows first"
+    )
+    restore.add_argument(
+        "--chunk-size", type=int, default=5000, help="rows in each INSERT"
+    )
+    restore.add_argument(
+        "--commit-chunks",
+        action="store_true",
+        help="commit each INSERT rather than loading in one transaction",
+    )
+    restore.add_argument(
+        "--keep-indexes",
+        action="store_true",
+        help="don't drop the non-unique indexes during the load",
+    )
+    restore.add_argument(
+        "--disable-checks",
+        action="store_true",
+        help="turn off MySQL foreign key and unique checks during the load",
+    )
+    restore.set_defaults(func=_restore)
+
+    rma = commands.add_parser("rma", help=_rma.__doc__)
+    rma.add_argument(
+        "--days",
+        type=float,
+        default=30,
+        help="list RMAs open longer than this (default: 30)",
+    )
+    rma.set_defaults(func=_rma)
+
+    metrics = commands.add_parser("metrics", help=_metrics.__doc__)
+    metrics.add_argument(
+        "--port", type=int, default=9123, help="port to serve /metrics on"
+    )
+    metrics.add_argument(
+        "--address", default="", help="address to listen on (default: all)"
+    )
+    metrics.add_argument(
+        "--ttl",
+        type=float,
+        default=60,
+        help="seconds to reuse the gauges before querying again (default: 60)",
+    )
+    metrics.add_argument(
+        "--once", action="store_true", help="print the gauges once and exit"
+    )
+    metrics.set_defaults(func=_metrics)
+
+    return parser
+
+
+def main(argv=None):
+    """Entry point for the `chimedb-node` command."""
+    args = _parser().parse_args(argv)
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,179 @@
+"""DHCP host file generation from NodeMAC
+
+Writes the MAC addresses of the components installed in assembled nodes
+as dnsmasq `dhcp-host` lines, ISC dhcpd `host` blocks or an /etc/ethers
+file.  The MACs are read from the database in one query, and the output
+is only replaced if it has changed, so the DHCP server need only be
+reloaded when something is different.
+"""
+from .export import stream_rows
+from .mac import MACRecord, format_mac, mac_location_query
+from .orm import NodeAssembled, NodeMAC
+
+import difflib
+import os
+import tempfile
+
+# First line of every generated file.  This must not vary between runs,
+# or every file would look changed.
+HEADER = "# Generated from the CHIME node database by chimedb.node.dhcp. Do not edit."
+
+# The interface a node boots from, which is named after the node
+BOOT_SLOT = "motherboard"
+BOOT_MAC_TYPE = "NIC0"
+
+
+def default_hostname(record):
+    """Return the host name for a MAC address.
+
+    The boot interface of a node (NIC0 of the motherboard) is named after
+    the node serial.  The other motherboard interfaces get a suffix
+    ("-nic1", ..., "-ipmi"), and the interfaces of the other components
+    get the slot and interface, e.g. "-nic-nic0" for NIC0 of the NIC card.
+    Underscores, which aren't allowed in host names, become hyphens
+    (e.g. "-rack-slot-nic0").
+
+    Parameters
+    ----------
+    record : MACRecord
+        The MAC address location.
+
+    Returns
+    -------
+    hostname : string
+    """
+    name = record.node_serial.lower()
+    if record.slot == BOOT_SLOT:
+        if record.mac_type != BOOT_MAC_TYPE:
+            name = "{0}-{1}".format(name, record.mac_type.lower())
+    else:
+        name = "{0}-{1}-{2}".format(name, record.slot, record.mac_type.lower())
+    return name.replace("_", "-")
+
+
+def _dnsmasq(mac, hostname, record):
+    return "dhcp-host={0},{1}\n".format(mac, hostname)
+
+
+def _isc(mac, hostname, record):
+    return (
+        "host {0} {{\n"
+        "  hardware ethernet {1};\n"
+        '  option host-name "{0}";\n'
+        "}}\n"
+    ).format(hostname, mac)
+
+
+def _ethers(mac, hostname, record):
+    return "{0} {1}\n".format(mac, hostname)
+
+
+# Line formatters for each output format
+FORMATS = {"dnsmasq": _dnsmasq, "isc": _isc, "ethers": _ethers}
+
+
+def host_entries(fmt, hostname=default_hostname, mac_types=None):
+    """Generate the entries of a DHCP host file.
+
+    Only MACs of components installed in a node are included.  The rows
+    are read as they are needed, through a server-side cursor if the
+    database driver has one (see `chimedb.node.export`); other drivers
+    fetch the whole result before the first entry.
+
+    Parameters
+    ----------
+    fmt : string
+        The output format: one of the keys of `FORMATS`.
+    hostname : callable, optional
+        Takes a MACRecord and returns the host name to use for it, or
+        None to leave it out.
+    mac_types : list of strings, optional
+        If given, only include MACs of these types (e.g. ["IPMI"]).
+
+    Yields
+    ------
+    entry : string
+        The text of each entry, ending with a newline.
+
+    Raises
+    ------
+    ValueError
+        Two MACs were given the same host name.
+    """
+    formatter = FORMATS[fmt]
+
+    query, _ = mac_location_query()
+    query = query.where(NodeAssembled.id.is_null(False)).order_by(
+        NodeAssembled.serial, NodeMAC.mac_type
+    )
+    if mac_types is not None:
+        query = query.where(NodeMAC.mac_type.in_(list(mac_types)))
+
+    names = dict()
+    for row in stream_rows(query):
+        record = MACRecord(*row[1:])
+        name = hostname(record)
+        if name is None:
+            continue
+        if name in names:
+            raise ValueError(
+                "host name {0} is used for both {1} and {2}".format(
+                    name, names[name], format_mac(row[0])
+                )
+            )
+        names[name] = format_mac(row[0])
+        yield formatter(names[name], name, record)
+
+
+def write_hosts(path, fmt, hostname=default_hostname, mac_types=None):
+    """Write a DHCP host file, replacing the existing file only if it changed.
+
+    The new file is written next to `path` and atomically renamed over
+    it, so the DHCP server never sees a partial file.
+
+    Parameters
+    ----------
+    path : string
+        The file to write.
+    fmt, hostname, mac_types
+        As for `host_entries`.
+
+    Returns
+    -------
+    diff : list of strings
+        The unified diff between the old and new file.  Empty if nothing
+        changed, in which case the file is not touched.
+
+    Raises
+    ------
+    ValueError
+        Two MACs were given the same host name.  The file is unchanged.
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    handle, temp_path = tempfile.mkstemp(dir=directory, prefix=".dhcp-")
+    try:
+        with os.fdopen(handle, "w") as f:
+            f.write(HEADER + "\n")
+            for entry in host_entries(fmt, hostname, mac_types):
+                f.write(entry)
+
+        try:
+            with open(path) as f:
+                old = f.readlines()
+        except FileNotFoundError:
+            old = list()
+        with open(temp_path) as f:
+            new = f.readlines()
+
+        diff = list(difflib.unified_diff(old, new, path, path + " (new)"))
+        if diff:
+            if os.path.exists(path):
+                os.chmod(temp_path, os.stat(path).st_mode & 0o7777)
+            else:
+                os.chmod(temp_path, 0o644)
+            os.replace(temp_path, path)
+    finally:
+        if os.path.exists(temp_path):
+            os.unlink(temp_path)
+
+    return diff
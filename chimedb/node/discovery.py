@@ -0,0 +1,682 @@
+"""Reconciliation of hardware discovery reports against the node database
+
+The hardware of each node can be collected with `dmidecode`,
+`lshw -json`, `nvidia-smi -q -x` and `ip link`.  `parse_report` turns
+that output into a `HardwareReport` of component serial numbers and MAC
+addresses; `reconcile` compares any number of reports with the database,
+using a fixed number of bulk queries however many nodes there are; and
+`apply_diffs` makes the database match the reports, writing history
+through `chimedb.node.api`.
+"""
+from . import api
+from .history import TYPE_SLOTS
+from .lookup import LOOKUP_CHUNK_SIZE, find_nodes, node_contents
+from .mac import format_mac, parse_mac
+from .orm import NodeItem, NodeMAC, NodeAssembled, NODE_SLOTS
+from .slots import slot_query
+
+from chimedb.core.exceptions import ValidationError
+
+from collections import namedtuple
+import json
+import peewee as pw
+import re
+import xml.etree.ElementTree as ElementTree
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# Placeholder values reported by firmware instead of a real serial number
+_NO_SERIAL = re.compile(
+    r"^(|not specified|not available|to be filled by o\.e\.m\.|default string|"
+    r"unknown|none|n/a|0+|no dimm|system serial number|serial ?num)$",
+    re.IGNORECASE,
+)
+
+# Interfaces in `ip link` output which don't correspond to hardware
+_VIRTUAL_INTERFACE = re.compile(r"^(lo|docker|veth|br-|virbr|vnet|tun|tap|cni|flannel)")
+
+# The slot recording a node's position in a rack.  Its item isn't part of
+# the host, so no report can see it.
+RACK_SLOT = "rack_slot"
+
+# A component seen in a report.  `slot` is a hint (e.g. "cpu1", "gpu0")
+# when the report says where the component is, otherwise None.
+Component = namedtuple("Component", ["type", "serial", "model", "slot"])
+
+
+class HardwareReport(object):
+    """The components and MAC addresses reported by one node.
+
+    Attributes
+    ----------
+    node : string
+        The serial number of the NodeAssembled.
+    components : dict
+        Maps (type, serial) to the Component seen.
+    macs : set of int
+        The MAC addresses of the physical network interfaces.
+    covered : set of strings
+        The NodeItem types the report's sources can see.  Components of
+        other types aren't flagged as missing.  "MAC" is included if the
+        report lists network interfaces.
+    """
+
+    def __init__(self, node):
+        self.node = node
+        self.components = dict()
+        self.macs = set()
+        self.covered = set()
+
+    def add(self, item_type, serial, model=None, slot=None):
+        """Add a component, ignoring placeholder serials."""
+        serial = (serial or "").strip()
+        if _NO_SERIAL.match(serial):
+            return
+        key = (item_type, serial)
+        # Keep the first slot hint and model seen for a component
+        old = self.components.get(key)
+        if old is not None:
+            slot = old.slot or slot
+            model = old.model or model
+        self.components[key] = Component(item_type, serial, model, slot)
+
+
+def _dmidecode_sections(text):
+    """Split dmidecode output into (title, {key: value}) pairs."""
+    for block in re.split(r"\n\s*\n", text):
+        lines = [line for line in block.splitlines() if not line.startswith("Handle")]
+        if not lines:
+            continue
+        fields = dict()
+        for line in lines[1:]:
+            key, sep, value = line.strip().partition(":")
+            if sep:
+                fields[key.strip()] = value.strip()
+        yield lines[0].strip(), fields
+
+
+def parse_dmidecode(report, text):
+    """Add the motherboard, CPUs and RAM in `dmidecode` output to `report`."""
+    report.covered.update(["MB", "CPU", "RAM"])
+    cpus = 0
+    dimms = 0
+    for title, fields in _dmidecode_sections(text):
+        if title == "Base Board Information":
+            report.add(
+                "MB",
+                fields.get("Serial Number"),
+                fields.get("Product Name"),
+                "motherboard",
+            )
+        elif title == "Processor Information":
+            if fields.get("Status", "").startswith("Unpopulated"):
+                continue
+            report.add(
+                "CPU",
+                fields.get("Serial Number"),
+                fields.get("Version"),
+                "cpu{0}".format(cpus),
+            )
+            cpus += 1
+        elif title == "Memory Device":
+            if fields.get("Size", "").startswith("No Module"):
+                continue
+            report.add(
+                "RAM",
+                fields.get("Serial Number"),
+                fields.get("Part Number"),
+                "ram{0}".format(dimms),
+            )
+            dimms += 1
+
+
+def parse_lshw(report, text):
+    """Add the components and MACs in `lshw -json` output to `report`."""
+    report.covered.update(["MB", "CPU", "RAM", "MAC"])
+
+    data = json.loads(text)
+    stack = data if isinstance(data, list) else [data]
+    while stack:
+        node = stack.pop()
+        stack.extend(node.get("children", []))
+
+        cls = node.get("class")
+        id_ = node.get("id", "")
+        if cls == "bus" and id_ == "core":
+            report.add("MB", node.get("serial"), node.get("product"), "motherboard")
+        elif cls == "processor":
+            report.add("CPU", node.get("serial"), node.get("product"))
+        elif cls == "memory" and id_.startswith("bank"):
+            if "empty" in node.get("description", "").lower():
+                continue
+            report.add("RAM", node.get("serial"), node.get("product"))
+        elif cls == "network" and node.get("serial"):
+            # lshw reports the MAC address as the serial of an interface
+            if _VIRTUAL_INTERFACE.match(node.get("logicalname", "") or ""):
+                continue
+            try:
+                report.macs.add(parse_mac(node["serial"]))
+            except ValueError:
+                pass
+
+
+def parse_nvidia_smi(report, text):
+    """Add the GPUs in `nvidia-smi -q -x` output to `report`."""
+    report.covered.add("GPU")
+
+    root = ElementTree.fromstring(text)
+    for gpu in root.findall("gpu"):
+        minor = gpu.findtext("minor_number")
+        slot = "gpu" + minor if minor in ("0", "1") else None
+        report.add("GPU", gpu.findtext("serial"), gpu.findtext("product_name"), slot)
+
+
+def parse_ip_link(report, text):
+    """Add the MAC addresses of the physical interfaces in `ip link` output."""
+    report.covered.add("MAC")
+
+    interface = None
+    for line in text.splitlines():
+        match = re.match(r"^\d+:\s+([^:@\s]+)", line)
+        if match:
+            interface = match.group(1)
+            continue
+        match = re.search(r"link/ether\s+([0-9a-fA-F:]{17})", line)
+        if match and interface and not _VIRTUAL_INTERFACE.match(interface):
+            # Bonded interfaces show their permanent address separately
+            permanent = re.search(r"permaddr\s+([0-9a-fA-F:]{17})", line)
+            report.macs.add(parse_mac((permanent or match).group(1)))
+
+
+# Parsers for each kind of document, keyed by the argument name
+PARSERS = {
+    "dmidecode": parse_dmidecode,
+    "lshw": parse_lshw,
+    "nvidia_smi": parse_nvidia_smi,
+    "ip_link": parse_ip_link,
+}
+
+
+def parse_report(node, dmidecode=None, lshw=None, nvidia_smi=None, ip_link=None):
+    """Parse the discovery output collected from one node.
+
+    Parameters
+    ----------
+    node : string
+        The serial number of the node (NodeAssembled.serial).
+    dmidecode, lshw, nvidia_smi, ip_link : string, optional
+        The output of `dmidecode`, `lshw -json`, `nvidia-smi -q -x` and
+        `ip link`.  Any may be omitted.
+
+    Returns
+    -------
+    report : HardwareReport
+    """
+    report = HardwareReport(node)
+    documents = {
+        "dmidecode": dmidecode,
+        "lshw": lshw,
+        "nvidia_smi": nvidia_smi,
+        "ip_link": ip_link,
+    }
+    for name, text in documents.items():
+        if text is not None:
+            PARSERS[name](report, text)
+
+    return report
+
+
+class NodeDiff(object):
+    """The differences between a node's report and the database.
+
+    Attributes
+    ----------
+    node : string
+        The node serial.
+    node_id : int or None
+        The id of the NodeAssembled, or None if the node is unknown.
+    missing : list of (slot, item_id, type, serial)
+        Components the database has in the node which weren't reported.
+    moved : list of (Component, item_id, from_node_id, from_slot)
+        Reported components which the database has elsewhere: in another
+        node (`from_node_id` and `from_slot` set) or in no node (both
+        None).
+    unexpected : list of Component
+        Reported components which aren't in the database at all.
+    unknown_macs : list of int
+        Reported MAC addresses which aren't in the database.
+    missing_macs : list of int
+        MAC addresses of components in the node which weren't reported.
+    error : string or None
+        Why the report couldn't be checked, if it couldn't.
+    """
+
+    def __init__(self, node, node_id, error=None):
+        self.node = node
+        self.node_id = node_id
+        self.error = error
+        self.missing = list()
+        self.moved = list()
+        self.unexpected = list()
+        self.unknown_macs = list()
+        self.missing_macs = list()
+
+    def __bool__(self):
+        return bool(
+            self.node_id is None
+            or self.error
+            or self.missing
+            or self.moved
+            or self.unexpected
+            or self.unknown_macs
+            or self.missing_macs
+        )
+
+    def summary(self):
+        """Return a list of strings describing the differences."""
+        if self.error is not None:
+            return ["{0}: {1}".format(self.node, self.error)]
+        if self.node_id is None:
+            return ["{0}: node not in database".format(self.node)]
+
+        lines = list()
+        for slot, _, item_type, serial in self.missing:
+            lines.append(
+                "{0}: missing {1} {2} ({3})".format(self.node, item_type, serial, slot)
+            )
+        for component, _, from_node, from_slot in self.moved:
+            where = (
+                "not installed"
+                if from_node is None
+                else "in node {0} {1}".format(from_node, from_slot)
+            )
+            lines.append(
+                "{0}: found {1} {2}, database has it {3}".format(
+                    self.node, component.type, component.serial, where
+                )
+            )
+        for component in self.unexpected:
+            lines.append(
+                "{0}: unknown {1} {2}".format(
+                    self.node, component.type, component.serial
+                )
+            )
+        for value in self.unknown_macs:
+            lines.append("{0}: unknown MAC {1}".format(self.node, format_mac(value)))
+        for value in self.missing_macs:
+            lines.append("{0}: missing MAC {1}".format(self.node, format_mac(value)))
+
+        return lines
+
+
+def _select(query, field, values):
+    """Iterate over `query`, restricted to rows with `field` in `values`.
+
+    If `values` is None, all rows are returned.  Otherwise one query is
+    run for each chunk of values.
+    """
+    if values is None:
+        for row in query.iterator():
+            yield row
+        return
+
+    for chunk in pw.chunked(list(values), LOOKUP_CHUNK_SIZE):
+        for row in query.where(field.in_(chunk)):
+            yield row
+
+
+class ExpectedState(object):
+    """What the database says the nodes contain.
+
+    Holds only plain tuples and dicts, so that the state is cheap to pickle
+    and can be compared against reports without touching the database.
+
+    Attributes
+    ----------
+    node_ids : dict
+        Maps NodeAssembled serial to id.
+    contents : dict
+        Maps node id to a dict mapping the id of each installed NodeItem to
+        (slot, type, serial).  The rack slot is left out.
+    items : dict
+        Maps (type, serial) to NodeItem id.
+    locations : dict
+        Maps NodeItem id to (node id, slot) for installed components.
+    macs : dict
+        Maps MAC value to (NodeItem id, Component).
+    expected_macs : dict
+        Maps NodeItem id to the set of its MAC values, other than IPMI.
+    """
+
+    def __init__(self):
+        self.node_ids = dict()
+        self.contents = dict()
+        self.items = dict()
+        self.locations = dict()
+        self.macs = dict()
+        self.expected_macs = dict()
+
+    @classmethod
+    def load(cls, reports=None):
+        """Load the expected state from the database.
+
+        Parameters
+        ----------
+        reports : iterable of HardwareReport, optional
+            If given, only load what is needed to check these reports.  By
+            default, the whole fleet is loaded with one query per table.
+
+        Returns
+        -------
+        state : ExpectedState
+        """
+        state = cls()
+        if reports is None:
+            node_serials = serials = reported_macs = None
+        else:
+            reports = list(reports)
+            node_serials = set(report.node for report in reports)
+            serials = set(
+                serial for report in reports for _, serial in report.components
+            )
+            reported_macs = set(value for report in reports for value in report.macs)
+
+        query = NodeAssembled.select(NodeAssembled.serial, NodeAssembled.id).tuples()
+        state.node_ids = dict(_select(query, NodeAssembled.serial, node_serials))
+
+        # The installed components
+        slots = slot_query(lambda field: field.is_null(False)).alias("slots")
+        query = (
+            NodeItem.select(slots.c.node_id, slots.c.slot, NodeItem.id)
+            .join(slots, on=(NodeItem.id == slots.c.item_id))
+            .tuples()
+        )
+        for node_id, slot, item_id in _select(
+            query,
+            slots.c.node_id,
+            None if reports is None else state.node_ids.values(),
+        ):
+            state.locations[item_id] = (node_id, slot)
+
+        # The components, by serial
+        query = NodeItem.select(NodeItem.id, NodeItem.type, NodeItem.serial).tuples()
+        item_rows = dict()
+        for id_, item_type, serial in _select(query, NodeItem.serial, serials):
+            state.items[(item_type, serial)] = id_
+            item_rows[id_] = (item_type, serial)
+        if reports is not None:
+            installed = set(state.locations) - set(item_rows)
+            for id_, item_type, serial in _select(query, NodeItem.id, installed):
+                item_rows[id_] = (item_type, serial)
+
+        for node_id in state.node_ids.values():
+            state.contents[node_id] = dict()
+        for item_id, (node_id, slot) in state.locations.items():
+            if slot != RACK_SLOT:
+                state.contents[node_id][item_id] = (slot,) + item_rows[item_id]
+
+        # The MACs
+        query = (
+            NodeMAC.select(
+                NodeMAC.value,
+                NodeMAC.mac_type,
+                NodeItem.id,
+                NodeItem.type,
+                NodeItem.serial,
+            )
+            .join(NodeItem)
+            .tuples()
+        )
+        rows = list(_select(query, NodeMAC.value, reported_macs))
+        if reports is not None:
+            rows.extend(_select(query, NodeMAC.item, state.locations))
+        for value, mac_type, id_, item_type, serial in rows:
+            state.macs[value] = (id_, Component(item_type, serial, None, None))
+            if (
+                mac_type != "IPMI"
+                and id_ in state.locations
+                and state.locations[id_][1] != RACK_SLOT
+            ):
+                state.expected_macs.setdefault(id_, set()).add(value)
+
+        # Where the reported components which aren't in the loaded nodes are
+        if reports is not None:
+            found = set(state.items.values()) | set(
+                entry[0] for entry in state.macs.values()
+            )
+            for item_id, (node, slot) in find_nodes(found).items():
+                state.locations.setdefault(item_id, (node.id, slot))
+
+        return state
+
+    def diff(self, report):
+        """Compare one report with the expected state.
+
+        Parameters
+        ----------
+        report : HardwareReport
+
+        Returns
+        -------
+        diff : NodeDiff
+        """
+        node_id = self.node_ids.get(report.node)
+        diff = NodeDiff(report.node, node_id)
+        if node_id is None:
+            return diff
+
+        here = self.contents[node_id]
+
+        def check_found(component, item_id):
+            if item_id in here:
+                return
+            location = self.locations.get(item_id, (None, None))
+            if location[1] == RACK_SLOT:
+                # Not a component of any host, whatever its type
+                return
+            diff.moved.append((component, item_id) + location)
+
+        # Components
+        seen = set()
+        for key, component in report.components.items():
+            item_id = self.items.get(key)
+            if item_id is None:
+                diff.unexpected.append(component)
+                continue
+            seen.add(item_id)
+            check_found(component, item_id)
+
+        # MACs identify components (e.g. NICs) which have no readable serial
+        if "MAC" in report.covered:
+            for value in sorted(report.macs):
+                if value not in self.macs:
+                    diff.unknown_macs.append(value)
+                    continue
+                item_id, component = self.macs[value]
+                if item_id not in seen:
+                    seen.add(item_id)
+                    check_found(component, item_id)
+
+            for item_id in here:
+                for value in sorted(self.expected_macs.get(item_id, ())):
+                    if value not in report.macs:
+                        diff.missing_macs.append(value)
+
+        for item_id, (slot, item_type, serial) in sorted(
+            here.items(), key=lambda entry: NODE_SLOTS.index(entry[1][0])
+        ):
+            if item_id in seen:
+                continue
+            # A component is missing if the report could have seen it, either
+            # by its type or, with a list of interfaces, by its MACs
+            if item_type in report.covered or (
+                "MAC" in report.covered and item_id in self.expected_macs
+            ):
+                diff.missing.append((slot, item_id, item_type, serial))
+
+        return diff
+
+
+def reconcile(reports, state=None):
+    """Compare hardware reports with the database.
+
+    All the reports are checked together with a fixed set of bulk
+    queries: the nodes and their contents, the reported serials, the
+    locations of those components, and the reported and expected MACs.
+
+    Parameters
+    ----------
+    reports : iterable of HardwareReport
+    state : ExpectedState, optional
+        The state to compare against.  By default, the state needed for
+        `reports` is loaded from the database.
+
+    Returns
+    -------
+    diffs : dict
+        Maps node serial to NodeDiff.  Nodes without differences are
+        included, with an empty (false) NodeDiff.
+    """
+    reports = list(reports)
+    if state is None:
+        state = ExpectedState.load(reports)
+
+    return dict((report.node, state.diff(report)) for report in reports)
+
+
+def _free_slot(slots, item_type, hint=None):
+    """Return a free slot for an item of `item_type`, or None.
+
+    The rack slot is never chosen.
+    """
+    prefix = TYPE_SLOTS.get(item_type)
+    if prefix is None:
+        return None
+    if hint is not None and hint.startswith(prefix) and slots.get(hint, False) is None:
+        return hint
+    for name in NODE_SLOTS:
+        if name.startswith(prefix) and slots.get(name, False) is None:
+            return name
+    return None
+
+
+def apply_diffs(diffs, note=None):
+    """Update the database to match the reports.
+
+    Missing components are removed from their nodes, and components found
+    elsewhere are moved into the node which reported them.  All removals
+    are done before any installs.  Components unknown to the database are
+    only logged; create them first with `chimedb.node.api.create_components`.
+
+    Each change is a compare-and-set: a component is only removed from a
+    slot which still holds it, and only installed in a slot which is still
+    empty.  If the database has changed since `reconcile` ran, the stale
+    parts of the diffs are skipped and reported, rather than undoing the
+    other change.
+
+    Parameters
+    ----------
+    diffs : iterable of NodeDiff
+        The output of `reconcile`.
+    note : string, optional
+        The note for the history records.  By default, notes are generated.
+
+    Returns
+    -------
+    actions : list of strings
+        A description of each change made.
+    skipped : list of strings
+        A description of each change not made because the database no
+        longer matched the diff.
+    """
+    diffs = [
+        diff
+        for diff in diffs
+        if diff and diff.node_id is not None and diff.error is None
+    ]
+    actions = list()
+    skipped = list()
+    removed = set()
+
+    def remove(node_id, slot, item_id, description):
+        try:
+            api.remove_component(node_id, slot, note=note, old_item=item_id)
+        except ValidationError as e:
+            # Including ConflictError: the slot no longer holds the item
+            _logger.warning("Not {0}: {1}".format(description, e))
+            skipped.append("{0}: {1}".format(description, e))
+        else:
+            actions.append(description)
+        # Either way, it is no longer where the diff says
+        removed.add(item_id)
+
+    for diff in diffs:
+        for slot, item_id, _, serial in diff.missing:
+            remove(
+                diff.node_id,
+                slot,
+                item_id,
+                "removed {0} from node {1} {2}".format(serial, diff.node, slot),
+            )
+
+    for diff in diffs:
+        for component, item_id, from_node, from_slot in diff.moved:
+            if from_node is not None and item_id not in removed:
+                remove(
+                    from_node,
+                    from_slot,
+                    item_id,
+                    "removed item {0} from node id {1} {2}".format(
+                        item_id, from_node, from_slot
+                    ),
+                )
+
+    # The slots as they are after the removals, and the types of the items
+    contents = dict(
+        (node["id"], node)
+        for node in node_contents([diff.node_id for diff in diffs], dicts=True)
+    )
+    moved = set(entry[1] for diff in diffs for entry in diff.moved)
+    item_types = dict(
+        _select(
+            NodeItem.select(NodeItem.id, NodeItem.type).tuples(), NodeItem.id, moved
+        )
+    )
+
+    for diff in diffs:
+        node = contents[diff.node_id]
+        slots = dict(
+            (name, None if node[name] is None else node[name]["id"])
+            for name in NODE_SLOTS
+        )
+        for component, item_id, _, _ in diff.moved:
+            slot = _free_slot(slots, item_types.get(item_id), component.slot)
+            if slot is None:
+                _logger.warning(
+                    "No free slot in node {0} for item {1}".format(diff.node, item_id)
+                )
+                continue
+            description = "installed item {0} in node {1} {2}".format(
+                item_id, diff.node, slot
+            )
+            try:
+                api.install_component(diff.node_id, slot, item_id, note=note)
+            except ValidationError as e:
+                # The slot has been filled, or the item installed elsewhere
+                _logger.warning("Not {0}: {1}".format(description, e))
+                skipped.append("{0}: {1}".format(description, e))
+                continue
+            slots[slot] = item_id
+            actions.append(description)
+
+        for component in diff.unexpected:
+            _logger.warning(
+                "{0} {1} in node {2} is not in the database".format(
+                    component.type, component.serial, diff.node
+                )
+            )
+
+    return actions, skipped
@@ -0,0 +1,356 @@
+"""Streaming export of the node database to Parquet or CSV
+
+Each table, and a denormalised view of every component with the node and
+slot it's currently in, is written to a file of its own.  Rows are read
+as tuples in batches and written out a batch at a time, so memory use
+doesn't grow with the size of the table.  The rows are read through a
+server-side cursor on MySQL, when the driver is pymysql (an unbuffered
+SSCursor), and on PostgreSQL, when the driver is psycopg2 (a named
+cursor).  Elsewhere `.tuples().iterator()` is used, which for SQLite
+also reads the rows as they are needed, but for other drivers may fetch
+the whole result first.  `stream_rows` gives other modules the same
+streaming for their own queries.
+
+Parquet output needs the optional `pyarrow` package (install
+`chimedb.node[parquet]`); CSV output has no extra requirements.
+
+Examples
+--------
+>>> import chimedb.core
+>>> from chimedb.node.export import export_all
+>>> chimedb.core.connect()
+>>> export_all("/data/nodedb-dump")
+>>> import pandas
+>>> items = pandas.read_parquet("/data/nodedb-dump/NodeItem.parquet")
+"""
+from .orm import NodeItem, NodeMAC, NodeAssembled, NodeRMA, NodeHistory
+from .slots import slot_query
+
+from collections import OrderedDict
+import csv
+import datetime
+import itertools
+import os
+import peewee as pw
+import uuid
+
+# Rows in each batch read from the database and written to the file
+EXPORT_BATCH_SIZE = 50000
+
+# The exported tables, in foreign key order
+EXPORT_MODELS = (NodeItem, NodeMAC, NodeAssembled, NodeRMA, NodeHistory)
+
+# The name of the denormalised component view
+COMPONENT_VIEW = "components"
+
+# File name extension for each format
+EXTENSIONS = {"parquet": ".parquet", "csv": ".csv"}
+
+
+def _pyarrow():
+    """Return the pyarrow and pyarrow.parquet modules, or None if missing."""
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        return None
+
+    return pyarrow, pyarrow.parquet
+
+
+def default_format():
+    """Return "parquet" if pyarrow is installed, otherwise "csv"."""
+    return "csv" if _pyarrow() is None else "parquet"
+
+
+def _model_query(model):
+    """Return the export query and columns for a table."""
+    fields = model._meta.sorted_fields
+    columns = [(field.column_name, field) for field in fields]
+    query = model.select(*fields).order_by(model._meta.primary_key)
+
+    return query, columns
+
+
+def _component_query():
+    """Return the export query and columns for the component view.
+
+    One row per NodeItem, with the id and serial of the node it's in and
+    the slot it occupies, which are null if it isn't installed.
+    """
+    slots = slot_query(lambda field: field.is_null(False)).alias("slots")
+    fields = [
+        field for field in NodeItem._meta.sorted_fields if field.name != "version"
+    ]
+    query = (
+        NodeItem.select(
+            *(fields + [NodeAssembled.id, NodeAssembled.serial, slots.c.slot])
+        )
+        .join(slots, pw.JOIN.LEFT_OUTER, on=(NodeItem.id == slots.c.item_id))
+        .join(
+            NodeAssembled, pw.JOIN.LEFT_OUTER, on=(NodeAssembled.id == slots.c.node_id)
+        )
+        .order_by(NodeItem.id)
+    )
+    columns = [(field.column_name, field) for field in fields] + [
+        ("node_id", NodeAssembled.id),
+        ("node_serial", NodeAssembled.serial),
+        ("slot", pw.CharField()),
+    ]
+
+    return query, columns
+
+
+def export_queries():
+    """Return the exports available.
+
+    Returns
+    -------
+    queries : OrderedDict
+        Maps export name (the table name, or `COMPONENT_VIEW`) to a
+        function returning (query, columns), where columns is a list of
+        (column name, peewee field) pairs.
+    """
+    queries = OrderedDict()
+    for model in EXPORT_MODELS:
+        queries[model.__name__] = lambda model=model: _model_query(model)
+    queries[COMPONENT_VIEW] = _component_query
+
+    return queries
+
+
+def _server_side_cursor(database):
+    """Return a server-side cursor, or None if the driver has none we know of.
+
+    For pymysql this is an unbuffered SSCursor, and for psycopg2 a named
+    cursor.  Outside a transaction (peewee runs psycopg2 in autocommit
+    mode) the named cursor is declared WITH HOLD, as peewee's own
+    `ServerSide` does; PostgreSQL then keeps the result on the server
+    rather than sending it all at once.
+    """
+    database = getattr(database, "obj", database)
+    if isinstance(database, pw.MySQLDatabase):
+        connection = database.connection()
+        if not type(connection).__module__.startswith("pymysql"):
+            return None
+
+        import pymysql.cursors
+
+        return connection.cursor(pymysql.cursors.SSCursor)
+
+    if isinstance(database, pw.PostgresqlDatabase):
+        connection = database.connection()
+        if not type(connection).__module__.startswith("psycopg2"):
+            return None
+
+        return connection.cursor(
+            name="chimedb_node_export_{0}".format(uuid.uuid4().hex),
+            withhold=not database.in_transaction(),
+        )
+
+    return None
+
+
+def stream_rows(query, columns=None):
+    """Stream the rows of a query as tuples.
+
+    The rows are read through a server-side cursor where the driver has
+    one (see the module documentation), so that they needn't all be held
+    in memory at once.
+
+    Parameters
+    ----------
+    query : peewee.SelectQuery
+        The query to run.
+    columns : list of (string, peewee.Field), optional
+        The name and field of each column of the query, used to convert
+        the values read through a server-side cursor.  If not given,
+        those values are returned as the driver gives them.
+
+    Yields
+    ------
+    row : tuple
+        Each row of the result.
+    """
+    cursor = _server_side_cursor(query.model._meta.database)
+    if cursor is None:
+        for row in query.tuples().iterator():
+            yield row
+        return
+
+    sql, params = query.sql()
+    try:
+        cursor.execute(sql, params)
+        if columns is None:
+            for row in cursor:
+                yield tuple(row)
+            return
+
+        converters = [field.python_value for _, field in columns]
+        for row in cursor:
+            yield tuple(
+                None if value is None else convert(value)
+                for convert, value in zip(converters, row)
+            )
+    finally:
+        cursor.close()
+
+
+def _batches(query, columns, batch_size):
+    """Stream the rows of `query` as lists of at most `batch_size` tuples."""
+    rows = stream_rows(query, columns)
+    while True:
+        batch = list(itertools.islice(rows, batch_size))
+        if not batch:
+            return
+        yield batch
+
+
+def _arrow_type(pa, field):
+    """Return the Arrow type for a peewee field."""
+    if isinstance(field, pw.ForeignKeyField):
+        field = field.rel_field
+    if isinstance(field, pw.BooleanField):
+        return pa.bool_()
+    if isinstance(field, pw.IntegerField):
+        return pa.int64()
+    if isinstance(field, pw.FloatField):
+        return pa.float64()
+    if isinstance(field, pw.DateTimeField):
+        return pa.timestamp("us")
+    if isinstance(field, pw.BlobField):
+        return pa.binary()
+    return pa.string()
+
+
+def _write_parquet(path, columns, batches):
+    pa, pq = _pyarrow()
+    schema = pa.schema(
+        [pa.field(name, _arrow_type(pa, field)) for name, field in columns]
+    )
+
+    count = 0
+    with pq.ParquetWriter(path, schema) as writer:
+        for batch in batches:
+            arrays = [
+                pa.array(values, type=column.type)
+                for values, column in zip(zip(*batch), schema)
+            ]
+            writer.write_batch(pa.RecordBatch.from_arrays(arrays, schema=schema))
+            count += len(batch)
+
+    return count
+
+
+def _csv_value(value):
+    if value is None:
+        return ""
+    if isinstance(value, bool):
+        return int(value)
+    if isinstance(value, datetime.datetime):
+        return value.isoformat(" ")
+    return value
+
+
+def _write_csv(path, columns, batches):
+    count = 0
+    with open(path, "w", newline="") as f:
+        writer = csv.writer(f)
+        writer.writerow([name for name, _ in columns])
+        for batch in batches:
+            writer.writerows([_csv_value(value) for value in row] for row in batch)
+            count += len(batch)
+
+    return count
+
+
+def export_table(name, path, fmt=None, batch_size=EXPORT_BATCH_SIZE):
+    """Export one table or view to a file.
+
+    Parameters
+    ----------
+    name : string
+        A key of `export_queries()`: a table name, or "components".
+    path : string
+        The file to write.
+    fmt : string, optional
+        "parquet" or "csv".  Defaults to `default_format()`.
+    batch_size : int, optional
+        The number of rows read and written at a time.
+
+    Returns
+    -------
+    count : int
+        The number of rows written.
+
+    Raises
+    ------
+    ImportError
+        If Parquet output is requested but pyarrow isn't installed.
+    """
+    if fmt is None:
+        fmt = default_format()
+    if fmt not in EXTENSIONS:
+        raise ValueError("Unknown export format: {0}".format(fmt))
+    if fmt == "parquet" and _pyarrow() is None:
+        raise ImportError("Parquet export needs pyarrow; use CSV or install it")
+
+    query, columns = export_queries()[name]()
+    batches = _batches(query, columns, batch_size)
+    if fmt == "parquet":
+        return _write_parquet(path, columns, batches)
+    return _write_csv(path, columns, batches)
+
+
+def _snapshot(database):
+    """Return a transaction in which every query sees the same snapshot.
+
+    On MySQL and PostgreSQL this is a REPEATABLE READ transaction.  A
+    SQLite transaction already reads a single snapshot.
+    """
+    real = getattr(database, "obj", database)
+    if isinstance(real, (pw.MySQLDatabase, pw.PostgresqlDatabase)):
+        return database.atomic(isolation_level="REPEATABLE READ")
+    return database.atomic()
+
+
+def export_all(directory, fmt=None, names=None, batch_size=EXPORT_BATCH_SIZE):
+    """Export tables and the component view to a directory.
+
+    Each is written to `<directory>/<name>.parquet` (or `.csv`).  All the
+    exports are read in one transaction, so that they are consistent with
+    each other even if the database is being written to: otherwise, for
+    example, NodeHistory could refer to NodeItems added after NodeItem
+    was written, and `chimedb.node.restore` would reject the dump.
+
+    Parameters
+    ----------
+    directory : string
+        The output directory, created if necessary.
+    fmt : string, optional
+        "parquet" or "csv".  Defaults to `default_format()`.
+    names : list of strings, optional
+        The exports to write.  By default, all of `export_queries()`.
+    batch_size : int, optional
+        The number of rows read and written at a time.
+
+    Returns
+    -------
+    counts : OrderedDict
+        Maps each export name to the number of rows written.
+    """
+    if fmt is None:
+        fmt = default_format()
+    if names is None:
+        names = list(export_queries())
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    counts = OrderedDict()
+    with _snapshot(NodeItem._meta.database):
+        for name in names:
+            path = os.path.join(directory, name + EXTENSIONS[fmt])
+            counts[name] = export_table(name, path, fmt, batch_size)
+
+    return counts
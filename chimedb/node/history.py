@@ -0,0 +1,518 @@
+"""Reconstruction of past node contents from NodeHistory
+
+The contents of the nodes at any time can be found by replaying the
+'ADD' and 'DEL' records of NodeHistory which affect a node.  Rather than
+always replaying from the start of the log, the replay starts from the
+nearest checkpoint: the empty database or a stored NodeSnapshot (both
+replaying forwards), or the current contents of NodeAssembled or a later
+NodeSnapshot (undoing records backwards).
+
+Snapshots are stored by `store_checkpoint` (run periodically with
+`chimedb-node checkpoint create`) and pruned by `thin_checkpoints`.
+
+History records are applied in id order, so this assumes the timestamps
+of the records increase with their ids, as they do when they are written
+by `chimedb.node.api`.
+"""
+from .orm import NodeItem, NodeAssembled, NodeHistory, NodeSnapshot, NODE_SLOTS
+from .instrument import instrumented
+from .slots import slot_query
+
+import peewee as pw
+import datetime
+import json
+import zlib
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# For history records without a slot, the slot name prefix for each
+# NodeItem type.  Items of other types are taken to be rack slots.
+TYPE_SLOTS = {
+    "MB": "motherboard",
+    "CPU": "cpu",
+    "GPU": "gpu",
+    "NIC": "nic",
+    "RAM": "ram",
+}
+
+# Default retention policy for stored checkpoints, used by
+# thin_checkpoints.  Each entry is (age, spacing): checkpoints younger
+# than `age` are kept at most one per `spacing` (None keeps them all).
+# Checkpoints older than the last age are kept at the last spacing.
+RETENTION = (
+    (datetime.timedelta(days=7), None),
+    (datetime.timedelta(days=90), datetime.timedelta(days=1)),
+    (datetime.timedelta(days=365), datetime.timedelta(weeks=1)),
+    (None, datetime.timedelta(days=30)),
+)
+
+# Cached result of _snapshots_enabled()
+_snapshots = None
+
+
+class Checkpoint(object):
+    """The contents of all nodes just after a given NodeHistory record.
+
+    Attributes
+    ----------
+    history_id : int
+        The id of the last NodeHistory record reflected in `nodes`, or 0
+        for the empty database.
+    nodes : dict
+        Maps the id of each NodeAssembled to a dict mapping slot name to
+        the id of the NodeItem in that slot.  Empty slots are omitted.
+    """
+
+    def __init__(self, history_id, nodes):
+        self.history_id = history_id
+        self.nodes = nodes
+
+    @classmethod
+    def empty(cls):
+        """The checkpoint before the first history record."""
+        return cls(0, dict())
+
+    @classmethod
+    def current(cls):
+        """The checkpoint of the current contents of NodeAssembled."""
+        with NodeAssembled._meta.database.atomic():
+            history_id = NodeHistory.select(pw.fn.MAX(NodeHistory.id)).scalar() or 0
+            nodes = dict()
+            query = slot_query(lambda field: field.is_null(False))
+            for node, slot, item in query.tuples().iterator():
+                nodes.setdefault(node, dict())[slot] = item
+
+        return cls(history_id, nodes)
+
+    def encode(self):
+        """Return the compressed encoding of `nodes` stored in NodeSnapshot."""
+        data = [[node, slots] for node, slots in sorted(self.nodes.items())]
+        return zlib.compress(json.dumps(data, separators=(",", ":")).encode())
+
+    @classmethod
+    def decode(cls, history_id, data):
+        """Create a checkpoint from the encoding made by `encode`."""
+        nodes = json.loads(zlib.decompress(bytes(data)).decode())
+        return cls(history_id, {node: slots for node, slots in nodes})
+
+    def copy(self):
+        """Return a copy of this checkpoint which can be modified independently."""
+        return Checkpoint(
+            self.history_id,
+            {node: dict(slots) for node, slots in self.nodes.items()},
+        )
+
+
+def _infer_slot(slots, item_type):
+    """Choose a slot for an item from a history record without a slot.
+
+    Returns the first empty slot matching the item's type.
+    """
+    prefix = TYPE_SLOTS.get(item_type, "rack_slot")
+    for name in NODE_SLOTS:
+        if name.startswith(prefix) and name not in slots:
+            return name
+
+    return None
+
+
+def _place(slots, slot, item, item_type):
+    """Put `item` into `slots`."""
+    if slot is None:
+        slot = _infer_slot(slots, item_type)
+    if slot is None:
+        _logger.warning("No free slot for item {0} in history replay".format(item))
+        return
+    slots[slot] = item
+
+
+def _remove(slots, slot, item):
+    """Remove `item` from `slots`."""
+    if slot is None or slots.get(slot) != item:
+        slot = next((name for name, value in slots.items() if value == item), None)
+    if slot is None:
+        _logger.warning("Item {0} not found in history replay".format(item))
+        return
+    del slots[slot]
+
+
+def _changes(after, until):
+    """Return the node-changing history records with `after` < id <= `until`.
+
+    The records are streamed from the database in id order as tuples
+    (id, operation, node_id, item_id, slot, item type).
+    """
+    return (
+        NodeHistory.select(
+            NodeHistory.id,
+            NodeHistory.operation,
+            NodeHistory.node,
+            NodeHistory.item,
+            NodeHistory.slot,
+            NodeItem.type,
+        )
+        .join(NodeItem, on=(NodeHistory.item == NodeItem.id))
+        .where(
+            (NodeHistory.id > after)
+            & (NodeHistory.id <= until)
+            & NodeHistory.node.is_null(False)
+            & NodeHistory.operation.in_(["ADD", "DEL"])
+        )
+    )
+
+
+def replay_forward(checkpoint, until):
+    """Apply the history records after a checkpoint, up to and including `until`.
+
+    Parameters
+    ----------
+    checkpoint : Checkpoint
+        The starting point.  This is modified in place.
+    until : int
+        The id of the last history record to apply.
+
+    Returns
+    -------
+    checkpoint : Checkpoint
+        The updated checkpoint.
+    """
+    query = _changes(checkpoint.history_id, until).order_by(NodeHistory.id)
+    for _, operation, node, item, slot, item_type in query.tuples().iterator():
+        slots = checkpoint.nodes.setdefault(node, dict())
+        if operation == "ADD":
+            _place(slots, slot, item, item_type)
+        else:
+            _remove(slots, slot, item)
+
+    checkpoint.history_id = max(checkpoint.history_id, until)
+    return checkpoint
+
+
+def replay_backward(checkpoint, until):
+    """Undo the history records after `until`, back from a checkpoint.
+
+    Parameters
+    ----------
+    checkpoint : Checkpoint
+        The starting point.  This is modified in place.
+    until : int
+        The id of the last history record to keep.
+
+    Returns
+    -------
+    checkpoint : Checkpoint
+        The updated checkpoint.
+    """
+    query = _changes(until, checkpoint.history_id).order_by(NodeHistory.id.desc())
+    for _, operation, node, item, slot, item_type in query.tuples().iterator():
+        slots = checkpoint.nodes.setdefault(node, dict())
+        if operation == "ADD":
+            _remove(slots, slot, item)
+        else:
+            _place(slots, slot, item, item_type)
+
+    checkpoint.history_id = min(checkpoint.history_id, until)
+    return checkpoint
+
+
+@instrumented
+def history_id_at(at):
+    """Return the id of the last NodeHistory record at or before `at`.
+
+    Returns 0 if there are no history records that early.
+    """
+    return (
+        NodeHistory.select(pw.fn.MAX(NodeHistory.id))
+        .where(NodeHistory.timestamp <= at)
+        .scalar()
+        or 0
+    )
+
+
+def _snapshots_enabled(refresh=False):
+    """Is the NodeSnapshot table present?
+
+    As for `chimedb.node.slots.slot_index_enabled`, only a positive result
+    is cached, so that checkpoints stored by another process are used as
+    soon as the table has been created.
+    """
+    global _snapshots
+
+    if not _snapshots or refresh:
+        _snapshots = NodeSnapshot.table_exists()
+
+    return _snapshots
+
+
+def stored_checkpoints(history_id):
+    """Load the stored checkpoints either side of `history_id`.
+
+    Returns
+    -------
+    checkpoints : list of Checkpoint
+        The latest stored checkpoint at or before `history_id` and the
+        earliest one after it, if they exist.
+    """
+    if not _snapshots_enabled():
+        return []
+
+    before = (
+        NodeSnapshot.select(NodeSnapshot.history_id, NodeSnapshot.data)
+        .where(NodeSnapshot.history_id <= history_id)
+        .order_by(NodeSnapshot.history_id.desc())
+        .limit(1)
+    )
+    after = (
+        NodeSnapshot.select(NodeSnapshot.history_id, NodeSnapshot.data)
+        .where(NodeSnapshot.history_id > history_id)
+        .order_by(NodeSnapshot.history_id)
+        .limit(1)
+    )
+
+    return [
+        Checkpoint.decode(*row) for query in (before, after) for row in query.tuples()
+    ]
+
+
+def store_checkpoint():
+    """Store a checkpoint of the current contents of NodeAssembled.
+
+    The NodeSnapshot table is created if it doesn't exist.  Nothing is
+    stored if there is already a checkpoint for the latest history record.
+
+    Returns
+    -------
+    history_id : int or None
+        The history id of the new checkpoint, or None if none was stored.
+    """
+    NodeSnapshot.create_table(safe=True)
+    _snapshots_enabled(refresh=True)
+
+    checkpoint = Checkpoint.current()
+    if (
+        NodeSnapshot.select()
+        .where(NodeSnapshot.history_id == checkpoint.history_id)
+        .exists()
+    ):
+        return None
+
+    NodeSnapshot.create(history_id=checkpoint.history_id, data=checkpoint.encode())
+    _logger.info("Stored checkpoint at history id {0}".format(checkpoint.history_id))
+
+    return checkpoint.history_id
+
+
+def thin_checkpoints(policy=RETENTION, now=None, dry_run=False):
+    """Delete stored checkpoints according to a retention policy.
+
+    Checkpoints are grouped into buckets of width `spacing` for their age
+    (see `RETENTION`) and all but the oldest in each bucket are deleted.
+    Keeping the oldest means repeated thinning is stable.
+
+    Parameters
+    ----------
+    policy : list of (timedelta, timedelta) pairs, optional
+        The retention policy.  The format is that of `RETENTION`.
+    now : datetime, optional
+        The time to compute ages from.  By default, now.
+    dry_run : bool, optional
+        If True, don't delete anything.
+
+    Returns
+    -------
+    deleted : list of int
+        The history ids of the deleted (or, if `dry_run`, deletable)
+        checkpoints.
+    """
+    if not _snapshots_enabled():
+        return []
+    if now is None:
+        now = datetime.datetime.now()
+
+    epoch = datetime.datetime(2000, 1, 1)
+    kept = set()
+    deleted = list()
+
+    query = NodeSnapshot.select(
+        NodeSnapshot.id, NodeSnapshot.history_id, NodeSnapshot.timestamp
+    ).order_by(NodeSnapshot.timestamp)
+    for id_, history_id, timestamp in query.tuples():
+        age = now - timestamp
+        spacing = next(
+            (spacing for limit, spacing in policy if limit is None or age < limit),
+            policy[-1][1],
+        )
+        if spacing is None:
+            continue
+
+        bucket = (spacing, (timestamp - epoch) // spacing)
+        if bucket in kept:
+            deleted.append((id_, history_id))
+        else:
+            kept.add(bucket)
+
+    if deleted and not dry_run:
+        with NodeSnapshot._meta.database.atomic():
+            for chunk in pw.chunked([id_ for id_, _ in deleted], 500):
+                NodeSnapshot.delete().where(NodeSnapshot.id.in_(chunk)).execute()
+
+    return [history_id for _, history_id in deleted]
+
+
+@instrumented
+def checkpoint_at(history_id, checkpoints=None):
+    """Reconstruct the node contents just after the given history record.
+
+    Starts from whichever of the empty database, the current contents of
+    NodeAssembled and `checkpoints` is nearest to `history_id`, measured
+    by the number of history ids between them.
+
+    Parameters
+    ----------
+    history_id : int
+        The id of the last history record to include.
+    checkpoints : list of Checkpoint, optional
+        Additional starting points.  These are not modified.  By default,
+        the nearest stored checkpoints are used.
+
+    Returns
+    -------
+    checkpoint : Checkpoint
+    """
+    if checkpoints is None:
+        checkpoints = stored_checkpoints(history_id)
+
+    # The current contents are only loaded if they are the best start
+    latest = NodeHistory.select(pw.fn.MAX(NodeHistory.id)).scalar() or 0
+    candidates = [Checkpoint.empty(), Checkpoint(latest, None)] + list(checkpoints)
+    start = min(
+        candidates, key=lambda checkpoint: abs(checkpoint.history_id - history_id)
+    )
+    _logger.debug(
+        "Replaying history from checkpoint {0} to {1}".format(
+            start.history_id, history_id
+        )
+    )
+
+    if start.nodes is None:
+        start = Checkpoint.current()
+    else:
+        start = start.copy()
+
+    if start.history_id <= history_id:
+        return replay_forward(start, history_id)
+    return replay_backward(start, history_id)
+
+
+@instrumented
+def snapshot(at=None):
+    """Return the contents of all nodes at a given time.
+
+    Parameters
+    ----------
+    at : datetime, optional
+        The time of the snapshot.  By default, now.
+
+    Returns
+    -------
+    nodes : dict
+        Maps the id of each NodeAssembled to a dict mapping slot name to
+        the id of the NodeItem in that slot.  Empty slots and nodes are
+        omitted.
+    """
+    if at is None:
+        at = datetime.datetime.now()
+
+    nodes = checkpoint_at(history_id_at(at)).nodes
+    return {node: slots for node, slots in nodes.items() if slots}
+
+
+@instrumented
+def history_for(item=None, node=None, after=None, limit=50, newest_first=True):
+    """Return one page of history records, using keyset pagination.
+
+    The page is selected with a WHERE on (timestamp, id) rather than an
+    OFFSET, so with the (item, timestamp) and (node, timestamp) indexes
+    every page costs the same, however deep.
+
+    Parameters
+    ----------
+    item : NodeItem or integer, optional
+        Only return records for this component (or component id).
+    node : NodeAssembled or integer, optional
+        Only return records for this node (or node id).
+    after : tuple, optional
+        The cursor returned with the previous page.  If not given, the
+        first page is returned.
+    limit : int, optional
+        The maximum number of records on the page.
+    newest_first : bool, optional
+        If True (the default) return the most recent records first.
+
+    Returns
+    -------
+    records : list of NodeHistory
+        The records on this page.
+    cursor : tuple or None
+        The (timestamp, id) cursor to pass as `after` to get the next
+        page, or None if this is the last page.
+    """
+    query = NodeHistory.select()
+    if item is not None:
+        query = query.where(NodeHistory.item == getattr(item, "id", item))
+    if node is not None:
+        query = query.where(NodeHistory.node == getattr(node, "id", node))
+
+    if after is not None:
+        timestamp, id_ = after
+        if newest_first:
+            query = query.where(
+                (NodeHistory.timestamp < timestamp)
+                | ((NodeHistory.timestamp == timestamp) & (NodeHistory.id < id_))
+            )
+        else:
+            query = query.where(
+                (NodeHistory.timestamp > timestamp)
+                | ((NodeHistory.timestamp == timestamp) & (NodeHistory.id > id_))
+            )
+
+    if newest_first:
+        query = query.order_by(NodeHistory.timestamp.desc(), NodeHistory.id.desc())
+    else:
+        query = query.order_by(NodeHistory.timestamp, NodeHistory.id)
+
+    # Fetch one extra record to find out if there's another page
+    records = list(query.limit(limit + 1))
+    if len(records) <= limit:
+        return records, None
+
+    records = records[:limit]
+    return records, (records[-1].timestamp, records[-1].id)
+
+
+def iter_history(item=None, node=None, page_size=500, newest_first=True):
+    """Iterate over all the history records for a component or node.
+
+    The records are fetched a page at a time with `history_for`.
+
+    Parameters
+    ----------
+    item, node, newest_first
+        As for `history_for`.
+    page_size : int, optional
+        The number of records fetched per query.
+
+    Yields
+    ------
+    record : NodeHistory
+    """
+    cursor = None
+    while True:
+        records, cursor = history_for(item, node, cursor, page_size, newest_first)
+        for record in records:
+            yield record
+        if cursor is None:
+            return
@@ -0,0 +1,489 @@
+"""Query instrumentation for node database operations
+
+Counts the SQL queries each operation makes, the time spent executing
+them and the number of rows fetched, and passes the totals to one or more
+sinks when the operation ends.  The functions of `chimedb.node.api`, and
+the lookups in `chimedb.node.lookup`, `chimedb.node.history` and
+`chimedb.node.mac`, are already marked as operations; other code can be
+measured with the `instrumented` decorator or the `operation` context
+manager.  Functions which return a query for the caller to run, like
+`chimedb.node.mac.macs_in_range`, aren't operations themselves: their
+queries count towards whatever operation is in progress when they run.
+
+`PrometheusSink` needs the optional `prometheus_client` package (install
+`chimedb.node[prometheus]`).
+
+Nothing is measured until a sink is added.  Then the `execute_sql`
+method of the database is wrapped to count queries while an operation is
+in progress; when the last sink is removed the wrapper is removed again,
+so with no sinks the only overhead is one check per API call.
+
+Operations may nest: a query counts towards every operation in progress
+in its thread, and each operation is passed to the sinks when it ends.
+The SQL time is the time spent in `execute_sql`; a driver which fetches
+rows lazily (like sqlite3) does some of its work while the rows are read,
+which isn't included.
+
+Examples
+--------
+>>> import logging
+>>> from chimedb.node import api, instrument
+>>> logging.basicConfig(level=logging.DEBUG)
+>>> instrument.add_sink(instrument.LoggingSink(min_queries=10))
+>>> with instrument.collect() as sink:
+...     api.create_components(rows)
+>>> sink.totals()["api.create_components"].queries
+12
+"""
+from .orm import NodeItem
+
+from contextlib import contextmanager
+import functools
+import threading
+import time
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# The active sinks.  Replaced, not modified, so that it can be read
+# without the lock.
+_sinks = ()
+_lock = threading.Lock()
+
+# The databases whose execute_sql is wrapped, and whether the callback
+# re-wrapping a newly-connected database has been attached to the proxy
+_hooked = set()
+_callback_attached = False
+
+# The operations in progress in each thread, innermost last
+_local = threading.local()
+
+
+class OperationStats(object):
+    """The queries made by one run of an operation.
+
+    Attributes
+    ----------
+    name : string
+        The name of the operation.
+    queries : int
+        The number of SQL statements executed.
+    sql_time : float
+        The total time spent executing them, in seconds.
+    rows : int
+        The number of rows fetched from the results.
+    elapsed : float
+        The total time the operation took, in seconds.  Not set until the
+        operation ends.
+    error : bool
+        True if the operation raised an exception.
+    """
+
+    __slots__ = ("name", "queries", "sql_time", "rows", "elapsed", "error")
+
+    def __init__(self, name):
+        self.name = name
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.elapsed = None
+        self.error = False
+
+    def __repr__(self):
+        return "<OperationStats {0}: {1} queries, {2:.4f} s SQL, {3} rows>".format(
+            self.name, self.queries, self.sql_time, self.rows
+        )
+
+
+class LoggingSink(object):
+    """Log each operation to the "chimedb" logger.
+
+    Parameters
+    ----------
+    level : int, optional
+        The logging level.
+    min_queries : int, optional
+        Only log operations making at least this many queries.
+    """
+
+    def __init__(self, level=logging.DEBUG, min_queries=0):
+        self.level = level
+        self.min_queries = min_queries
+
+    def record(self, stats):
+        if stats.queries < self.min_queries:
+            return
+        _logger.log(
+            self.level,
+            "{0}: {1} queries, {2:.4f} s in SQL, {3} rows fetched, "
+            "{4:.4f} s total{5}".format(
+                stats.name,
+                stats.queries,
+                stats.sql_time,
+                stats.rows,
+                stats.elapsed,
+                " (failed)" if stats.error else "",
+            ),
+        )
+
+
+class MemorySink(object):
+    """Keep totals for each operation in memory.
+
+    Parameters
+    ----------
+    keep : int, optional
+        If non-zero, also keep the OperationStats of the last `keep`
+        operations in `records`.
+
+    Attributes
+    ----------
+    records : list of OperationStats
+        The most recent operations, oldest first.
+    """
+
+    def __init__(self, keep=0):
+        self.keep = keep
+        self.records = list()
+        self._totals = dict()
+        self._lock = threading.Lock()
+
+    def record(self, stats):
+        with self._lock:
+            total = self._totals.get(stats.name)
+            if total is None:
+                total = self._totals[stats.name] = OperationTotals(stats.name)
+            total.calls += 1
+            total.queries += stats.queries
+            total.sql_time += stats.sql_time
+            total.rows += stats.rows
+            total.elapsed += stats.elapsed
+            total.errors += stats.error
+
+            if self.keep:
+                self.records.append(stats)
+                del self.records[: -self.keep]
+
+    def totals(self):
+        """Return a dict of OperationTotals, keyed by operation name."""
+        with self._lock:
+            return dict((name, total.copy()) for name, total in self._totals.items())
+
+    def clear(self):
+        """Forget everything recorded so far."""
+        with self._lock:
+            self._totals.clear()
+            del self.records[:]
+
+
+class OperationTotals(object):
+    """The totals of all runs of an operation recorded by a MemorySink.
+
+    Attributes
+    ----------
+    name : string
+        The name of the operation.
+    calls : int
+        The number of runs.
+    queries, sql_time, rows, elapsed
+        The sums over all runs; see `OperationStats`.
+    errors : int
+        The number of runs which raised an exception.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.calls = 0
+        self.queries = 0
+        self.sql_time = 0.0
+        self.rows = 0
+        self.elapsed = 0.0
+        self.errors = 0
+
+    def copy(self):
+        total = OperationTotals(self.name)
+        total.__dict__.update(self.__dict__)
+        return total
+
+    def __repr__(self):
+        return "<OperationTotals {0}: {1} calls, {2} queries>".format(
+            self.name, self.calls, self.queries
+        )
+
+
+class PrometheusSink(object):
+    """Count operations, queries, SQL time and rows with Prometheus counters.
+
+    Needs the optional `prometheus_client` package.  The counters are
+    labelled by operation:
+
+    - `<prefix>_operations_total`
+    - `<prefix>_operation_errors_total`
+    - `<prefix>_queries_total`
+    - `<prefix>_sql_seconds_total`
+    - `<prefix>_rows_fetched_total`
+
+    Parameters
+    ----------
+    prefix : string, optional
+        The prefix of the metric names.
+    registry : prometheus_client.CollectorRegistry, optional
+        The registry to add the counters to.  Defaults to the global one.
+    """
+
+    def __init__(self, prefix="chimedb_node", registry=None):
+        try:
+            from prometheus_client import Counter, REGISTRY
+        except ImportError:
+            raise ImportError("PrometheusSink needs the prometheus_client package")
+
+        if registry is None:
+            registry = REGISTRY
+
+        def counter(name, description):
+            return Counter(
+                "{0}_{1}".format(prefix, name),
+                description,
+                ["operation"],
+                registry=registry,
+            )
+
+        # prometheus_client adds the _total suffix to counters
+        self.operations = counter("operations", "Node database operations run")
+        self.errors = counter(
+            "operation_errors", "Node database operations which failed"
+        )
+        self.queries = counter("queries", "SQL statements executed by operations")
+        self.sql_seconds = counter(
+            "sql_seconds", "Time spent executing SQL statements in operations"
+        )
+        self.rows = counter("rows_fetched", "Rows fetched by operations")
+
+    def record(self, stats):
+        self.operations.labels(stats.name).inc()
+        if stats.error:
+            self.errors.labels(stats.name).inc()
+        self.queries.labels(stats.name).inc(stats.queries)
+        self.sql_seconds.labels(stats.name).inc(stats.sql_time)
+        self.rows.labels(stats.name).inc(stats.rows)
+
+
+class _CountingCursor(object):
+    """Wrap a DB-API cursor to count the rows fetched from it."""
+
+    __slots__ = ("_cursor", "_stack")
+
+    def __init__(self, cursor, stack):
+        self._cursor = cursor
+        self._stack = stack
+
+    def _count(self, rows):
+        for stats in self._stack:
+            stats.rows += rows
+
+    def fetchone(self):
+        row = self._cursor.fetchone()
+        if row is not None:
+            self._count(1)
+        return row
+
+    def fetchmany(self, *args, **kwargs):
+        rows = self._cursor.fetchmany(*args, **kwargs)
+        self._count(len(rows))
+        return rows
+
+    def fetchall(self):
+        rows = self._cursor.fetchall()
+        self._count(len(rows))
+        return rows
+
+    def __iter__(self):
+        for row in self._cursor:
+            self._count(1)
+            yield row
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+def _stack():
+    """Return the list of operations in progress in this thread."""
+    try:
+        return _local.stack
+    except AttributeError:
+        _local.stack = list()
+        return _local.stack
+
+
+def _hook(db):
+    """Wrap the execute_sql method of a database to count queries."""
+    if db is None or db in _hooked:
+        return
+    original = db.execute_sql
+
+    def execute_sql(sql, params=None, *args, **kwargs):
+        stack = getattr(_local, "stack", None)
+        if not stack:
+            return original(sql, params, *args, **kwargs)
+
+        stack = list(stack)
+        start = time.perf_counter()
+        try:
+            cursor = original(sql, params, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - start
+            for stats in stack:
+                stats.queries += 1
+                stats.sql_time += elapsed
+
+        return _CountingCursor(cursor, stack)
+
+    db.execute_sql = execute_sql
+    _hooked.add(db)
+
+
+def _unhook(db):
+    """Remove the wrapper added by `_hook`."""
+    if db in _hooked:
+        # Uncovers the execute_sql method of the class
+        del db.execute_sql
+        _hooked.discard(db)
+
+
+def _on_connect(db):
+    """Called by the database proxy when it's initialised."""
+    with _lock:
+        if _sinks:
+            _hook(db)
+
+
+def add_sink(sink):
+    """Start passing the stats of each operation to `sink`.
+
+    Adding the first sink enables the instrumentation.
+
+    Parameters
+    ----------
+    sink : object
+        Any object with a `record(stats)` method, which is called with an
+        `OperationStats` at the end of each operation.  It may be called
+        from several threads.
+    """
+    global _sinks, _callback_attached
+
+    with _lock:
+        _sinks = _sinks + (sink,)
+
+        db = NodeItem._meta.database
+        if hasattr(db, "attach_callback"):
+            if not _callback_attached:
+                # Wrap the new database if chimedb.core reconnects
+                db.attach_callback(_on_connect)
+                _callback_attached = True
+            db = db.obj
+        _hook(db)
+
+
+def remove_sink(sink):
+    """Stop passing operations to `sink`.
+
+    Removing the last sink disables the instrumentation.
+    """
+    global _sinks
+
+    with _lock:
+        _sinks = tuple(other for other in _sinks if other is not sink)
+        if not _sinks:
+            for db in list(_hooked):
+                _unhook(db)
+
+
+def enabled():
+    """Return True if any sinks have been added."""
+    return bool(_sinks)
+
+
+@contextmanager
+def collect(keep=0):
+    """Context manager recording operations in a MemorySink while it's open.
+
+    Parameters
+    ----------
+    keep : int, optional
+        Passed to `MemorySink`.
+
+    Yields
+    ------
+    sink : MemorySink
+    """
+    sink = MemorySink(keep)
+    add_sink(sink)
+    try:
+        yield sink
+    finally:
+        remove_sink(sink)
+
+
+class operation(object):
+    """Context manager measuring the queries made in its block.
+
+    The OperationStats is passed to the sinks on exit.  If no sinks have
+    been added nothing is measured, and the context manager returns None.
+
+    Parameters
+    ----------
+    name : string
+        The name of the operation.
+    """
+
+    __slots__ = ("name", "_stats", "_start")
+
+    def __init__(self, name):
+        self.name = name
+        self._stats = None
+
+    def __enter__(self):
+        if not _sinks:
+            return None
+        self._stats = OperationStats(self.name)
+        _stack().append(self._stats)
+        self._start = time.perf_counter()
+        return self._stats
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        stats = self._stats
+        if stats is None:
+            return False
+        self._stats = None
+        stats.elapsed = time.perf_counter() - self._start
+        stats.error = exc_type is not None
+        _stack().remove(stats)
+
+        for sink in _sinks:
+            try:
+                sink.record(stats)
+            except Exception:
+                _logger.exception("Instrumentation sink {0!r} failed".format(sink))
+
+        return False
+
+
+def instrumented(func):
+    """Decorator making each call of `func` an operation.
+
+    The operation is named after the module and function, e.g.
+    "lookup.find_item".  Not for generator functions, whose queries
+    are made after the call returns.
+    """
+    name = "{0}.{1}".format(func.__module__.rpartition(".")[2], func.__name__)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _sinks:
+            return func(*args, **kwargs)
+        with operation(name):
+            return func(*args, **kwargs)
+
+    return wrapper
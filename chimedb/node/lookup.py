@@ -0,0 +1,335 @@
+"""Read-only lookups in the node hardware tracking database
+"""
+from .orm import NodeItem, NodeAssembled, NodeSlot, NODE_SLOTS
+from .instrument import instrumented
+from .slots import slot_index_enabled, slot_query
+
+import peewee as pw
+import sqlite3
+
+# Largest number of items resolved per query by the bulk lookups.  The
+# lookups which search every slot may use fewer; see `_chunk_size`.
+LOOKUP_CHUNK_SIZE = 500
+
+# Bound parameters in one statement: the limit of MySQL and PostgreSQL
+MAX_PARAMETERS = 65535
+
+
+def _parameter_limit(database):
+    """Return the number of bound parameters allowed in one statement."""
+    database = getattr(database, "obj", database)
+    if not isinstance(database, pw.SqliteDatabase):
+        return MAX_PARAMETERS
+
+    connection = database.connection()
+    if hasattr(connection, "getlimit"):
+        # Python 3.11+: the limit actually set on this connection
+        return connection.getlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER)
+    return 32766 if sqlite3.sqlite_version_info >= (3, 32, 0) else 999
+
+
+def _chunk_size():
+    """Return the number of items to resolve per query over all the slots.
+
+    Each item is a bound parameter in every part of the `slot_query`
+    union: once with the NodeSlot index, but once per slot without it,
+    where 500 items would need 7500 parameters, more than older SQLite
+    allows.  Each part also has a couple of parameters of its own.
+    """
+    parts = 1 if slot_index_enabled() else len(NODE_SLOTS)
+    limit = _parameter_limit(NodeAssembled._meta.database)
+    return max(min(LOOKUP_CHUNK_SIZE, limit // parts - 2), 1)
+
+
+def _get_id(item):
+    """Return the id of `item`, which may be a model instance or an id."""
+    return getattr(item, "id", item)
+
+
+def _node_query(condition):
+    """Return the NodeAssembled query for the slots matching `condition`.
+
+    Each returned node has two extra attributes: `slot`, the name of the
+    matching slot, and `item_id`, the id of the item in that slot.  The
+    slot subquery is also returned, for use in further joins.
+    """
+    slots = slot_query(condition).alias("slots")
+    query = (
+        NodeAssembled.select(NodeAssembled, slots.c.slot, slots.c.item_id)
+        .join(slots, on=(NodeAssembled.id == slots.c.node_id))
+        .objects()
+    )
+    return query, slots
+
+
+@instrumented
+def find_item(serial, item_type=None):
+    """Return the component with the given serial number, or None.
+
+    Parameters
+    ----------
+    serial : string
+        The serial number.
+    item_type : string, optional
+        The NodeItem type.  Should be given if the serial might be shared
+        by components of different types.
+
+    Raises
+    ------
+    ValueError
+        `item_type` is None and the serial matches components of more
+        than one type.
+    """
+    query = NodeItem.select().where(NodeItem.serial == serial)
+    if item_type is not None:
+        query = query.where(NodeItem.type == item_type)
+
+    items = list(query.limit(2))
+    if len(items) > 1:
+        raise ValueError("serial {0} is not unique".format(serial))
+    return items[0] if items else None
+
+
+@instrumented
+def find_nodes(items):
+    """Find the nodes holding a collection of components.
+
+    All the slots are searched with one query per chunk of items (at most
+    `LOOKUP_CHUNK_SIZE`), using the NodeSlot index if it is in use, or else a UNION ALL
+    over the slot columns of NodeAssembled.
+
+    Parameters
+    ----------
+    items : iterable
+        The components to look for, either as NodeItems or NodeItem ids.
+
+    Returns
+    -------
+    nodes : dict
+        Maps the id of each installed component to a tuple
+        (node, slot) giving the NodeAssembled holding it and the name of
+        the slot it is in.  Components not installed in a node are
+        omitted.
+    """
+    ids = list(set(_get_id(item) for item in items))
+
+    nodes = dict()
+    for chunk in pw.chunked(ids, _chunk_size()):
+        query, _ = _node_query(lambda field: field.in_(chunk))
+        for node in query:
+            nodes[node.item_id] = (node, node.slot)
+
+    return nodes
+
+
+@instrumented
+def find_node(item):
+    """Find the node holding a component.
+
+    Parameters
+    ----------
+    item : NodeItem or integer
+        The component to look for, or its id.
+
+    Returns
+    -------
+    node : NodeAssembled or None
+        The node holding the component, or None if it isn't installed.
+    slot : string or None
+        The name of the slot the component is in, or None if it isn't
+        installed.
+    """
+    return find_nodes([item]).get(_get_id(item), (None, None))
+
+
+@instrumented
+def find_nodes_by_serial(serials, item_type=None):
+    """Find the nodes holding the components with the given serial numbers.
+
+    The serials are resolved to NodeItems within the same query that
+    searches the slots.
+
+    Parameters
+    ----------
+    serials : iterable of strings
+        The serial numbers of the components to look for.
+    item_type : string, optional
+        If given, only consider components of this NodeItem type.
+
+    Returns
+    -------
+    nodes : dict
+        Maps a tuple (type, serial) for each installed component to a
+        tuple (node, slot) giving the NodeAssembled holding it and the
+        name of the slot it is in.  Components not installed in a node
+        are omitted.
+    """
+    serials = list(set(serials))
+
+    nodes = dict()
+    for chunk in pw.chunked(serials, _chunk_size()):
+        items = NodeItem.select(NodeItem.id).where(NodeItem.serial.in_(chunk))
+        if item_type is not None:
+            items = items.where(NodeItem.type == item_type)
+
+        query, slots = _node_query(lambda field: field.in_(items))
+        query = (
+            query.select_extend(
+                NodeItem.type.alias("item_type"), NodeItem.serial.alias("item_serial")
+            )
+            .switch(NodeAssembled)
+            .join(NodeItem, on=(NodeItem.id == slots.c.item_id))
+        )
+        for node in query:
+            nodes[(node.item_type, node.item_serial)] = (node, node.slot)
+
+    return nodes
+
+
+@instrumented
+def node_slots(node, prefix=None):
+    """List the contents of the slots of a node.
+
+    Parameters
+    ----------
+    node : NodeAssembled or integer
+        The node, or its id.  The node's row (or its NodeSlot rows, if
+        that index is in use) is read directly.
+    prefix : string, optional
+        If given, only list slots whose name starts with this (e.g. "ram").
+
+    Returns
+    -------
+    slots : dict
+        Maps slot name to the id of the NodeItem in it, or None for an
+        empty slot.
+    """
+    node = _get_id(node)
+    names = [name for name in NODE_SLOTS if prefix is None or name.startswith(prefix)]
+
+    if slot_index_enabled():
+        query = NodeSlot.select(NodeSlot.slot_name, NodeSlot.item).where(
+            (NodeSlot.node == node) & NodeSlot.slot_name.in_(names)
+        )
+        return dict(query.tuples())
+
+    fields = NodeAssembled.slot_fields()
+    row = (
+        NodeAssembled.select(*[fields[name] for name in names])
+        .where(NodeAssembled.id == node)
+        .tuples()
+        .first()
+    )
+    if row is None:
+        return dict()
+    return dict(zip(names, row))
+
+
+@instrumented
+def empty_slots(prefix=None):
+    """List the empty slots across all nodes.
+
+    Parameters
+    ----------
+    prefix : string, optional
+        If given, only list slots whose name starts with this (e.g. "ram").
+
+    Returns
+    -------
+    slots : list
+        A list of (node_id, slot name) tuples.
+    """
+    names = [name for name in NODE_SLOTS if prefix is None or name.startswith(prefix)]
+
+    query = slot_query(lambda field: field.is_null(), names)
+    return [(node_id, slot) for node_id, slot, _ in query.tuples()]
+
+
+@instrumented
+def node_contents(nodes=None, dicts=False):
+    """Fetch assembled nodes with all their components.
+
+    Touching `node.gpu0.serial` on a NodeAssembled normally runs a query
+    for each foreign key.  This function instead fetches the nodes with
+    one query and all of their components with a second (per chunk of
+    nodes, if `nodes` is given), and attaches the components to the
+    nodes, so that no further queries are needed.
+
+    Parameters
+    ----------
+    nodes : iterable, optional
+        The nodes to fetch, as NodeAssembled instances or ids.  By
+        default, all nodes.
+    dicts : bool, optional
+        If True, return plain dicts instead of model instances, which is
+        faster when the results are only read.
+
+    Returns
+    -------
+    nodes : list
+        The nodes, ordered by serial.  If `dicts` is False, these are
+        NodeAssembled instances whose slot attributes are already-loaded
+        NodeItems.  If `dicts` is True, each is a dict of the NodeAssembled
+        fields in which each slot is a dict of the NodeItem fields (or
+        None, for an empty slot).
+    """
+    slots = slot_query(lambda field: field.is_null(False)).alias("slots")
+    node_query = NodeAssembled.select()
+    item_query = NodeItem.select(NodeItem, slots.c.node_id, slots.c.slot).join(
+        slots, on=(NodeItem.id == slots.c.item_id)
+    )
+
+    if nodes is None:
+        chunks = [(node_query, item_query)]
+    else:
+        # The node ids are bound parameters in both queries, so they're
+        # sent in chunks, like the items of the other bulk lookups
+        ids = list(set(_get_id(node) for node in nodes))
+        chunks = [
+            (
+                node_query.where(NodeAssembled.id.in_(chunk)),
+                item_query.where(slots.c.node_id.in_(chunk)),
+            )
+            for chunk in pw.chunked(ids, _chunk_size())
+        ]
+
+    result = list()
+    for node_query, item_query in chunks:
+        if dicts:
+            found = list(node_query.dicts())
+            by_id = {node["id"]: node for node in found}
+            for node in found:
+                for name in NODE_SLOTS:
+                    node[name] = None
+            for item in item_query.dicts():
+                node = by_id.get(item.pop("node_id"))
+                if node is not None:
+                    node[item.pop("slot")] = item
+        else:
+            found = list(node_query)
+            by_id = {node.id: node for node in found}
+            for item in item_query.objects():
+                node = by_id.get(item.node_id)
+                if node is not None:
+                    # Fill the foreign key cache directly, so the node isn't
+                    # marked as modified
+                    node.__rel__[item.slot] = item
+        result += found
+
+    if dicts:
+        result.sort(key=lambda node: (node["serial"], node["id"]))
+    else:
+        result.sort(key=lambda node: (node.serial, node.id))
+
+    return result
+
+    result = list(node_query)
+    by_id = {node.id: node for node in result}
+    for item in item_query.objects():
+        node = by_id.get(item.node_id)
+        if node is not None:
+            # Fill the foreign key cache directly, so the node isn't
+            # marked as modified
+            node.__rel__[item.slot] = item
+
+    return result
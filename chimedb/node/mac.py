@@ -0,0 +1,421 @@
+"""MAC address parsing, formatting and queries
+
+MAC addresses are stored in NodeMAC as 48-bit integers, which is also
+the primary key.  All the MACs in a vendor block (OUI) therefore form a
+contiguous range of keys, which can be found with a single range scan.
+"""
+from .orm import NodeItem, NodeMAC, NodeAssembled, NodeHistory
+from .instrument import instrumented
+from .lookup import LOOKUP_CHUNK_SIZE
+from .slots import slot_query
+
+from collections import namedtuple
+import peewee as pw
+import re
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# Largest valid MAC address
+MAC_MAX = (1 << 48) - 1
+
+# Separators allowed between the digit groups of a textual MAC address
+_MAC_SEPARATORS = re.compile(r"[:.\-\s]")
+
+# The digits of a MAC address or OUI, once the separators are removed.
+# Checked explicitly, since int() also accepts signs and underscores.
+_MAC_DIGITS = re.compile(r"[0-9a-fA-F]{12}")
+_OUI_DIGITS = re.compile(r"[0-9a-fA-F]{6}")
+
+
+def parse_mac(mac):
+    """Convert a MAC address to an integer.
+
+    Accepts integers and the usual textual forms:
+    "00:1b:21:3a:4f:5c", "00-1B-21-3A-4F-5C", "001b.213a.4f5c" and
+    "001b213a4f5c".  Single-digit groups in colon notation, as printed
+    by some tools (e.g. "0:1b:21:3a:4f:5c"), are also accepted.
+
+    Parameters
+    ----------
+    mac : string or integer
+        The MAC address.
+
+    Returns
+    -------
+    value : int
+        The MAC address as an integer.
+
+    Raises
+    ------
+    ValueError
+        `mac` is not a valid MAC address.
+    """
+    if isinstance(mac, bool):
+        raise ValueError("invalid MAC address: {0!r}".format(mac))
+    if isinstance(mac, int):
+        value = mac
+    else:
+        text = str(mac).strip()
+        groups = _MAC_SEPARATORS.split(text)
+        if not all(groups):
+            raise ValueError("invalid MAC address: {0!r}".format(mac))
+        if len(groups) == 6:
+            # Pad single-digit groups
+            groups = [group.rjust(2, "0") for group in groups]
+        digits = "".join(groups)
+        if not _MAC_DIGITS.fullmatch(digits):
+            raise ValueError("invalid MAC address: {0!r}".format(mac))
+        value = int(digits, 16)
+
+    if not 0 <= value <= MAC_MAX:
+        raise ValueError("MAC address out of range: {0!r}".format(mac))
+
+    return value
+
+
+def format_mac(value, sep=":", upper=False):
+    """Convert an integer MAC address to text.
+
+    Parameters
+    ----------
+    value : int
+        The MAC address.
+    sep : string, optional
+        The separator to put between the octets.  If "." the Cisco-style
+        form with groups of four digits is used.
+    upper : bool, optional
+        If True, use upper-case hex digits.
+
+    Returns
+    -------
+    mac : string
+        The formatted MAC address.
+    """
+    digits = "{0:012X}".format(value) if upper else "{0:012x}".format(value)
+
+    if sep == ".":
+        return ".".join(digits[i : i + 4] for i in range(0, 12, 4))
+
+    return sep.join(digits[i : i + 2] for i in range(0, 12, 2))
+
+
+def parse_oui(oui):
+    """Convert a vendor prefix (OUI) to an integer.
+
+    Parameters
+    ----------
+    oui : string or integer
+        The first three octets of a MAC address, e.g. "00:1b:21", or as
+        an integer.
+
+    Returns
+    -------
+    value : int
+        The OUI as a 24-bit integer.
+    """
+    if isinstance(oui, bool):
+        raise ValueError("invalid OUI: {0!r}".format(oui))
+    if isinstance(oui, int):
+        value = oui
+    else:
+        groups = _MAC_SEPARATORS.split(oui.strip())
+        if not all(groups):
+            raise ValueError("invalid OUI: {0!r}".format(oui))
+        if len(groups) == 3:
+            groups = [group.rjust(2, "0") for group in groups]
+        digits = "".join(groups)
+        if not _OUI_DIGITS.fullmatch(digits):
+            raise ValueError("invalid OUI: {0!r}".format(oui))
+        value = int(digits, 16)
+
+    if not 0 <= value < (1 << 24):
+        raise ValueError("OUI out of range: {0!r}".format(oui))
+
+    return value
+
+
+def macs_in_range(first, last):
+    """Return a query for the NodeMACs in an inclusive range.
+
+    The query is only run when it is iterated, so this isn't an
+    instrumented operation; wrap the iteration in
+    `chimedb.node.instrument.operation` to measure it.
+
+    Parameters
+    ----------
+    first, last : string or integer
+        The first and last MAC addresses of the range.
+
+    Returns
+    -------
+    query : peewee.ModelSelect
+        The NodeMACs in the range, ordered by address.
+    """
+    return (
+        NodeMAC.select()
+        .where(NodeMAC.value.between(parse_mac(first), parse_mac(last)))
+        .order_by(NodeMAC.value)
+    )
+
+
+def macs_by_oui(oui):
+    """Return a query for the NodeMACs with a given vendor prefix (OUI).
+
+    As for `macs_in_range`, the query is run by the caller.
+
+    Parameters
+    ----------
+    oui : string or integer
+        The first three octets of the MAC addresses, e.g. "00:1b:21".
+
+    Returns
+    -------
+    query : peewee.ModelSelect
+        The NodeMACs with that prefix, ordered by address.
+    """
+    first = parse_oui(oui) << 24
+    return macs_in_range(first, first | 0xFFFFFF)
+
+
+@instrumented
+def get_mac(mac):
+    """Return the NodeMAC for a MAC address, or None if there isn't one.
+
+    Parameters
+    ----------
+    mac : string or integer
+        The MAC address.
+    """
+    return NodeMAC.get_or_none(NodeMAC.value == parse_mac(mac))
+
+
+# One entry in the MACResolver map
+MACRecord = namedtuple(
+    "MACRecord",
+    ["item", "serial", "mac_type", "node", "node_serial", "rack_slot", "slot"],
+)
+MACRecord.__doc__ = """Resolved location of a MAC address
+
+Attributes
+----------
+item : int
+    The id of the NodeItem with the MAC address
+serial : string
+    The serial number of that NodeItem
+mac_type : string
+    The NodeMAC type ('NIC0', ..., 'IPMI')
+node : int or None
+    The id of the NodeAssembled holding the item, if any
+node_serial : string or None
+    The serial number of that node
+rack_slot : string or None
+    The serial number of the node's rack slot, if it is racked
+slot : string or None
+    The name of the node slot holding the item
+"""
+
+
+def mac_location_query():
+    """Return a query locating every NodeMAC.
+
+    The query joins NodeMAC to its NodeItem, the node holding the item (if
+    any) and that node's rack slot (if any).  Each row is a tuple: the
+    integer MAC followed by the fields of a `MACRecord`.
+
+    Returns
+    -------
+    query : peewee.ModelSelect
+        The query, in tuples mode.
+    slots : peewee query
+        The node-slot subquery, aliased "slots", for use in further
+        conditions.
+    """
+    slots = slot_query(lambda field: field.is_null(False)).alias("slots")
+    RackSlot = NodeItem.alias("rack")
+
+    query = (
+        NodeMAC.select(
+            NodeMAC.value,
+            NodeItem.id,
+            NodeItem.serial,
+            NodeMAC.mac_type,
+            NodeAssembled.id,
+            NodeAssembled.serial,
+            RackSlot.serial,
+            slots.c.slot,
+        )
+        .join(NodeItem, on=(NodeMAC.item == NodeItem.id))
+        .join(slots, pw.JOIN.LEFT_OUTER, on=(slots.c.item_id == NodeItem.id))
+        .join(
+            NodeAssembled, pw.JOIN.LEFT_OUTER, on=(NodeAssembled.id == slots.c.node_id)
+        )
+        .join(RackSlot, pw.JOIN.LEFT_OUTER, on=(RackSlot.id == NodeAssembled.rack_slot))
+        .tuples()
+    )
+
+    return query, slots
+
+
+@instrumented
+def locate_mac(mac):
+    """Look up a single MAC address in the database.
+
+    For many lookups, use a `MACResolver` instead.
+
+    Parameters
+    ----------
+    mac : string or integer
+        The MAC address.
+
+    Returns
+    -------
+    record : MACRecord or None
+        The location of the MAC address, or None if it is unknown.
+    """
+    query, _ = mac_location_query()
+    row = query.where(NodeMAC.value == parse_mac(mac)).first()
+    return None if row is None else MACRecord(*row[1:])
+
+
+class MACResolver(object):
+    """In-memory map from MAC address to component, node and rack slot.
+
+    The whole map is loaded with one joined query over NodeMAC, NodeItem,
+    NodeAssembled and the node slots, after which each lookup is a dict
+    access.  `refresh` brings the map up to date by reloading only the
+    MACs affected by NodeHistory records written since the last load.
+
+    Changes made to NodeMAC without a corresponding NodeHistory record
+    are not seen by `refresh`; call `load` to rebuild the whole map.
+    The map is loaded automatically on first use.
+    """
+
+    def __init__(self):
+        self._map = None
+        self._by_item = None
+        self._history_id = None
+
+    def __len__(self):
+        self._ensure_loaded()
+        return len(self._map)
+
+    def __contains__(self, mac):
+        self._ensure_loaded()
+        return parse_mac(mac) in self._map
+
+    def __getitem__(self, value):
+        """Look up an integer MAC address, raising KeyError if it's unknown."""
+        self._ensure_loaded()
+        return self._map[value]
+
+    def _ensure_loaded(self):
+        if self._map is None:
+            self.load()
+
+    def _store(self, rows):
+        """Add the rows of `mac_location_query` to the map."""
+        for row in rows:
+            record = MACRecord(*row[1:])
+            self._map[row[0]] = record
+            self._by_item.setdefault(record.item, set()).add(row[0])
+
+    def load(self):
+        """Load the entire map from the database."""
+        history_id = NodeHistory.select(pw.fn.MAX(NodeHistory.id)).scalar()
+
+        query, _ = mac_location_query()
+
+        self._map = dict()
+        self._by_item = dict()
+        self._store(query)
+        self._history_id = history_id or 0
+
+        _logger.debug("MACResolver: loaded {0} MACs".format(len(self._map)))
+
+    def refresh(self):
+        """Update the map with the changes recorded in NodeHistory since the last load.
+
+        Returns
+        -------
+        count : int
+            The number of MACs reloaded.
+        """
+        if self._map is None:
+            self.load()
+            return len(self._map)
+
+        changes = list(
+            NodeHistory.select(NodeHistory.id, NodeHistory.node, NodeHistory.item)
+            .where(NodeHistory.id > self._history_id)
+            .tuples()
+        )
+        if not changes:
+            return 0
+
+        history_id = max(change[0] for change in changes)
+        nodes = set(change[1] for change in changes if change[1] is not None)
+        items = set(change[2] for change in changes if change[2] is not None)
+
+        # Drop the existing entries before reloading, so deleted MACs vanish
+        for item in items:
+            for value in self._by_item.pop(item, ()):
+                self._map.pop(value, None)
+
+        # Items currently in an affected node also need reloading,
+        # since the node's rack slot may have changed.
+        query, slots = mac_location_query()
+        conditions = [
+            NodeItem.id.in_(chunk)
+            for chunk in pw.chunked(list(items), LOOKUP_CHUNK_SIZE)
+        ]
+        conditions += [
+            slots.c.node_id.in_(chunk)
+            for chunk in pw.chunked(list(nodes), LOOKUP_CHUNK_SIZE)
+        ]
+
+        # An item may match both conditions; count each MAC once
+        reloaded = set()
+        for condition in conditions:
+            rows = list(query.where(condition))
+            self._store(rows)
+            reloaded.update(row[0] for row in rows)
+
+        self._history_id = history_id
+
+        return len(reloaded)
+
+    def resolve(self, mac):
+        """Look up a MAC address.
+
+        Parameters
+        ----------
+        mac : string or integer
+            The MAC address.
+
+        Returns
+        -------
+        record : MACRecord or None
+            The location of the MAC address, or None if it is unknown.
+        """
+        self._ensure_loaded()
+        return self._map.get(parse_mac(mac))
+
+    def resolve_many(self, macs):
+        """Look up many MAC addresses.
+
+        Parameters
+        ----------
+        macs : iterable of strings or integers
+            The MAC addresses.
+
+        Returns
+        -------
+        records : dict
+            Maps each input MAC address to its MACRecord, or None if it is
+            unknown.
+        """
+        self._ensure_loaded()
+        return {mac: self._map.get(parse_mac(mac)) for mac in macs}
@@ -0,0 +1,344 @@
+"""Prometheus/OpenMetrics gauges of the node database
+
+`MetricsExporter` computes a set of gauges for dashboards with a few
+aggregate queries and caches them for a time-to-live, so that frequent
+scrapes don't each query the database:
+
+- `chimedb_node_nodes{rack, node_type}`: assembled nodes per rack.  The
+  rack of a node is the `location` of its rack-slot NodeItem; nodes not
+  in a rack slot have an empty `rack`.
+- `chimedb_node_components{type, status}`: NodeItems by type and status.
+- `chimedb_node_open_rmas{company}` and
+  `chimedb_node_open_rma_oldest_seconds{company}`: RMAs not yet received
+  back, and the age of the oldest, per company.
+- `chimedb_node_empty_slots{node_type, slot}`: empty slots of each kind
+  (e.g. "ram" for ram0 to ram7) over all nodes.
+
+The gauges are rendered in the Prometheus text exposition format, which
+OpenMetrics scrapers also accept, by `MetricsExporter.render`, or served
+over HTTP by `serve` and `chimedb-node metrics`.
+
+Examples
+--------
+>>> import chimedb.core
+>>> from chimedb.node.metrics import MetricsExporter, serve
+>>> chimedb.core.connect()
+>>> serve(MetricsExporter(ttl=60), port=9123)
+"""
+from .instrument import instrumented
+from .orm import NodeItem, NodeAssembled, NODE_SLOTS
+from .rma import open_rma_summary
+
+from collections import namedtuple, OrderedDict
+from http.server import BaseHTTPRequestHandler, HTTPServer
+import datetime
+import peewee as pw
+import threading
+import time
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# The prefix of every metric name
+PREFIX = "chimedb_node"
+
+# The Content-Type of the text exposition format
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# A gauge: its name (without the prefix), help text, label names, and a
+# list of (label values, value) samples
+Gauge = namedtuple("Gauge", ["name", "help", "labels", "samples"])
+
+# The kind of each slot, used as the `slot` label of the empty slot gauge
+SLOT_KINDS = OrderedDict((name, name.rstrip("0123456789")) for name in NODE_SLOTS)
+
+
+def nodes_per_rack():
+    """Return a Gauge of the number of nodes in each rack."""
+    Rack = NodeItem.alias("rack")
+    rack = pw.fn.COALESCE(Rack.location, "")
+    query = (
+        NodeAssembled.select(
+            rack, NodeAssembled.node_type, pw.fn.COUNT(NodeAssembled.id)
+        )
+        .join(Rack, pw.JOIN.LEFT_OUTER, on=(Rack.id == NodeAssembled.rack_slot))
+        .group_by(rack, NodeAssembled.node_type)
+        .order_by(rack, NodeAssembled.node_type)
+    )
+
+    return Gauge(
+        "nodes",
+        "Assembled nodes per rack",
+        ("rack", "node_type"),
+        [((rack, node_type), count) for rack, node_type, count in query.tuples()],
+    )
+
+
+def components_by_status():
+    """Return a Gauge of the number of components of each type and status."""
+    query = (
+        NodeItem.select(NodeItem.type, NodeItem.status, pw.fn.COUNT(NodeItem.id))
+        .group_by(NodeItem.type, NodeItem.status)
+        .order_by(NodeItem.type, NodeItem.status)
+    )
+
+    return Gauge(
+        "components",
+        "Components by type and status",
+        ("type", "status"),
+        [((type_, status), count) for type_, status, count in query.tuples()],
+    )
+
+
+def open_rmas(now=None):
+    """Return Gauges of the number and oldest age of open RMAs per company."""
+    if now is None:
+        now = datetime.datetime.now()
+    summary = open_rma_summary(now=now)
+
+    return [
+        Gauge(
+            "open_rmas",
+            "RMAs not yet received back",
+            ("company",),
+            [((row.company,), row.count) for row in summary],
+        ),
+        Gauge(
+            "open_rma_oldest_seconds",
+            "Time since the oldest open RMA was sent",
+            ("company",),
+            [((row.company,), (now - row.oldest).total_seconds()) for row in summary],
+        ),
+    ]
+
+
+def empty_slots():
+    """Return a Gauge of the number of empty slots of each kind.
+
+    All the slots are counted in a single pass over NodeAssembled.
+    """
+    fields = [getattr(NodeAssembled, name) for name in NODE_SLOTS]
+    query = NodeAssembled.select(
+        NodeAssembled.node_type,
+        *[pw.fn.SUM(pw.Case(None, [(field.is_null(), 1)], 0)) for field in fields]
+    ).group_by(NodeAssembled.node_type)
+
+    counts = OrderedDict()
+    for node_type, *empty in query.tuples():
+        for name, count in zip(NODE_SLOTS, empty):
+            key = (node_type, SLOT_KINDS[name])
+            counts[key] = counts.get(key, 0) + int(count or 0)
+
+    return Gauge(
+        "empty_slots",
+        "Empty slots in assembled nodes",
+        ("node_type", "slot"),
+        sorted(counts.items()),
+    )
+
+
+@instrumented
+def collect():
+    """Compute all the gauges.
+
+    Returns
+    -------
+    gauges : list of Gauge
+    """
+    return [nodes_per_rack(), components_by_status()] + open_rmas() + [empty_slots()]
+
+
+def _escape(value, quote=True):
+    """Escape a label value (or, if not `quote`, help text)."""
+    value = str(value).replace("\\", "\\\\").replace("\n", "\\n")
+    if quote:
+        value = value.replace('"', '\\"')
+    return value
+
+
+def _format_value(value):
+    if isinstance(value, int):
+        return str(value)
+    return repr(float(value))
+
+
+def render(gauges, prefix=PREFIX):
+    """Render gauges in the Prometheus text exposition format.
+
+    Parameters
+    ----------
+    gauges : list of Gauge
+        The gauges, e.g. from `collect`.
+    prefix : string, optional
+        Prefixed, with an underscore, to the gauge names.
+
+    Returns
+    -------
+    text : string
+    """
+    lines = list()
+    for gauge in gauges:
+        name = "{0}_{1}".format(prefix, gauge.name) if prefix else gauge.name
+        lines.append("# HELP {0} {1}".format(name, _escape(gauge.help, quote=False)))
+        lines.append("# TYPE {0} gauge".format(name))
+        for values, value in gauge.samples:
+            labels = ",".join(
+                '{0}="{1}"'.format(label, _escape("" if item is None else item))
+                for label, item in zip(gauge.labels, values)
+            )
+            lines.append(
+                "{0}{1} {2}".format(
+                    name, "{" + labels + "}" if labels else "", _format_value(value)
+                )
+            )
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsExporter(object):
+    """The node database gauges, cached for a time-to-live.
+
+    Parameters
+    ----------
+    ttl : float, optional
+        The number of seconds the gauges are reused before the database is
+        queried again.
+    prefix : string, optional
+        Prefixed to the metric names.
+
+    Attributes
+    ----------
+    refreshes : int
+        The number of times the gauges have been computed.
+    failures : int
+        The number of times computing them failed.
+    """
+
+    def __init__(self, ttl=60.0, prefix=PREFIX):
+        self.ttl = ttl
+        self.prefix = prefix
+
+        self.refreshes = 0
+        self.failures = 0
+
+        self._lock = threading.Lock()
+        self._gauges = None
+        self._updated = None
+        self._duration = None
+        # The time and error of the last failed refresh, if it failed
+        self._failed = None
+        self._error = None
+
+    def _meta_gauges(self):
+        """Return gauges describing the cached data itself."""
+        return [
+            Gauge(
+                "metrics_age_seconds",
+                "Time since the node database gauges were computed",
+                (),
+                [((), time.monotonic() - self._updated)],
+            ),
+            Gauge(
+                "metrics_query_seconds",
+                "Time taken to compute the node database gauges",
+                (),
+                [((), self._duration)],
+            ),
+        ]
+
+    def gauges(self):
+        """Return the gauges, recomputing them if they are older than `ttl`.
+
+        Only one thread recomputes them; any others wait for the result.
+        If recomputing fails, the error is logged and the previous gauges
+        are returned, or the error is raised if there are none.  After a
+        failure, the database isn't queried again until `ttl` has passed,
+        so that a struggling database isn't hit by every scrape.
+
+        Returns
+        -------
+        gauges : list of Gauge
+        """
+        with self._lock:
+            now = time.monotonic()
+            if self._failed is not None and now - self._failed < self.ttl:
+                if self._gauges is None:
+                    raise self._error
+            elif self._updated is None or now - self._updated >= self.ttl:
+                try:
+                    gauges = collect()
+                except Exception as e:
+                    self.failures += 1
+                    self._failed = now
+                    self._error = e
+                    if self._gauges is None:
+                        raise
+                    _logger.exception("Failed to update the node database gauges")
+                else:
+                    self._gauges = gauges
+                    self._updated = now
+                    self._duration = time.monotonic() - now
+                    self._failed = self._error = None
+                    self.refreshes += 1
+
+            return self._gauges + self._meta_gauges()
+
+    def render(self):
+        """Return the gauges in the Prometheus text exposition format."""
+        return render(self.gauges(), self.prefix)
+
+
+class _Handler(BaseHTTPRequestHandler):
+    """Serves the exporter's gauges at /metrics."""
+
+    exporter = None
+
+    def do_GET(self):
+        if self.path.split("?")[0] not in ("/", "/metrics"):
+            self.send_error(404)
+            return
+
+        try:
+            body = self.exporter.render().encode("utf-8")
+        except Exception:
+            _logger.exception("Failed to compute the node database gauges")
+            self.send_error(500)
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        _logger.debug("metrics: " + format % args)
+
+
+def serve(exporter=None, port=9123, address=""):
+    """Serve the gauges over HTTP at /metrics until interrupted.
+
+    Requests are handled one at a time, in the calling thread, so that a
+    single database connection is used.
+
+    Parameters
+    ----------
+    exporter : MetricsExporter, optional
+        The exporter to serve.  By default, one with the default TTL.
+    port : int, optional
+        The port to listen on.
+    address : string, optional
+        The address to listen on.  By default, all interfaces.
+    """
+    if exporter is None:
+        exporter = MetricsExporter()
+
+    handler = type("Handler", (_Handler,), {"exporter": exporter})
+    server = HTTPServer((address, port), handler)
+    _logger.info("Serving node database metrics on port {0}".format(port))
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
@@ -0,0 +1,315 @@
+"""Schema migration helpers for the node hardware tracker
+
+The columns and indexes declared in the table definitions are only
+created by `create_table`.  These functions add any which are missing
+from an existing, populated database.
+
+The models select every declared column, so a database created before
+columns were added (e.g. `version` on NodeItem and NodeAssembled, or
+`slot` on NodeHistory) must be migrated, with `chimedb-node migrate`,
+before this version of the package is used with it.  `check_schema`
+tells whether that has been done.
+"""
+from chimedb.core.exceptions import CHIMEdbError
+
+from .orm import NodeItem, NodeMAC, NodeAssembled, NodeHistory, NodeRMA
+
+import peewee as pw
+from playhouse.migrate import SchemaMigrator, migrate as run_operations
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# Tables managed by the migration functions, in creation order
+MODELS = (NodeItem, NodeMAC, NodeAssembled, NodeRMA, NodeHistory)
+
+# Set by check_schema once the columns have been found
+_schema_ok = False
+
+
+class SchemaError(CHIMEdbError):
+    """The node tables are missing columns: run `chimedb-node migrate`."""
+
+
+def missing_columns(model):
+    """Return the fields of `model` which have no column in the database.
+
+    Parameters
+    ----------
+    model : base_model subclass
+        The table to check.
+
+    Returns
+    -------
+    fields : list of peewee.Field
+        The fields without columns.
+    """
+    db = model._meta.database
+    existing = set(column.name for column in db.get_columns(model._meta.table_name))
+
+    return [
+        field
+        for field in model._meta.sorted_fields
+        if field.column_name not in existing
+    ]
+
+
+def check_schema(refresh=False):
+    """Check that every declared column of the node tables exists.
+
+    The check is only made once per process once it has passed, unless
+    `refresh` is True.
+
+    Raises
+    ------
+    SchemaError
+        Some columns are missing, so `chimedb-node migrate` needs to be
+        run before the database can be used.
+    """
+    global _schema_ok
+
+    if _schema_ok and not refresh:
+        return
+
+    missing = [
+        "{0}.{1}".format(model._meta.table_name, field.column_name)
+        for model in MODELS
+        for field in missing_columns(model)
+    ]
+    if missing:
+        raise SchemaError(
+            "The node database is missing column(s) {0}; run `chimedb-node "
+            "migrate` to add them".format(", ".join(missing))
+        )
+
+    _schema_ok = True
+
+
+def add_columns(models=MODELS, dry_run=False):
+    """Add the declared columns which are missing from the database.
+
+    Only nullable columns, or columns with a default, can be added to a
+    populated table.  Others are logged and skipped.
+
+    Parameters
+    ----------
+    models : list of base_model subclasses, optional
+        The tables to migrate.  By default, all node tables.
+    dry_run : bool, optional
+        If True, don't change anything; just report what would be done.
+
+    Returns
+    -------
+    added : list of strings
+        The "table.column" names of the columns added (or, if `dry_run`,
+        which would have been added).
+    skipped : list of strings
+        The "table.column" names of the columns which can't be added.
+    """
+    added = list()
+    skipped = list()
+
+    for model in models:
+        db = model._meta.database
+        # The migrator needs the real database, not the proxy
+        migrator = SchemaMigrator.from_database(getattr(db, "obj", db))
+        table = model._meta.table_name
+
+        for field in missing_columns(model):
+            name = "{0}.{1}".format(table, field.column_name)
+            if not field.null and field.default is None:
+                _logger.warning(
+                    "Can't add NOT NULL column {0} without a default".format(name)
+                )
+                skipped.append(name)
+                continue
+
+            if not dry_run:
+                _logger.info("Adding column {0}".format(name))
+                with db.atomic():
+                    run_operations(migrator.add_column(table, field.column_name, field))
+            added.append(name)
+
+    return added, skipped
+
+
+def missing_indexes(model):
+    """Return the indexes declared for `model` which don't exist in the database.
+
+    Parameters
+    ----------
+    model : base_model subclass
+        The table to check.
+
+    Returns
+    -------
+    indexes : list of peewee.ModelIndex
+        The missing indexes.
+    """
+    db = model._meta.database
+    existing = set(index.name for index in db.get_indexes(model._meta.table_name))
+
+    return [
+        index for index in model._meta.fields_to_index() if index._name not in existing
+    ]
+
+
+def find_duplicates(model, fields):
+    """Find rows which would violate a unique index on `fields`.
+
+    Rows with NULL in any of the fields are ignored, since they don't
+    violate a unique index.
+
+    Parameters
+    ----------
+    model : base_model subclass
+        The table to check.
+    fields : list of peewee.Field
+        The fields of the index.
+
+    Returns
+    -------
+    duplicates : list
+        A list of (values..., count) tuples, one for each set of values
+        appearing more than once.
+    """
+    query = (
+        model.select(*fields, pw.fn.COUNT(model._meta.primary_key).alias("n"))
+        .group_by(*fields)
+        .having(pw.fn.COUNT(model._meta.primary_key) > 1)
+    )
+    for field in fields:
+        query = query.where(field.is_null(False))
+
+    return list(query.tuples())
+
+
+def build_indexes(models=MODELS, dry_run=False):
+    """Create the declared indexes which are missing from the database.
+
+    A unique index is not created if existing rows would violate it;
+    the offending values are logged instead, so they can be fixed and
+    the migration re-run.
+
+    Parameters
+    ----------
+    models : list of base_model subclasses, optional
+        The tables to migrate.  By default, all node tables.
+    dry_run : bool, optional
+        If True, don't create anything; just report what would be done.
+
+    Returns
+    -------
+    created : list of strings
+        The names of the indexes created (or, if `dry_run`, the names of
+        those which would have been created).
+    skipped : list of strings
+        The names of the unique indexes not created because of
+        duplicate rows.
+    """
+    created = list()
+    skipped = list()
+
+    for model in models:
+        db = model._meta.database
+        for index in missing_indexes(model):
+            if index._unique:
+                duplicates = find_duplicates(model, index._expressions)
+                if duplicates:
+                    _logger.warning(
+                        "Not creating unique index {0}: {1} duplicate values, "
+                        "e.g. {2}".format(index._name, len(duplicates), duplicates[0])
+                    )
+                    skipped.append(index._name)
+                    continue
+
+            if not dry_run:
+                _logger.info("Creating index {0}".format(index._name))
+                # Not "IF NOT EXISTS", which MySQL doesn't support
+                db.execute(index.safe(False))
+            created.append(index._name)
+
+    return created, skipped
+
+
+def deferrable_indexes(model):
+    """Return the existing indexes of `model` which can be dropped for a bulk load.
+
+    These are the non-unique indexes, except, on MySQL, those on foreign
+    keys, which MySQL won't drop while the constraint exists.
+
+    Parameters
+    ----------
+    model : base_model subclass
+        The table to check.
+
+    Returns
+    -------
+    indexes : list of peewee.ModelIndex
+        The indexes which can be dropped.
+    """
+    db = model._meta.database
+    db = getattr(db, "obj", db)
+    existing = set(index.name for index in db.get_indexes(model._meta.table_name))
+
+    indexes = list()
+    for index in model._meta.fields_to_index():
+        if index._unique or index._name not in existing:
+            continue
+        if isinstance(db, pw.MySQLDatabase) and any(
+            isinstance(field, pw.ForeignKeyField) for field in index._expressions
+        ):
+            continue
+        indexes.append(index)
+
+    return indexes
+
+
+def drop_indexes(models=MODELS):
+    """Drop the indexes which can be deferred during a bulk load.
+
+    Inserting into a table without its secondary indexes, and rebuilding
+    them afterwards with `build_indexes`, is much faster than updating
+    the indexes row by row.
+
+    Parameters
+    ----------
+    models : list of base_model subclasses, optional
+        The tables to change.  By default, all node tables.
+
+    Returns
+    -------
+    dropped : list of strings
+        The names of the indexes dropped.
+    """
+    dropped = list()
+    for model in models:
+        db = model._meta.database
+        migrator = SchemaMigrator.from_database(getattr(db, "obj", db))
+        for index in deferrable_indexes(model):
+            _logger.info("Dropping index {0}".format(index._name))
+            with db.atomic():
+                run_operations(migrator.drop_index(model._meta.table_name, index._name))
+            dropped.append(index._name)
+
+    return dropped
+
+
+def migrate(models=MODELS, dry_run=False):
+    """Bring an existing database up to date with the table definitions.
+
+    Runs `add_columns` and then `build_indexes`.
+
+    Returns
+    -------
+    changed : list of strings
+        The columns and indexes added (or which would have been).
+    skipped : list of strings
+        The columns and indexes which couldn't be added.
+    """
+    added, skipped_columns = add_columns(models, dry_run)
+    created, skipped_indexes = build_indexes(models, dry_run)
+
+    return added + created, skipped_columns + skipped_indexes
@@ -36,6 +36,9 @@ class NodeItem(base_model):
             - 'GONE': the component has been discarded
     location : text
         Location of component (if not in a node)
+    version : integer
+        Row version, incremented by every update made through
+        `chimedb.node.api`, used to detect conflicting updates
     """
 
     type = EnumField(["CPU", "GPU", "MB", "NIC", "RAM"], default="CPU")
@@ -43,6 +46,15 @@ class NodeItem(base_model):
     serial = pw.CharField(max_length=64, null=True)
     status = EnumField(["OK", "RMA", "GONE"], default="OK")
     location = pw.TextField()
+    version = pw.IntegerField(default=0)
+
+    class Meta:
+        indexes = (
+            # type + serial is unique
+            (("type", "serial"), True),
+            # for listing items by status
+            (("status", "type"), False),
+        )
 
 
 class NodeMAC(base_model):
@@ -70,10 +82,30 @@ class NodeMAC(base_model):
     class Meta:
         indexes = (
             # item + type is unique
-            (("item", "node_type"), True),
+            (("item", "mac_type"), True),
         )
 
 
+# The NodeItem slots of a NodeAssembled, in field order
+NODE_SLOTS = (
+    "rack_slot",
+    "motherboard",
+    "cpu0",
+    "cpu1",
+    "gpu0",
+    "gpu1",
+    "nic",
+    "ram0",
+    "ram1",
+    "ram2",
+    "ram3",
+    "ram4",
+    "ram5",
+    "ram6",
+    "ram7",
+)
+
+
 class NodeAssembled(base_model):
     """Data for an assembled X-engine GPU node or FRB L1 node
 
@@ -117,6 +149,9 @@ class NodeAssembled(base_model):
         Reference to the eighth installed NodeRAM module
     location : text
         Location of node (if not in a rack)
+    version : integer
+        Row version, incremented by every update made through
+        `chimedb.node.api`, used to detect conflicting updates
     """
 
     node_type = EnumField(["FRB", "GPU"], default="GPU")
@@ -136,6 +171,44 @@ class NodeAssembled(base_model):
     ram5 = pw.ForeignKeyField(NodeItem, backref="node", unique=True, null=True)
     ram6 = pw.ForeignKeyField(NodeItem, backref="node", unique=True, null=True)
     ram7 = pw.ForeignKeyField(NodeItem, backref="node", unique=True, null=True)
+    version = pw.IntegerField(default=0)
+
+    @classmethod
+    def slot_fields(cls):
+        """Return a dict of the NodeItem foreign key fields, keyed by slot name."""
+        return {name: getattr(cls, name) for name in NODE_SLOTS}
+
+
+class NodeSlot(base_model):
+    """Optional index of the contents of the NodeAssembled slots
+
+    There is one row per slot of every assembled node, including empty
+    slots.  This table duplicates information in NodeAssembled; it is
+    kept in sync by the functions in `chimedb.node.api` and may be
+    rebuilt with `chimedb.node.slots.rebuild_slot_index`.  Changes to
+    NodeAssembled made any other way are not seen by NodeSlot until it
+    is rebuilt.
+
+    Attributes
+    ----------
+    node : foreign key
+        Reference to the NodeAssembled
+    slot_name : enum
+        The name of the slot (one of `NODE_SLOTS`)
+    item : foreign key
+        Reference to the NodeItem in the slot, or NULL if the slot
+        is empty
+    """
+
+    node = pw.ForeignKeyField(NodeAssembled, backref="slots")
+    slot_name = EnumField(list(NODE_SLOTS), default="rack_slot")
+    item = pw.ForeignKeyField(NodeItem, backref="slot", unique=True, null=True)
+
+    class Meta:
+        indexes = (
+            # node + slot_name is unique
+            (("node", "slot_name"), True),
+        )
 
 
 class NodeRMA(base_model):
@@ -161,6 +234,12 @@ class NodeRMA(base_model):
     send_time = pw.DateTimeField(default=datetime.datetime.now)
     recv_time = pw.DateTimeField(null=True)
 
+    class Meta:
+        indexes = (
+            # for finding open RMAs (no recv_time) by age
+            (("recv_time", "send_time"), False),
+        )
+
 
 class NodeHistory(base_model):
     """Notes and history for the node hardware tracker
@@ -182,6 +261,10 @@ class NodeHistory(base_model):
         Referencing the NodeItem affected, if any
     rma : foreign key
         Referencing the NodeRMA record, if any
+    slot : enum
+        The NodeAssembled slot (one of `NODE_SLOTS`) affected by an
+        'ADD' or 'DEL' on a node, if known.  NULL in records written
+        before this column was added.
     timestamp : datetime
         The timestamp of the record
     autonote : boolean
@@ -195,6 +278,36 @@ class NodeHistory(base_model):
     node = pw.ForeignKeyField(NodeAssembled, backref="history", null=True)
     item = pw.ForeignKeyField(NodeItem, backref="history", null=True)
     rma = pw.ForeignKeyField(NodeRMA, backref="history", null=True)
-    timestamp = pw.DateTimeField(default=datetime.datetime.now)
+    slot = EnumField(list(NODE_SLOTS), null=True)
+    timestamp = pw.DateTimeField(default=datetime.datetime.now, index=True)
     autonote = pw.BooleanField(default=True)
     note = pw.TextField()
+
+    class Meta:
+        indexes = (
+            # for the history of a component or node, in time order
+            (("item", "timestamp"), False),
+            (("node", "timestamp"), False),
+        )
+
+
+class NodeSnapshot(base_model):
+    """Optional stored checkpoints of the contents of all nodes
+
+    Each row holds the contents of every NodeAssembled slot just after
+    the NodeHistory record `history_id`.  These are starting points for
+    reconstructing past node contents; see `chimedb.node.history`.
+
+    Attributes
+    ----------
+    history_id : integer
+        The id of the last NodeHistory record reflected in the snapshot
+    timestamp : datetime
+        The time the snapshot was made
+    data : blob
+        The zlib-compressed JSON encoding of the node contents
+    """
+
+    history_id = pw.IntegerField(unique=True)
+    timestamp = pw.DateTimeField(default=datetime.datetime.now)
+    data = pw.BlobField()
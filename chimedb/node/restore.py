@@ -0,0 +1,369 @@
+"""Bulk load of the node tables from an export
+
+The counterpart of `chimedb.node.export`: loads the table files written by
+`export_all` into an empty database, e.g. to seed a staging or test
+database from a production dump.  Tables are loaded in foreign key order
+with large multi-row INSERTs, keeping the primary keys of the export.
+Referential integrity is checked once, at the end, rather than row by
+row.
+
+For speed, the load can:
+
+- run in a single transaction, rather than committing each chunk;
+- drop the non-unique indexes first and rebuild them afterwards (with
+  `chimedb.node.migrate.build_indexes`);
+- on MySQL, turn off foreign key and unique checks for the session;
+- on PostgreSQL with psycopg2, load CSV files with COPY.
+
+The NodeSlot index, if present, is rebuilt after the load.
+"""
+from chimedb.core.exceptions import ValidationError
+
+from .export import EXPORT_MODELS, EXTENSIONS, _pyarrow
+from .lookup import _parameter_limit
+from .migrate import build_indexes, drop_indexes
+from .orm import NodeSlot, NodeSnapshot
+from .slots import rebuild_slot_index, slot_index_enabled
+
+from collections import OrderedDict
+from contextlib import nullcontext
+import csv
+import os
+import peewee as pw
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# Rows in each INSERT
+IMPORT_CHUNK_SIZE = 5000
+
+
+def _database(model):
+    """Return the real database of a model, not the proxy."""
+    db = model._meta.database
+    return getattr(db, "obj", db)
+
+
+def _chunk_size(model, chunk_size, columns):
+    """Limit `chunk_size` to the number of bound parameters allowed."""
+    limit = _parameter_limit(_database(model))
+    return max(min(chunk_size, limit // columns), 1)
+
+
+def _csv_converter(field):
+    """Return a function converting a CSV string to a value for `field`."""
+    if isinstance(field, pw.ForeignKeyField):
+        field = field.rel_field
+
+    if isinstance(field, pw.BooleanField):
+        convert = _csv_bool
+    elif isinstance(field, pw.IntegerField):
+        convert = int
+    elif isinstance(field, pw.FloatField):
+        convert = float
+    elif isinstance(field, pw.DateTimeField):
+        convert = field.python_value
+    else:
+        # The exporter writes NULL as an empty string, so an empty string
+        # is only kept as one in a NOT NULL column
+        convert = str
+        if not field.null:
+            return convert
+
+    def converter(value):
+        return None if value == "" else convert(value)
+
+    return converter
+
+
+def _csv_bool(value):
+    return value not in ("0", "False", "false")
+
+
+def _read_csv(path, fields, batch_size):
+    """Yield the rows of a CSV export in batches."""
+    with open(path, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        converters = [_csv_converter(fields[name]) for name in header]
+        batch = list()
+        for row in reader:
+            batch.append(
+                tuple(convert(value) for convert, value in zip(converters, row))
+            )
+            if len(batch) >= batch_size:
+                yield header, batch
+                batch = list()
+        if batch:
+            yield header, batch
+
+
+def _read_parquet(path, fields, batch_size):
+    """Yield the rows of a Parquet export in batches."""
+    _, pq = _pyarrow()
+    parquet = pq.ParquetFile(path)
+    for record_batch in parquet.iter_batches(batch_size=batch_size):
+        columns = record_batch.to_pydict()
+        header = list(columns)
+        yield header, list(zip(*[columns[name] for name in header]))
+
+
+def _find_file(directory, name, fmt):
+    """Return the path and format of the export of table `name`, or None."""
+    formats = list(EXTENSIONS) if fmt is None else [fmt]
+    for fmt in formats:
+        path = os.path.join(directory, name + EXTENSIONS[fmt])
+        if os.path.exists(path):
+            if fmt == "parquet" and _pyarrow() is None:
+                raise ImportError("Reading {0} needs pyarrow".format(path))
+            return path, fmt
+
+    return None, None
+
+
+def _copy_csv(model, path, fields):
+    """Load a CSV export into PostgreSQL with COPY.
+
+    Returns the number of rows loaded, or None if COPY isn't available
+    (not PostgreSQL, or not psycopg2).
+    """
+    db = _database(model)
+    if not isinstance(db, pw.PostgresqlDatabase):
+        return None
+    cursor = db.cursor()
+    if not hasattr(cursor, "copy_expert"):
+        return None
+
+    with open(path, newline="") as f:
+        header = next(csv.reader(f))
+        f.seek(0)
+        # Empty strings in NOT NULL text columns are strings, not NULL
+        not_null = [
+            name
+            for name in header
+            if not fields[name].null
+            and isinstance(fields[name], (pw.CharField, pw.TextField))
+        ]
+        sql = 'COPY "{0}" ({1}) FROM STDIN WITH (FORMAT csv, HEADER true{2})'.format(
+            model._meta.table_name,
+            ", ".join('"{0}"'.format(name) for name in header),
+            (
+                ", FORCE_NOT_NULL ({0})".format(
+                    ", ".join('"{0}"'.format(name) for name in not_null)
+                )
+                if not_null
+                else ""
+            ),
+        )
+        cursor.copy_expert(sql, f)
+
+    return cursor.rowcount
+
+
+def _reset_sequence(model):
+    """Move a PostgreSQL id sequence past the loaded primary keys."""
+    db = _database(model)
+    key = model._meta.primary_key
+    if not isinstance(db, pw.PostgresqlDatabase) or not isinstance(key, pw.AutoField):
+        return
+
+    table = model._meta.table_name
+    db.execute_sql(
+        "SELECT setval(pg_get_serial_sequence('\"{0}\"', '{1}'), "
+        'COALESCE(MAX("{1}"), 0) + 1, false) FROM "{0}"'.format(table, key.column_name)
+    )
+
+
+def load_table(model, path, fmt, chunk_size=IMPORT_CHUNK_SIZE):
+    """Load one table from an export file, keeping its primary keys.
+
+    Parameters
+    ----------
+    model : base_model subclass
+        The table to load.
+    path : string
+        The export file.
+    fmt : string
+        "parquet" or "csv".
+    chunk_size : int, optional
+        The maximum number of rows in each INSERT.
+
+    Returns
+    -------
+    count : int
+        The number of rows loaded.
+    """
+    fields = dict((field.column_name, field) for field in model._meta.sorted_fields)
+
+    count = _copy_csv(model, path, fields) if fmt == "csv" else None
+    if count is None:
+        chunk_size = _chunk_size(model, chunk_size, len(fields))
+        read = _read_csv if fmt == "csv" else _read_parquet
+        count = 0
+        for header, rows in read(path, fields, chunk_size):
+            model.insert_many(rows, fields=[fields[name] for name in header]).execute()
+            count += len(rows)
+
+    _reset_sequence(model)
+    _logger.info("Loaded {0} rows into {1}".format(count, model.__name__))
+
+    return count
+
+
+def check_integrity(models=EXPORT_MODELS):
+    """Find rows whose foreign keys refer to missing rows.
+
+    Parameters
+    ----------
+    models : list of base_model subclasses, optional
+        The tables to check.
+
+    Returns
+    -------
+    broken : OrderedDict
+        Maps "table.column" to the number of rows with a dangling foreign
+        key.  Empty if all references are intact.
+    """
+    broken = OrderedDict()
+    for model in models:
+        for field in model._meta.sorted_fields:
+            if not isinstance(field, pw.ForeignKeyField):
+                continue
+
+            target = field.rel_model.alias()
+            count = (
+                model.select()
+                .join(
+                    target,
+                    pw.JOIN.LEFT_OUTER,
+                    on=(field == getattr(target, field.rel_field.name)),
+                )
+                .where(
+                    field.is_null(False)
+                    & getattr(target, field.rel_field.name).is_null()
+                )
+                .count()
+            )
+            if count:
+                broken[
+                    "{0}.{1}".format(model._meta.table_name, field.column_name)
+                ] = count
+
+    return broken
+
+
+def _set_checks(models, enabled):
+    """Turn MySQL foreign key and unique checks on or off for the session."""
+    db = _database(models[0])
+    if isinstance(db, pw.MySQLDatabase):
+        value = 1 if enabled else 0
+        db.execute_sql(
+            "SET foreign_key_checks = {0}, unique_checks = {0}".format(value)
+        )
+
+
+def restore(
+    directory,
+    fmt=None,
+    replace=False,
+    chunk_size=IMPORT_CHUNK_SIZE,
+    single_transaction=True,
+    defer_indexes=True,
+    disable_checks=False,
+):
+    """Load the node tables from an export directory.
+
+    Parameters
+    ----------
+    directory : string
+        A directory written by `chimedb.node.export.export_all`.
+    fmt : string, optional
+        "parquet" or "csv".  By default, whichever is present for each
+        table, preferring Parquet.
+    replace : bool, optional
+        If True, delete the existing contents of the tables first.
+        Otherwise, the tables must be empty.
+    chunk_size : int, optional
+        The maximum number of rows in each INSERT.
+    single_transaction : bool, optional
+        If True (the default), load everything in one transaction, which
+        is rolled back if the integrity check fails.  If False, each
+        INSERT is committed on its own.
+    defer_indexes : bool, optional
+        If True (the default), drop the non-unique indexes before the load
+        and rebuild them afterwards.
+    disable_checks : bool, optional
+        If True, turn off MySQL's per-row foreign key and unique checks
+        during the load.  Ignored for other databases.
+
+    Returns
+    -------
+    counts : OrderedDict
+        Maps table name to the number of rows loaded.
+
+    Raises
+    ------
+    ValidationError
+        If the tables aren't empty (and `replace` is False), a table's file
+        is missing, or the loaded rows have dangling foreign keys.
+    """
+    models = list(EXPORT_MODELS)
+    db = models[0]._meta.database
+
+    paths = OrderedDict()
+    for model in models:
+        path, table_fmt = _find_file(directory, model.__name__, fmt)
+        if path is None:
+            raise ValidationError(
+                "No export of {0} in {1}".format(model.__name__, directory)
+            )
+        paths[model] = (path, table_fmt)
+
+    if not replace:
+        for model in models:
+            if model.select().exists():
+                raise ValidationError(
+                    "Table {0} is not empty".format(model._meta.table_name)
+                )
+
+    if defer_indexes:
+        drop_indexes(models)
+    if disable_checks:
+        _set_checks(models, False)
+
+    counts = OrderedDict()
+    try:
+        with db.atomic() if single_transaction else nullcontext():
+            if replace:
+                for table in (NodeSnapshot, NodeSlot):
+                    if table.table_exists():
+                        table.delete().execute()
+                for model in reversed(models):
+                    model.delete().execute()
+
+            for model in models:
+                path, table_fmt = paths[model]
+                counts[model.__name__] = load_table(model, path, table_fmt, chunk_size)
+
+            broken = check_integrity(models)
+            if broken:
+                raise ValidationError(
+                    "Dangling foreign keys after load: {0}".format(
+                        ", ".join(
+                            "{0} ({1} rows)".format(name, count)
+                            for name, count in broken.items()
+                        )
+                    )
+                )
+    finally:
+        if disable_checks:
+            _set_checks(models, True)
+        if defer_indexes:
+            build_indexes(models)
+
+    if slot_index_enabled(refresh=True):
+        rebuild_slot_index()
+
+    return counts
@@ -0,0 +1,228 @@
+"""RMA analytics
+
+Aggregates over NodeRMA, computed in the database with GROUP BY so that
+only one row per company or model comes back:
+
+- `turnaround`: mean, median and 90th percentile repair time per company;
+- `open_rmas` and `open_rma_summary`: components still out for RMA;
+- `failure_rates`: RMAs per component model, relative to the number of
+  that model installed.
+
+The percentiles use window functions, which need MySQL 8.0, MariaDB
+10.2, PostgreSQL or SQLite 3.25 or newer.
+"""
+from .orm import NodeItem, NodeRMA
+from .instrument import instrumented
+from .slots import slot_query
+
+from collections import namedtuple
+import datetime
+import peewee as pw
+
+# Turnaround statistics for one company; times are in days
+Turnaround = namedtuple("Turnaround", ["company", "count", "mean", "median", "p90"])
+
+# RMA count for one component model
+FailureRate = namedtuple("FailureRate", ["model", "failures", "installed", "rate"])
+
+# Open RMAs for one company
+OpenSummary = namedtuple("OpenSummary", ["company", "count", "oldest"])
+
+
+def _seconds_between(start, end):
+    """Return an SQL expression for the seconds from `start` to `end`."""
+    db = NodeRMA._meta.database
+    db = getattr(db, "obj", db)
+
+    if isinstance(db, pw.SqliteDatabase):
+        return (pw.fn.julianday(end) - pw.fn.julianday(start)) * 86400
+    if isinstance(db, pw.PostgresqlDatabase):
+        return pw.fn.EXTRACT(pw.NodeList((pw.SQL("EPOCH FROM"), end - start)))
+    return pw.fn.TIMESTAMPDIFF(pw.SQL("SECOND"), start, end)
+
+
+def _percentile(rank, count, value, fraction):
+    """Return an aggregate picking the nearest-rank percentile of `value`.
+
+    The nearest rank is the smallest `rank` with `rank >= fraction * count`.
+    """
+    return pw.fn.MAX(
+        pw.Case(
+            None,
+            [
+                (
+                    (rank >= count * fraction) & (rank - 1 < count * fraction),
+                    value,
+                )
+            ],
+            None,
+        )
+    )
+
+
+@instrumented
+def turnaround(since=None, company=None):
+    """Return RMA turnaround statistics per company.
+
+    Only completed RMAs (with a `recv_time`) are included.
+
+    Parameters
+    ----------
+    since : datetime, optional
+        Only include RMAs sent at or after this time.
+    company : string, optional
+        Only include RMAs for this company.
+
+    Returns
+    -------
+    stats : list of Turnaround
+        One per company, ordered by company.  Times are in days.
+    """
+    seconds = _seconds_between(NodeRMA.send_time, NodeRMA.recv_time)
+    durations = NodeRMA.select(
+        NodeRMA.company,
+        seconds.alias("seconds"),
+        pw.fn.ROW_NUMBER()
+        .over(partition_by=[NodeRMA.company], order_by=[seconds])
+        .alias("rank"),
+        pw.fn.COUNT(NodeRMA.id).over(partition_by=[NodeRMA.company]).alias("n"),
+    ).where(NodeRMA.recv_time.is_null(False))
+    if since is not None:
+        durations = durations.where(NodeRMA.send_time >= since)
+    if company is not None:
+        durations = durations.where(NodeRMA.company == company)
+    durations = durations.alias("durations")
+
+    c = durations.c
+    query = (
+        pw.Select(
+            [durations],
+            [
+                c.company,
+                pw.fn.COUNT(c.seconds),
+                pw.fn.AVG(c.seconds),
+                _percentile(c.rank, c.n, c.seconds, 0.5),
+                _percentile(c.rank, c.n, c.seconds, 0.9),
+            ],
+        )
+        .group_by(c.company)
+        .order_by(c.company)
+        .bind(NodeRMA._meta.database)
+    )
+
+    return [
+        Turnaround(
+            name,
+            count,
+            *[None if value is None else float(value) / 86400 for value in stats]
+        )
+        for name, count, *stats in query.tuples()
+    ]
+
+
+@instrumented
+def open_rmas(older_than=0, now=None):
+    """Return the RMAs still open after a number of days.
+
+    Parameters
+    ----------
+    older_than : float, optional
+        Only return RMAs sent more than this many days ago.
+    now : datetime, optional
+        The current time.  Defaults to now.
+
+    Returns
+    -------
+    rmas : list of NodeRMA
+        The open RMAs, oldest first, with their `item` already loaded.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=older_than)
+
+    return list(
+        NodeRMA.select(NodeRMA, NodeItem)
+        .join(NodeItem)
+        .where(NodeRMA.recv_time.is_null() & (NodeRMA.send_time < cutoff))
+        .order_by(NodeRMA.send_time)
+    )
+
+
+@instrumented
+def open_rma_summary(older_than=0, now=None):
+    """Count the RMAs still open after a number of days, per company.
+
+    Parameters
+    ----------
+    older_than, now
+        As for `open_rmas`.
+
+    Returns
+    -------
+    summary : list of OpenSummary
+        One per company with open RMAs, giving the number open and the
+        send time of the oldest, ordered by company.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+    cutoff = now - datetime.timedelta(days=older_than)
+
+    query = (
+        NodeRMA.select(
+            NodeRMA.company,
+            pw.fn.COUNT(NodeRMA.id),
+            pw.fn.MIN(NodeRMA.send_time).python_value(NodeRMA.send_time.python_value),
+        )
+        .where(NodeRMA.recv_time.is_null() & (NodeRMA.send_time < cutoff))
+        .group_by(NodeRMA.company)
+        .order_by(NodeRMA.company)
+    )
+
+    return [OpenSummary(*row) for row in query.tuples()]
+
+
+@instrumented
+def failure_rates(since=None):
+    """Return the RMA rate of each component model.
+
+    The rate is the number of components of the model sent for RMA,
+    divided by the number of components of the model currently installed
+    in nodes.
+
+    Parameters
+    ----------
+    since : datetime, optional
+        Only count RMAs sent at or after this time.
+
+    Returns
+    -------
+    rates : list of FailureRate
+        One per model which is installed or has been sent for RMA, ordered
+        by model.  `rate` is None if none of the model are installed.
+    """
+    failed = NodeRMA.select(NodeItem.model, pw.fn.COUNT(NodeRMA.item.distinct())).join(
+        NodeItem
+    )
+    if since is not None:
+        failed = failed.where(NodeRMA.send_time >= since)
+    failed = dict(failed.group_by(NodeItem.model).tuples())
+
+    slots = slot_query(lambda field: field.is_null(False)).alias("slots")
+    installed = dict(
+        NodeItem.select(NodeItem.model, pw.fn.COUNT(NodeItem.id))
+        .join(slots, on=(NodeItem.id == slots.c.item_id))
+        .group_by(NodeItem.model)
+        .tuples()
+    )
+
+    rates = list()
+    for model in sorted(set(failed) | set(installed), key=lambda name: name or ""):
+        failures = failed.get(model, 0)
+        count = installed.get(model, 0)
+        rates.append(
+            FailureRate(
+                model, failures, count, float(failures) / count if count else None
+            )
+        )
+
+    return rates
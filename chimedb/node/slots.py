@@ -0,0 +1,198 @@
+"""Maintenance of the optional NodeSlot index table
+
+NodeSlot is only kept in sync by the writes made through
+`chimedb.node.api` (and the bulk loaders, which rebuild it).  Anything
+else which writes the slot columns of NodeAssembled directly, such as
+SQL run by hand or another program, leaves NodeSlot stale: lookups will
+then return the old contents until `chimedb-node slots rebuild` is run.
+`chimedb-node slots verify` reports any differences.
+"""
+from .orm import NodeAssembled, NodeSlot
+
+import peewee as pw
+
+import logging
+
+_logger = logging.getLogger("chimedb")
+_logger.addHandler(logging.NullHandler())
+
+# True once slot_index_enabled() has found the NodeSlot table
+_enabled = False
+
+
+def slot_index_enabled(refresh=False):
+    """Is the NodeSlot table in use?
+
+    The NodeSlot table is optional: if it doesn't exist in the database,
+    nothing tries to maintain or query it.  Once the table has been
+    found, the result is cached for the life of the process, unless
+    `refresh` is True.  While it is absent the check is made on every
+    call, so that a process which was started before the table was
+    created by another one starts maintaining it at once, rather than
+    leaving it stale.
+    """
+    global _enabled
+
+    if not _enabled or refresh:
+        _enabled = NodeSlot.table_exists()
+
+    return _enabled
+
+
+def assembled_slots(condition=None, names=None):
+    """Return a UNION ALL query over all slots of NodeAssembled.
+
+    Each row of the query has three columns: `node_id`, `slot` and
+    `item_id`.  If `condition` is given, it is a function taking a slot
+    field and returning an expression; only slots satisfying that
+    expression are selected.  Each part of the union can then use the
+    index on its column, which a single OR over all columns can't do.
+    If `names` is given, only those slots are included.
+    """
+    union = None
+    for name, field in NodeAssembled.slot_fields().items():
+        if names is not None and name not in names:
+            continue
+        query = NodeAssembled.select(
+            NodeAssembled.id.alias("node_id"),
+            pw.Value(name).alias("slot"),
+            field.alias("item_id"),
+        )
+        if condition is not None:
+            query = query.where(condition(field))
+        union = query if union is None else union + query
+
+    return union
+
+
+def indexed_slots(condition=None, names=None):
+    """Return a query over NodeSlot with the same columns as `assembled_slots`.
+
+    `condition` is applied to the `NodeSlot.item` field.
+    """
+    query = NodeSlot.select(
+        NodeSlot.node.alias("node_id"),
+        NodeSlot.slot_name.alias("slot"),
+        NodeSlot.item.alias("item_id"),
+    )
+    if condition is not None:
+        query = query.where(condition(NodeSlot.item))
+    if names is not None:
+        query = query.where(NodeSlot.slot_name.in_(list(names)))
+
+    return query
+
+
+def slot_query(condition=None, names=None):
+    """Return a query of (node_id, slot, item_id) over all node slots.
+
+    This uses the NodeSlot index, if it is in use, otherwise it falls
+    back to `assembled_slots`.  See that function for the arguments.
+    """
+    if slot_index_enabled():
+        return indexed_slots(condition, names)
+
+    return assembled_slots(condition, names)
+
+
+def sync_slot(node, slot, item):
+    """Record in NodeSlot that `slot` of `node` now holds `item`.
+
+    Does nothing if the NodeSlot table is not in use.  This should be
+    called inside the transaction which updates NodeAssembled.  If `item`
+    is moving from another slot, that slot must be synced first.
+
+    Parameters
+    ----------
+    node : NodeAssembled or integer
+        The node, or its id.
+    slot : string
+        The slot name.
+    item : NodeItem, integer or None
+        The item now in the slot, or its id, or None for an empty slot.
+    """
+    if not slot_index_enabled():
+        return
+
+    node = getattr(node, "id", node)
+    item = getattr(item, "id", item)
+
+    updated = (
+        NodeSlot.update(item=item)
+        .where((NodeSlot.node == node) & (NodeSlot.slot_name == slot))
+        .execute()
+    )
+    if not updated:
+        # Node created without its slot rows
+        NodeSlot.insert(node=node, slot_name=slot, item=item).execute()
+
+
+def add_node_slots(node):
+    """Create the NodeSlot rows for a new node.
+
+    Does nothing if the NodeSlot table is not in use.
+
+    Parameters
+    ----------
+    node : NodeAssembled
+        The new node.
+    """
+    if not slot_index_enabled():
+        return
+
+    NodeSlot.insert_many(
+        [
+            {"node": node.id, "slot_name": name, "item": getattr(node, name + "_id")}
+            for name in NodeAssembled.slot_fields()
+        ]
+    ).execute()
+
+
+def rebuild_slot_index():
+    """Repopulate the NodeSlot table from NodeAssembled.
+
+    The table is created if it doesn't exist.  The rebuild is done in a
+    single transaction with one INSERT ... SELECT, so other connections
+    never see the table partially filled.
+
+    Returns
+    -------
+    count : int
+        The number of rows written.
+    """
+    db = NodeSlot._meta.database
+
+    NodeSlot.create_table(safe=True)
+
+    with db.atomic():
+        NodeSlot.delete().execute()
+        NodeSlot.insert_from(
+            assembled_slots(), [NodeSlot.node, NodeSlot.slot_name, NodeSlot.item]
+        ).execute()
+
+    slot_index_enabled(refresh=True)
+
+    count = NodeSlot.select().count()
+    _logger.info("Rebuilt NodeSlot index: {0} slots".format(count))
+
+    return count
+
+
+def verify_slot_index():
+    """Compare the NodeSlot table with NodeAssembled.
+
+    Returns
+    -------
+    missing : set
+        The (node_id, slot_name, item_id) tuples in NodeAssembled which
+        are absent from NodeSlot.
+    extra : set
+        The (node_id, slot_name, item_id) tuples in NodeSlot which are
+        absent from NodeAssembled.
+    """
+    expected = set(assembled_slots().tuples())
+    actual = set(
+        NodeSlot.select(NodeSlot.node, NodeSlot.slot_name, NodeSlot.item).tuples()
+    )
+
+    return expected - actual, actual - expected
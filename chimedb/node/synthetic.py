@@ -0,0 +1,446 @@
+"""Synthetic fleets for testing and benchmarking
+
+`generate_fleet` makes the rows of a consistent, made-up fleet: every
+component slot of every NodeAssembled holds a NodeItem of the right type,
+most nodes are racked, MACs are unique and start with the OUI of a
+plausible vendor, and the NodeHistory ADD and DEL records replay to the
+final contents of NodeAssembled.
+`write_fleet` bulk-loads those rows into empty tables, and `build_fleet`
+does both.
+
+The history follows a simple model of a real fleet: components are
+delivered, then the nodes are assembled, then components are swapped for
+spares at random times, GPUs most often.  Some of the removed components
+are sent for RMA, coming back to the spare pool after a (log-normally
+distributed) repair time, or still being out at the end.
+
+Examples
+--------
+>>> from chimedb.node.synthetic import build_fleet, check_replay
+>>> build_fleet(items=100000, history=1000000)
+>>> check_replay()
+[]
+"""
+from .history import Checkpoint, replay_forward
+from .migrate import build_indexes, drop_indexes
+from .orm import NodeItem, NodeMAC, NodeAssembled, NodeRMA, NodeHistory, NODE_SLOTS
+from .slots import rebuild_slot_index, slot_index_enabled
+
+from collections import OrderedDict
+import datetime
+import heapq
+import math
+import peewee as pw
+import random
+
+# The component slots of a synthetic node, and the component type in each.
+# The rack slot is filled separately.
+SLOT_TYPES = OrderedDict(
+    (name, "MB" if name == "motherboard" else name.rstrip("0123456789").upper())
+    for name in NODE_SLOTS
+    if name != "rack_slot"
+)
+
+# Component models of each type
+ITEM_MODELS = {
+    "MB": ["X11DPG-OT-CPU", "H12DSG-O-CPU"],
+    "CPU": ["Xeon Gold 6226R", "EPYC 7302"],
+    "GPU": ["Radeon Pro V340", "A100-PCIE-40GB"],
+    "NIC": ["ConnectX-5", "X710-DA4"],
+    "RAM": ["M393A4K40DB3-CWE", "HMA84GR7CJR4N-XN"],
+}
+
+# The vendor of each component type, used for RMAs
+VENDORS = {
+    "MB": "Supermicro",
+    "CPU": "Intel",
+    "GPU": "AMD",
+    "NIC": "Mellanox",
+    "RAM": "Samsung",
+}
+
+# The OUIs (first three bytes) of the MACs of each type with interfaces,
+# and the interfaces each has
+OUIS = {"MB": (0x002590, 0xAC1F6B), "NIC": (0x0C42A1, 0x3CFDFE)}
+TYPE_MACS = {"MB": ("NIC0", "NIC1", "IPMI"), "NIC": ("NIC0", "NIC1")}
+
+# Rack slots are NodeItems too, but the type enum has no rack type, so they
+# get the enum's default.  Their location is the name of the rack.
+RACK_ITEM_TYPE = NodeItem.type.default
+RACK_UNITS = 16
+
+# Relative rate at which a component in one slot of each type fails
+FAILURE_WEIGHTS = {"MB": 2.0, "CPU": 0.5, "GPU": 8.0, "NIC": 2.0, "RAM": 1.0}
+
+# The columns of each table, in the order of the generated row tuples
+ITEM_COLUMNS = ("id", "type", "model", "serial", "status", "location", "version")
+MAC_COLUMNS = ("value", "item", "mac_type")
+NODE_COLUMNS = (
+    ("id", "node_type", "serial", "rack_slot") + tuple(SLOT_TYPES) + ("version",)
+)
+RMA_COLUMNS = ("id", "item", "number", "company", "send_time", "recv_time")
+HISTORY_COLUMNS = (
+    "id",
+    "operation",
+    "node",
+    "item",
+    "rma",
+    "slot",
+    "timestamp",
+    "autonote",
+    "note",
+)
+
+# The phases of the history, as fractions of its length: components are
+# delivered, then nodes assembled, then components swapped until the end
+DELIVERY_END = 0.05
+ASSEMBLY_END = 0.2
+
+
+class Fleet(object):
+    """The rows of a synthetic fleet.
+
+    Each attribute is a list of tuples, with the columns given by the
+    corresponding `*_COLUMNS` tuple.  Datetimes are strings in the format
+    peewee uses, so that the rows can be inserted as they are.
+
+    Attributes
+    ----------
+    items, macs, nodes, rmas, history : list of tuples
+    """
+
+    def __init__(self):
+        self.items = list()
+        self.macs = list()
+        self.nodes = list()
+        self.rmas = list()
+        self.history = list()
+
+    def tables(self):
+        """Return (model, columns, rows) for each table, in foreign key order."""
+        return [
+            (NodeItem, ITEM_COLUMNS, self.items),
+            (NodeMAC, MAC_COLUMNS, self.macs),
+            (NodeAssembled, NODE_COLUMNS, self.nodes),
+            (NodeRMA, RMA_COLUMNS, self.rmas),
+            (NodeHistory, HISTORY_COLUMNS, self.history),
+        ]
+
+    def sizes(self):
+        """Return a dict of the number of rows for each table."""
+        return dict((model.__name__, len(rows)) for model, _, rows in self.tables())
+
+
+def _serial(item_type, id_):
+    """Make a vendor-like serial number for a component."""
+    if item_type == "MB":
+        return "ZM{0:08d}".format(id_)
+    if item_type == "GPU":
+        return "{0:013d}".format(1324019000000 + id_)
+    if item_type == "NIC":
+        return "MT{0:010d}".format(id_)
+    return "{0}{1:08X}".format(item_type[0], id_)
+
+
+def generate_fleet(
+    items=1000,
+    spares=0.1,
+    years=3.0,
+    swaps_per_node_year=4.0,
+    history=None,
+    rma_fraction=0.6,
+    racked=0.9,
+    seed=0,
+    now=None,
+):
+    """Generate the rows of a synthetic fleet.
+
+    Parameters
+    ----------
+    items : int, optional
+        The number of components.  The number of nodes is chosen so that
+        all their component slots can be filled, leaving a fraction
+        `spares` of the components as spares.  Very small fleets have a
+        single, partly-filled node.  There is also a rack-slot NodeItem
+        for each racked node.
+    spares : float, optional
+        The fraction of spare components.
+    years : float, optional
+        The length of the history, ending at `now`.
+    swaps_per_node_year : float, optional
+        The mean rate at which components are swapped.
+    history : int, optional
+        If given, the approximate number of NodeHistory rows wanted, which
+        sets the number of swaps instead of `swaps_per_node_year`.
+    rma_fraction : float, optional
+        The fraction of removed components which are sent for RMA.
+    racked : float, optional
+        The probability that a node is installed in a rack slot when it
+        is assembled.  The rack slots are filled in order, `RACK_UNITS`
+        to a rack.
+    seed : int, optional
+        The random seed.  The same arguments give the same fleet.
+    now : datetime, optional
+        The end of the history.  By default, now.
+
+    Returns
+    -------
+    fleet : Fleet
+    """
+    rng = random.Random(seed)
+    if now is None:
+        now = datetime.datetime.now().replace(microsecond=0)
+    span = datetime.timedelta(days=365.25 * years).total_seconds()
+    start = now - datetime.timedelta(seconds=span)
+    fleet = Fleet()
+
+    # The slots to fill, node by node, and the types of the spares
+    per_node = len(SLOT_TYPES)
+    node_count = max(1, int(round(items / (per_node * (1 + spares)))))
+    fill = [(node, slot) for node in range(node_count) for slot in SLOT_TYPES][:items]
+    demand = dict()
+    for _, slot in fill:
+        demand[SLOT_TYPES[slot]] = demand.get(SLOT_TYPES[slot], 0) + 1
+    types = sorted(demand)
+    spare_types = rng.choices(
+        types, weights=[demand[name] for name in types], k=items - len(fill)
+    )
+
+    # Components, delivered at random times at the start
+    item_types = [SLOT_TYPES[slot] for _, slot in fill] + spare_types
+    delivered = sorted(rng.uniform(0, DELIVERY_END * span) for _ in item_types)
+    events = list()
+    for index, item_type in enumerate(item_types):
+        id_ = index + 1
+        fleet.items.append(
+            [
+                id_,
+                item_type,
+                rng.choice(ITEM_MODELS[item_type]),
+                _serial(item_type, id_),
+                "OK",
+                "",
+                0,
+            ]
+        )
+        events.append((delivered[index], "ADD", None, id_, None, None))
+
+        for mac_type in TYPE_MACS.get(item_type, ()):
+            oui = OUIS[item_type][id_ % len(OUIS[item_type])]
+            fleet.macs.append(((oui << 24) | len(fleet.macs), id_, mac_type))
+
+    # Nodes, assembled after the deliveries
+    contents = [dict() for _ in range(node_count)]
+    for (node, slot), id_ in zip(fill, range(1, len(fill) + 1)):
+        contents[node][slot] = id_
+    assembled = sorted(
+        rng.uniform(DELIVERY_END * span, ASSEMBLY_END * span) for _ in contents
+    )
+    for node, when in enumerate(assembled):
+        events.append((when, "NOP", node + 1, None, None, None))
+        for slot, id_ in contents[node].items():
+            events.append((when, "ADD", node + 1, id_, None, slot))
+
+    pools = dict((name, list()) for name in types)
+    for index, item_type in enumerate(spare_types):
+        pools[item_type].append(len(fill) + index + 1)
+
+    # Swaps, at random times until the end
+    if history is None:
+        swaps = int(round(node_count * years * swaps_per_node_year))
+    else:
+        swaps = max(0, (history - len(events)) // 2)
+    times = sorted(rng.uniform(ASSEMBLY_END * span, span) for _ in range(swaps))
+    slots = list(SLOT_TYPES)
+    chosen = rng.choices(
+        slots, weights=[FAILURE_WEIGHTS[SLOT_TYPES[name]] for name in slots], k=swaps
+    )
+    returns = list()
+    for when, slot in zip(times, chosen):
+        while returns and returns[0][0] <= when:
+            _, id_, _ = heapq.heappop(returns)
+            pools[fleet.items[id_ - 1][1]].append(id_)
+
+        if not pools.get(SLOT_TYPES[slot]):
+            # No spares of this type are left: swap something which has some
+            stocked = [name for name in slots if pools.get(SLOT_TYPES[name])]
+            if not stocked and returns:
+                # None at all: the RMA due back first is expedited
+                _, id_, rma = heapq.heappop(returns)
+                fleet.rmas[rma - 1][5] = when
+                pools[fleet.items[id_ - 1][1]].append(id_)
+                stocked = [name for name in slots if pools.get(SLOT_TYPES[name])]
+            if not stocked:
+                continue
+            slot = rng.choice(stocked)
+        node = rng.randrange(node_count)
+        old = contents[node].get(slot)
+        if old is None:
+            continue
+        pool = pools[SLOT_TYPES[slot]]
+        new = pool.pop(rng.randrange(len(pool)))
+        contents[node][slot] = new
+
+        rma = None
+        if rng.random() < rma_fraction:
+            # Repairs take three weeks on average, with a long tail
+            repair = rng.lognormvariate(math.log(21 * 86400), 0.6)
+            rma = len(fleet.rmas) + 1
+            recv = when + repair if when + repair <= span else None
+            fleet.rmas.append(
+                [
+                    rma,
+                    old,
+                    "RMA{0:07d}".format(rma),
+                    VENDORS[SLOT_TYPES[slot]],
+                    when,
+                    recv,
+                ]
+            )
+            if recv is None:
+                fleet.items[old - 1][4] = "RMA"
+            else:
+                heapq.heappush(returns, (recv, old, rma))
+        else:
+            pool.append(old)
+
+        events.append((when, "DEL", node + 1, old, rma, slot))
+        events.append((when, "ADD", node + 1, new, None, slot))
+
+    # Rack slots, after the spares, for most of the nodes.  A node is
+    # racked when it's assembled, and never moves.  These are drawn last,
+    # so that `racked` doesn't change the rest of the fleet.
+    for node, when in enumerate(assembled):
+        if rng.random() >= racked:
+            continue
+        id_ = len(fleet.items) + 1
+        rack, unit = divmod(id_ - len(item_types) - 1, RACK_UNITS)
+        fleet.items.append(
+            [
+                id_,
+                RACK_ITEM_TYPE,
+                None,
+                "R{0:03d}U{1:02d}".format(rack, unit),
+                "OK",
+                "rack{0:03d}".format(rack),
+                0,
+            ]
+        )
+        contents[node]["rack_slot"] = id_
+        events.append((0, "ADD", None, id_, None, None))
+        events.append((when, "ADD", node + 1, id_, None, "rack_slot"))
+
+    # The phases don't overlap and each is generated in time order, so a
+    # stable sort by time keeps each DEL before its ADD
+    events.sort(key=lambda event: event[0])
+
+    def timestamp(offset):
+        return str(start + datetime.timedelta(seconds=offset))
+
+    fleet.items = [tuple(row) for row in fleet.items]
+    for id_, (when, operation, node, item, rma, slot) in enumerate(events, 1):
+        fleet.history.append(
+            (id_, operation, node, item, rma, slot, timestamp(when), True, "synthetic")
+        )
+    fleet.rmas = [
+        (id_, item, number, company, timestamp(sent), recv and timestamp(recv))
+        for id_, item, number, company, sent, recv in fleet.rmas
+    ]
+    for node, slots in enumerate(contents):
+        fleet.nodes.append(
+            (node + 1, "GPU", "cn{0:05d}".format(node + 1), slots.get("rack_slot"))
+            + tuple(slots.get(name) for name in SLOT_TYPES)
+            + (0,)
+        )
+
+    return fleet
+
+
+def _insert(model, columns, rows, chunk_size):
+    """Insert rows as fast as the database allows."""
+    fields = [getattr(model, name) for name in columns]
+    db = model._meta.database
+    db = getattr(db, "obj", db)
+
+    if isinstance(db, (pw.SqliteDatabase, pw.MySQLDatabase)) and rows:
+        # executemany skips building an SQL statement for every chunk;
+        # pymysql turns it into multi-row INSERTs
+        sql, _ = model.insert_many(rows[:1], fields=fields).sql()
+        cursor = db.cursor()
+        for chunk in pw.chunked(rows, chunk_size):
+            cursor.executemany(sql, chunk)
+    else:
+        for chunk in pw.chunked(rows, chunk_size):
+            model.insert_many(chunk, fields=fields).execute()
+
+
+def write_fleet(fleet, chunk_size=10000, defer_indexes=True):
+    """Insert a generated fleet into the (empty) node tables.
+
+    Parameters
+    ----------
+    fleet : Fleet
+        The output of `generate_fleet`.
+    chunk_size : int, optional
+        The number of rows sent to the database at once.
+    defer_indexes : bool, optional
+        If True (the default), drop the non-unique indexes for the load
+        and rebuild them afterwards, which is much faster for large
+        histories.
+
+    Returns
+    -------
+    sizes : dict
+        The number of rows inserted into each table.
+    """
+    tables = fleet.tables()
+    models = [model for model, _, _ in tables]
+    if defer_indexes:
+        drop_indexes(models)
+
+    try:
+        with NodeItem._meta.database.atomic():
+            for model, columns, rows in tables:
+                _insert(model, columns, rows, chunk_size)
+    finally:
+        if defer_indexes:
+            build_indexes(models)
+
+    if slot_index_enabled(refresh=True):
+        rebuild_slot_index()
+
+    return fleet.sizes()
+
+
+def build_fleet(chunk_size=10000, defer_indexes=True, **kwargs):
+    """Generate a synthetic fleet and insert it into the (empty) node tables.
+
+    The keyword arguments are passed to `generate_fleet`; `chunk_size` and
+    `defer_indexes` to `write_fleet`.
+
+    Returns
+    -------
+    sizes : dict
+        The number of rows inserted into each table.
+    """
+    return write_fleet(generate_fleet(**kwargs), chunk_size, defer_indexes)
+
+
+def check_replay():
+    """Check that replaying the whole history gives the current node contents.
+
+    Returns
+    -------
+    nodes : list of int
+        The ids of the nodes whose replayed contents differ from
+        NodeAssembled.  Empty if the history is consistent.
+    """
+    current = Checkpoint.current()
+    replayed = replay_forward(Checkpoint.empty(), current.history_id)
+
+    ids = set(current.nodes) | set(replayed.nodes)
+    return sorted(
+        id_
+        for id_ in ids
+        if current.nodes.get(id_, dict()) != replayed.nodes.get(id_, dict())
+    )
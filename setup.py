@@ -12,11 +12,13 @@ setup(
     cmdclass=versioneer.get_cmdclass(),
     packages=["chimedb.node"],
     zip_safe=False,
+    entry_points={"console_scripts": ["chimedb-node = chimedb.node.cli:main"]},
     install_requires=[
         "chimedb @ git+https://github.com/chime-experiment/chimedb.git",
         "peewee > 3",
         "future",
     ],
+    extras_require={"parquet": ["pyarrow"], "prometheus": ["prometheus_client"]},
     author="CHIME collaboration",
     author_email="dvw@phas.ubc.ca",
     description="CHIME GPU node hardware database",
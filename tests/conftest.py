@@ -0,0 +1,51 @@
+"""Fixtures for the chimedb.node tests
+
+The tests run against a temporary SQLite database, with the node models
+bound to it in place of the chimedb.core connection.
+"""
+import peewee as pw
+import pytest
+
+from chimedb.node import history, slots
+from chimedb.node.orm import (
+    NodeItem,
+    NodeMAC,
+    NodeAssembled,
+    NodeRMA,
+    NodeHistory,
+    NodeSlot,
+    NodeSnapshot,
+)
+
+# The tables created for every test.  NodeSlot is optional, so it's only
+# created by the `slot_index` fixture.
+MODELS = (NodeItem, NodeMAC, NodeAssembled, NodeRMA, NodeHistory, NodeSnapshot)
+
+
+@pytest.fixture
+def db(tmp_path):
+    """An empty node database."""
+    database = pw.SqliteDatabase(str(tmp_path / "node.db"))
+    with database.bind_ctx(MODELS + (NodeSlot,)):
+        database.create_tables(MODELS)
+        slots.slot_index_enabled(refresh=True)
+        history._snapshots_enabled(refresh=True)
+        yield database
+    database.close()
+
+
+@pytest.fixture(params=[False, True], ids=["assembled", "slot_index"])
+def slot_index(request, db):
+    """Run a test both without and with the NodeSlot index."""
+    if request.param:
+        slots.rebuild_slot_index()
+    yield request.param
+    slots.slot_index_enabled(refresh=True)
+
+
+@pytest.fixture
+def fleet(db):
+    """A small synthetic fleet; returns the row counts."""
+    from chimedb.node.synthetic import build_fleet
+
+    return build_fleet(items=300, seed=1)
@@ -0,0 +1,58 @@
+"""Tests of the asyncio interface"""
+import asyncio
+import threading
+import time
+
+from chimedb.node import api
+from chimedb.node.aio import AsyncNodeDB
+
+
+def test_lookups_and_close(db, monkeypatch):
+    api.create_components(
+        [{"type": "GPU", "serial": "g{0}".format(i)} for i in range(8)]
+    )
+
+    closed = list()
+    close = db.close
+
+    def record_close():
+        closed.append((threading.current_thread().name, close()))
+
+    monkeypatch.setattr(db, "close", record_close)
+
+    async def main():
+        async with AsyncNodeDB(max_workers=3) as nodedb:
+            items = await asyncio.gather(
+                *[nodedb.find_item("g{0}".format(i)) for i in range(8)]
+            )
+        return items
+
+    items = asyncio.run(main())
+    assert [item.serial for item in items] == ["g{0}".format(i) for i in range(8)]
+
+    # Every worker closed its connection, and at least one had one open
+    workers = [name for name, _ in closed if name.startswith("chimedb-node")]
+    assert len(set(workers)) == 3
+    assert any(result for _, result in closed)
+
+
+def test_exit_does_not_block_loop(db):
+    ticks = list()
+
+    async def ticker(stop):
+        while not stop.is_set():
+            ticks.append(time.monotonic())
+            await asyncio.sleep(0.01)
+
+    async def main():
+        stop = asyncio.Event()
+        task = asyncio.ensure_future(ticker(stop))
+        async with AsyncNodeDB(max_workers=1) as nodedb:
+            nodedb._executor.submit(time.sleep, 0.3)
+            before = len(ticks)
+        after = len(ticks)
+        stop.set()
+        await task
+        return after - before
+
+    assert asyncio.run(main()) >= 5
@@ -0,0 +1,82 @@
+"""Tests of the parallel audit of discovery dumps"""
+from chimedb.node import api, audit
+
+NVIDIA_SMI = """\
+<?xml version="1.0" ?>
+<nvidia_smi_log>
+  <gpu id="00000000:3B:00.0">
+    <serial>{0}</serial>
+    <minor_number>0</minor_number>
+  </gpu>
+</nvidia_smi_log>
+"""
+
+
+def _dump(tmp_path, files):
+    """Write a dump directory holding `files`, keyed by (node, filename)."""
+    directory = tmp_path / "dump"
+    directory.mkdir()
+    for (node, filename), text in files.items():
+        (directory / node).mkdir(exist_ok=True)
+        (directory / node / filename).write_text(text)
+    return directory
+
+
+def test_audit_dump(db, tmp_path):
+    ids, _ = api.create_components(
+        [{"type": "GPU", "serial": serial} for serial in ["G1", "G2", "G3"]]
+    )
+    for serial, item in zip(["cn001", "cn002", "cn003"], ids):
+        api.install_component(api.create_node(serial), "gpu0", item)
+
+    directory = _dump(
+        tmp_path,
+        {
+            # Clean
+            ("cn001", "nvidia-smi.xml"): NVIDIA_SMI.format("G1"),
+            # Unparsable
+            ("cn002", "nvidia-smi.xml"): "<nvidia_smi_log><gpu>",
+            # G3 replaced by an unknown GPU
+            ("cn003", "nvidia-smi.xml"): NVIDIA_SMI.format("G4"),
+            # Nothing the audit reads
+            ("cn004", "notes.txt"): "",
+        },
+    )
+    (directory / "README").write_text("")
+
+    assert list(audit.dump_reports(str(directory))) == [
+        (node, {"nvidia_smi": str(directory / node / "nvidia-smi.xml")})
+        for node in ["cn001", "cn002", "cn003"]
+    ]
+
+    diffs = {
+        diff.node: diff for diff in audit.audit_dump(str(directory), max_workers=1)
+    }
+    assert sorted(diffs) == ["cn001", "cn002", "cn003"]
+
+    assert not diffs["cn001"]
+    assert diffs["cn002"].error
+    assert diffs["cn002"].node_id is not None
+    assert not diffs["cn002"].missing
+
+    diff = diffs["cn003"]
+    assert not diff.error
+    assert diff.missing == [("gpu0", ids[2], "GPU", "G3")]
+    assert [component.serial for component in diff.unexpected] == ["G4"]
+
+
+def test_run_audit(db):
+    """Reports given as text rather than paths."""
+    ids, _ = api.create_components([{"type": "GPU", "serial": "G1"}])
+    api.install_component(api.create_node("cn001"), "gpu0", ids[0])
+
+    reports = [
+        ("cn001", {"nvidia_smi": NVIDIA_SMI.format("G1")}),
+        ("cn009", {"nvidia_smi": NVIDIA_SMI.format("G1")}),
+    ]
+    diffs = {diff.node: diff for diff in audit.run_audit(reports, max_workers=1)}
+
+    assert not diffs["cn001"]
+    # An unknown node is always a difference
+    assert diffs["cn009"].node_id is None
+    assert diffs["cn009"]
@@ -0,0 +1,51 @@
+"""Tests of the NodeCache"""
+import threading
+
+from chimedb.node import api
+from chimedb.node.cache import NodeCache
+
+
+def test_write_invalidates(db):
+    cache = NodeCache(max_age=60)
+    (id_,), _ = api.create_components([{"type": "GPU", "serial": "g1"}])
+
+    assert cache.item(id_).model is None
+    assert cache.item(id_).model is None
+    assert cache.stats()["hits"] == 1
+
+    api.update_item(id_, model="A100")
+    assert cache.item(id_).model == "A100"
+
+
+def test_lookups_not_serialised(db):
+    """A slow lookup doesn't block lookups of other keys."""
+    cache = NodeCache(max_age=60)
+    started = threading.Event()
+    release = threading.Event()
+
+    def slow():
+        started.set()
+        assert release.wait(10)
+        return "slow"
+
+    thread = threading.Thread(target=cache._get, args=("slow", slow))
+    thread.start()
+    try:
+        assert started.wait(10)
+        assert cache._get("fast", lambda: "fast") == "fast"
+    finally:
+        release.set()
+        thread.join()
+
+    assert cache._get("slow", lambda: "other") == "slow"
+
+
+def test_result_loaded_across_invalidation_is_dropped(db):
+    cache = NodeCache(max_age=60)
+
+    def load():
+        cache.clear()
+        return "stale"
+
+    assert cache._get("key", load) == "stale"
+    assert cache._get("key", lambda: "fresh") == "fresh"
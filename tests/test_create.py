@@ -0,0 +1,34 @@
+"""Tests of bulk component creation"""
+from chimedb.node import api, lookup
+from chimedb.node.orm import NodeItem, NodeMAC, NodeHistory
+
+
+def test_per_row_failures(db):
+    api.create_components([{"type": "GPU", "serial": "existing"}])
+
+    rows = [
+        {"type": "GPU", "serial": "g1", "model": "A100"},
+        {"type": "GPU", "serial": "existing"},
+        {"type": "GPU", "serial": "g1"},
+        {"type": "TPU", "serial": "t1"},
+        {"type": "CPU", "serial": "c1", "status": "BROKEN"},
+        {"type": "NIC", "serial": "n1", "macs": {"NIC9": "00:11:22:33:44:55"}},
+        {"type": "NIC", "serial": "n2", "macs": {"NIC0": "not a mac"}},
+        {"type": "MB", "serial": "m1", "macs": {"NIC0": "00:11:22:33:44:55"}},
+        {"type": "MB", "serial": "m2", "macs": {"NIC0": "00-11-22-33-44-55"}},
+        {"type": "RAM", "serial": None},
+    ]
+    ids, failures = api.create_components(rows, chunk_size=4)
+
+    assert sorted(failures) == [1, 2, 3, 4, 5, 6, 8]
+    assert "type" in failures[3]
+    assert "status" in failures[4]
+    assert "mac_type" in failures[5]
+    for index in (0, 7, 9):
+        assert ids[index] is not None
+    assert all(ids[index] is None for index in failures)
+
+    assert lookup.find_item("g1").model == "A100"
+    assert NodeItem.select().count() == 4
+    assert NodeMAC.select().count() == 1
+    assert NodeHistory.select().where(NodeHistory.operation == "ADD").count() == 4
@@ -0,0 +1,76 @@
+"""Tests of the DHCP host file generation"""
+import re
+
+import pytest
+
+from chimedb.node import api, dhcp
+from chimedb.node.orm import NodeMAC
+
+
+@pytest.mark.parametrize("fmt", sorted(dhcp.FORMATS))
+def test_unique_hostnames(fleet, fmt):
+    entries = list(dhcp.host_entries(fmt))
+    text = "".join(entries)
+    if fmt == "isc":
+        names = re.findall(r"^host (\S+) \{", text, re.M)
+    elif fmt == "dnsmasq":
+        names = re.findall(r"^dhcp-host=[^,]+,(\S+)$", text, re.M)
+    else:
+        names = re.findall(r"^\S+ (\S+)$", text, re.M)
+
+    assert len(names) == len(entries) > 0
+    assert len(set(names)) == len(names)
+
+
+def test_boot_nic_is_named_after_node(fleet):
+    records = [
+        (name, record)
+        for name, record in (
+            (dhcp.default_hostname(record), record) for record in _installed_records()
+        )
+        if name == record.node_serial.lower()
+    ]
+
+    assert records
+    for _, record in records:
+        assert (record.slot, record.mac_type) == ("motherboard", "NIC0")
+
+
+def _installed_records():
+    from chimedb.node.mac import MACRecord, mac_location_query
+
+    query, _ = mac_location_query()
+    for row in query:
+        if row[4] is not None:
+            yield MACRecord(*row[1:])
+
+
+def test_duplicate_hostname_fails(fleet, tmp_path):
+    path = str(tmp_path / "ethers")
+    assert dhcp.write_hosts(path, "ethers")
+
+    with pytest.raises(ValueError):
+        dhcp.write_hosts(path, "ethers", hostname=lambda record: record.node_serial)
+
+    # The old file is left alone, and regenerating it changes nothing
+    assert dhcp.write_hosts(path, "ethers") == []
+    assert NodeMAC.select().count() > 0
+
+
+def test_hostnames_have_no_underscores(db):
+    ids, _ = api.create_components(
+        [
+            {"type": "MB", "serial": "M1", "macs": {"NIC0": 1, "IPMI": 2}},
+            {"type": "NIC", "serial": "R1", "macs": {"NIC0": 3}},
+        ]
+    )
+    node = api.create_node("CN_001")
+    api.install_component(node, "motherboard", ids[0])
+    # A rack slot with an interface of its own, e.g. a PDU outlet
+    api.install_component(node, "rack_slot", ids[1])
+
+    assert list(dhcp.host_entries("ethers")) == [
+        "00:00:00:00:00:02 cn-001-ipmi\n",
+        "00:00:00:00:00:01 cn-001\n",
+        "00:00:00:00:00:03 cn-001-rack-slot-nic0\n",
+    ]
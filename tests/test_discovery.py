@@ -0,0 +1,285 @@
+"""Tests of reconciling hardware reports with the database"""
+from chimedb.node import api, discovery
+from chimedb.node.orm import NodeAssembled
+
+
+DMIDECODE = """\
+# dmidecode 3.3
+Getting SMBIOS data from sysfs.
+
+Handle 0x0002, DMI type 2, 15 bytes
+Base Board Information
+\tManufacturer: Supermicro
+\tProduct Name: X11DPG-OT-CPU
+\tSerial Number: MB001
+
+Handle 0x0040, DMI type 4, 48 bytes
+Processor Information
+\tSocket Designation: CPU1
+\tVersion: Intel(R) Xeon(R) Gold 6226R CPU @ 2.90GHz
+\tStatus: Populated, Enabled
+\tSerial Number: Not Specified
+
+Handle 0x0041, DMI type 4, 48 bytes
+Processor Information
+\tSocket Designation: CPU2
+\tVersion: Intel(R) Xeon(R) Gold 6226R CPU @ 2.90GHz
+\tStatus: Populated, Enabled
+\tSerial Number: CPU-B
+
+Handle 0x0042, DMI type 4, 48 bytes
+Processor Information
+\tSocket Designation: CPU3
+\tStatus: Unpopulated
+\tSerial Number: To Be Filled By O.E.M.
+
+Handle 0x0050, DMI type 17, 84 bytes
+Memory Device
+\tSize: 32 GB
+\tLocator: DIMMA1
+\tSerial Number: 1A2B3C4D
+\tPart Number: M393A4K40DB3-CWE
+
+Handle 0x0051, DMI type 17, 84 bytes
+Memory Device
+\tSize: No Module Installed
+\tLocator: DIMMA2
+\tSerial Number: NO DIMM
+
+Handle 0x0052, DMI type 17, 84 bytes
+Memory Device
+\tSize: 32 GB
+\tLocator: DIMMB1
+\tSerial Number: 5E6F7A8B
+\tPart Number: M393A4K40DB3-CWE
+"""
+
+LSHW = """\
+{
+  "id": "cn001", "class": "system", "serial": "SYS1",
+  "children": [
+    {"id": "core", "class": "bus", "product": "X11DPG-OT-CPU", "serial": "MB001",
+     "children": [
+       {"id": "cpu:0", "class": "processor", "product": "Xeon", "serial": "CPU-A"},
+       {"id": "cpu:1", "class": "processor", "product": "Xeon",
+        "serial": "Not Specified"},
+       {"id": "memory", "class": "memory", "children": [
+         {"id": "bank:0", "class": "memory", "description": "DIMM DDR4",
+          "product": "M393A4K40DB3-CWE", "serial": "1A2B3C4D"},
+         {"id": "bank:1", "class": "memory", "description": "DIMM [empty]"}
+       ]},
+       {"id": "network", "class": "network", "logicalname": "eno1",
+        "serial": "00:1b:21:00:00:01"},
+       {"id": "network:1", "class": "network", "logicalname": "docker0",
+        "serial": "02:42:ac:11:00:02"},
+       {"id": "network:2", "class": "network", "logicalname": "eno2",
+        "serial": "not a mac"}
+     ]}
+  ]
+}
+"""
+
+NVIDIA_SMI = """\
+<?xml version="1.0" ?>
+<nvidia_smi_log>
+  <gpu id="00000000:3B:00.0">
+    <product_name>A100-PCIE-40GB</product_name>
+    <serial>GPU-A</serial>
+    <minor_number>0</minor_number>
+  </gpu>
+  <gpu id="00000000:AF:00.0">
+    <product_name>A100-PCIE-40GB</product_name>
+    <serial>GPU-B</serial>
+    <minor_number>1</minor_number>
+  </gpu>
+  <gpu id="00000000:D8:00.0">
+    <product_name>A100-PCIE-40GB</product_name>
+    <serial>N/A</serial>
+    <minor_number>2</minor_number>
+  </gpu>
+</nvidia_smi_log>
+"""
+
+IP_LINK = """\
+1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN mode DEFAULT
+    link/loopback 00:00:00:00:00:00 brd 00:00:00:00:00:00
+2: eno1: <BROADCAST,MULTICAST,SLAVE,UP,LOWER_UP> mtu 9000 master bond0 state UP
+    link/ether 00:1b:21:00:00:01 brd ff:ff:ff:ff:ff:ff
+3: eno2: <BROADCAST,MULTICAST,SLAVE,UP,LOWER_UP> mtu 9000 master bond0 state UP
+    link/ether 00:1b:21:00:00:01 brd ff:ff:ff:ff:ff:ff permaddr 00:1b:21:00:00:02
+4: bond0: <BROADCAST,MULTICAST,MASTER,UP,LOWER_UP> mtu 9000 state UP
+    link/ether 00:1b:21:00:00:01 brd ff:ff:ff:ff:ff:ff
+5: docker0: <NO-CARRIER,BROADCAST,MULTICAST,UP> mtu 1500 state DOWN
+    link/ether 02:42:ac:11:00:02 brd ff:ff:ff:ff:ff:ff
+6: veth1a2b3c@if5: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 master docker0
+    link/ether 7a:3e:51:00:00:09 brd ff:ff:ff:ff:ff:ff link-netnsid 0
+"""
+
+
+def _gpus(*serials):
+    ids, failures = api.create_components(
+        [{"type": "GPU", "serial": serial} for serial in serials]
+    )
+    assert not failures
+    return ids
+
+
+def _report(node, *serials):
+    report = discovery.HardwareReport(node)
+    report.covered.add("GPU")
+    for slot, serial in enumerate(serials):
+        report.add("GPU", serial, slot="gpu{0}".format(slot))
+    return report
+
+
+def test_apply_diffs(db, slot_index):
+    node_a = api.create_node("cn001")
+    node_b = api.create_node("cn002")
+    g1, g2 = _gpus("G1", "G2")
+    api.install_component(node_a, "gpu0", g1)
+    api.install_component(node_b, "gpu0", g2)
+
+    # G1 has gone, and G2 has moved from cn002 to cn001
+    diffs = discovery.reconcile([_report("cn001", "G2")])
+    actions, skipped = discovery.apply_diffs(diffs.values())
+
+    assert len(actions) == 3 and not skipped
+    assert NodeAssembled.get_by_id(node_a.id).gpu0_id == g2
+    assert NodeAssembled.get_by_id(node_b.id).gpu0_id is None
+
+
+def test_apply_stale_diffs(db, slot_index):
+    node_a = api.create_node("cn001")
+    node_b = api.create_node("cn002")
+    node_c = api.create_node("cn003")
+    g1, g2, g3, g4 = _gpus("G1", "G2", "G3", "G4")
+    api.install_component(node_a, "gpu0", g1)
+    api.install_component(node_b, "gpu0", g3)
+
+    diffs = discovery.reconcile([_report("cn001", "G3")])
+
+    # Changed by someone else after the reports were checked: G1 swapped
+    # for G2, and G3 moved to cn003
+    api.swap_component(node_a, "gpu0", g2)
+    api.remove_component(node_b, "gpu0")
+    api.install_component(node_c, "gpu0", g3)
+    api.install_component(node_b, "gpu0", g4)
+
+    actions, skipped = discovery.apply_diffs(diffs.values())
+
+    assert not actions
+    assert len(skipped) == 3
+    assert NodeAssembled.get_by_id(node_a.id).gpu0_id == g2
+    assert NodeAssembled.get_by_id(node_b.id).gpu0_id == g4
+    assert NodeAssembled.get_by_id(node_c.id).gpu0_id == g3
+
+
+def test_racked_node(db, slot_index):
+    """The rack slot's item is never reported missing, or filled."""
+    node = api.create_node("cn001")
+    ids, _ = api.create_components(
+        [{"type": "CPU", "serial": "RACK-A1"}, {"type": "CPU", "serial": "C1"}]
+    )
+    api.install_component(node, "rack_slot", ids[0])
+    api.install_component(node, "cpu0", ids[1])
+
+    report = discovery.HardwareReport("cn001")
+    report.covered.update(["MB", "CPU", "RAM"])
+    report.add("CPU", "C1", slot="cpu0")
+    diffs = discovery.reconcile([report])
+    assert not diffs["cn001"]
+    assert discovery.apply_diffs(diffs.values()) == ([], [])
+    assert NodeAssembled.get_by_id(node.id).rack_slot_id == ids[0]
+
+    # Nor is the rack slot chosen for a moved item
+    api.remove_component(node, "rack_slot")
+    report.add("CPU", "RACK-A1")
+    discovery.apply_diffs(discovery.reconcile([report]).values())
+    node = NodeAssembled.get_by_id(node.id)
+    assert (node.rack_slot_id, node.cpu1_id) == (None, ids[0])
+    assert discovery._free_slot({"rack_slot": None}, None) is None
+
+
+def _components(report):
+    return sorted(report.components.values())
+
+
+def test_parse_dmidecode():
+    report = discovery.parse_report("cn001", dmidecode=DMIDECODE)
+
+    # Placeholder serials, unpopulated sockets and empty DIMM slots are left
+    # out, but still count towards the slot numbering
+    assert _components(report) == [
+        ("CPU", "CPU-B", "Intel(R) Xeon(R) Gold 6226R CPU @ 2.90GHz", "cpu1"),
+        ("MB", "MB001", "X11DPG-OT-CPU", "motherboard"),
+        ("RAM", "1A2B3C4D", "M393A4K40DB3-CWE", "ram0"),
+        ("RAM", "5E6F7A8B", "M393A4K40DB3-CWE", "ram1"),
+    ]
+    assert report.covered == set(["MB", "CPU", "RAM"])
+    assert not report.macs
+
+
+def test_parse_lshw():
+    report = discovery.parse_report("cn001", lshw=LSHW)
+
+    assert _components(report) == [
+        ("CPU", "CPU-A", "Xeon", None),
+        ("MB", "MB001", "X11DPG-OT-CPU", "motherboard"),
+        ("RAM", "1A2B3C4D", "M393A4K40DB3-CWE", None),
+    ]
+    # Not the docker bridge, or the unparsable serial
+    assert report.macs == set([0x001B21000001])
+    assert "MAC" in report.covered
+
+
+def test_parse_nvidia_smi():
+    report = discovery.parse_report("cn001", nvidia_smi=NVIDIA_SMI)
+
+    assert _components(report) == [
+        ("GPU", "GPU-A", "A100-PCIE-40GB", "gpu0"),
+        ("GPU", "GPU-B", "A100-PCIE-40GB", "gpu1"),
+    ]
+    assert report.covered == set(["GPU"])
+
+
+def test_parse_ip_link():
+    report = discovery.parse_report("cn001", ip_link=IP_LINK)
+
+    # The bond's slaves by their permanent addresses; no loopback, docker
+    # bridge or veth
+    assert report.macs == set([0x001B21000001, 0x001B21000002])
+    assert report.covered == set(["MAC"])
+    assert not report.components
+
+
+def test_parse_report_merges():
+    """Slot hints and models survive a second sighting without them."""
+    report = discovery.parse_report(
+        "cn001", dmidecode=DMIDECODE, lshw=LSHW, ip_link=IP_LINK
+    )
+
+    components = dict(
+        ((item.type, item.serial), item) for item in report.components.values()
+    )
+    assert components[("RAM", "1A2B3C4D")].slot == "ram0"
+    assert components[("CPU", "CPU-A")].slot is None
+    assert components[("MB", "MB001")].model == "X11DPG-OT-CPU"
+    assert report.covered == set(["MB", "CPU", "RAM", "MAC"])
+
+
+def test_reconcile_fleet(db, slot_index, fleet):
+    """Reports of every node's components match a racked synthetic fleet."""
+    reports = list()
+    for node in NodeAssembled.select():
+        report = discovery.HardwareReport(node.serial)
+        report.covered.update(["MB", "CPU", "GPU", "NIC", "RAM"])
+        for slot in NodeAssembled.slot_fields():
+            item = getattr(node, slot)
+            if item is not None and slot != "rack_slot":
+                report.add(item.type, item.serial, slot=slot)
+        reports.append(report)
+
+    assert NodeAssembled.select().where(NodeAssembled.rack_slot.is_null(False))
+    diffs = discovery.reconcile(reports)
+    assert len(diffs) == len(reports)
+    assert not any(diffs.values())
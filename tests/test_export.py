@@ -0,0 +1,77 @@
+"""Tests of the export and restore of the node tables"""
+import peewee as pw
+import pytest
+
+from chimedb.core.exceptions import ValidationError
+
+from chimedb.node import export, slots
+from chimedb.node.export import EXPORT_MODELS, export_all
+from chimedb.node.restore import restore
+from chimedb.node.orm import NodeItem, NodeHistory, NodeSlot
+
+from conftest import MODELS
+
+
+def _contents():
+    return dict(
+        (
+            model.__name__,
+            list(model.select().order_by(model._meta.primary_key).tuples()),
+        )
+        for model in EXPORT_MODELS
+    )
+
+
+@pytest.mark.parametrize("fmt", ["csv", "parquet"])
+def test_round_trip(db, fleet, tmp_path, fmt):
+    if fmt == "parquet":
+        pytest.importorskip("pyarrow")
+
+    counts = export_all(str(tmp_path / "dump"), fmt)
+    for name, count in fleet.items():
+        assert counts[name] == count
+    expected = _contents()
+
+    copy = pw.SqliteDatabase(str(tmp_path / "copy.db"))
+    with copy.bind_ctx(MODELS + (NodeSlot,)):
+        copy.create_tables(MODELS + (NodeSlot,))
+        assert restore(str(tmp_path / "dump"), fmt) == fleet
+        assert _contents() == expected
+        # The slot index is rebuilt from the restored nodes
+        assert slots.verify_slot_index() == (set(), set())
+
+        with pytest.raises(ValidationError):
+            restore(str(tmp_path / "dump"), fmt)
+        restore(str(tmp_path / "dump"), fmt, replace=True, single_transaction=False)
+        assert _contents() == expected
+    copy.close()
+    slots.slot_index_enabled(refresh=True)
+
+
+def test_consistent_snapshot(db, fleet, tmp_path, monkeypatch):
+    """Rows written during the export don't appear in later files."""
+    db.execute_sql("PRAGMA journal_mode=wal")
+    writer = pw.SqliteDatabase(db.database)
+    export_table = export.export_table
+
+    def write_after_items(name, *args):
+        count = export_table(name, *args)
+        if name == "NodeItem":
+            with writer.bind_ctx(MODELS):
+                item = NodeItem.create(type="GPU", serial="LATE", location="")
+                NodeHistory.create(operation="NOP", item=item, note="late")
+        return count
+
+    monkeypatch.setattr(export, "export_table", write_after_items)
+    counts = export_all(str(tmp_path / "dump"), "csv")
+    writer.close()
+    assert counts["NodeItem"] == fleet["NodeItem"]
+    assert counts["NodeHistory"] == fleet["NodeHistory"]
+    assert NodeHistory.select().count() == fleet["NodeHistory"] + 1
+
+    copy = pw.SqliteDatabase(str(tmp_path / "copy.db"))
+    with copy.bind_ctx(MODELS + (NodeSlot,)):
+        copy.create_tables(MODELS)
+        assert restore(str(tmp_path / "dump"), "csv") == fleet
+    copy.close()
+    slots.slot_index_enabled(refresh=True)
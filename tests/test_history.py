@@ -0,0 +1,130 @@
+"""Tests of the node history queries"""
+import datetime
+
+import peewee as pw
+
+from chimedb.node import history, instrument
+from chimedb.node.orm import NodeHistory, NodeSnapshot
+
+
+def _replay(at=None, history_id=None):
+    """The node contents at `at` or after `history_id`, replaying everything."""
+    if history_id is None:
+        until = NodeHistory.timestamp <= at
+    else:
+        until = NodeHistory.id <= history_id
+    nodes = dict()
+    query = (
+        NodeHistory.select(
+            NodeHistory.operation, NodeHistory.node, NodeHistory.item, NodeHistory.slot
+        )
+        .where(
+            NodeHistory.node.is_null(False)
+            & NodeHistory.operation.in_(["ADD", "DEL"])
+            & until
+        )
+        .order_by(NodeHistory.id)
+    )
+    for operation, node, item, slot in query.tuples():
+        slots = nodes.setdefault(node, dict())
+        if operation == "ADD":
+            assert slot not in slots
+            slots[slot] = item
+        else:
+            assert slots.pop(slot) == item
+
+    return {node: slots for node, slots in nodes.items() if slots}
+
+
+def _times(count):
+    """`count` times spread over the history, and either side of it."""
+    first, last = NodeHistory.select(
+        pw.fn.MIN(NodeHistory.timestamp), pw.fn.MAX(NodeHistory.timestamp)
+    ).scalar(as_tuple=True)
+    step = (last - first) / count
+    return [first - step + step * i for i in range(count + 3)]
+
+
+def test_snapshot(db, slot_index, fleet):
+    times = _times(20)
+    snapshots = [history.snapshot(at) for at in times]
+    assert snapshots == [_replay(at) for at in times]
+    # Starting empty, and changing throughout
+    assert snapshots[0] == dict()
+    assert len(set(str(sorted(nodes.items())) for nodes in snapshots)) > 10
+
+    # At the exact time of a change
+    record = NodeHistory.select().where(NodeHistory.operation == "DEL").first()
+    assert history.snapshot(record.timestamp) == _replay(record.timestamp)
+    assert history.snapshot() == _replay(datetime.datetime.now())
+
+
+def test_snapshot_from_checkpoints(db, fleet):
+    # Stored checkpoints through the history, computed independently
+    records = list(NodeHistory.select().order_by(NodeHistory.id))
+    for record in records[100::200]:
+        checkpoint = history.Checkpoint(record.id, _replay(history_id=record.id))
+        NodeSnapshot.create(history_id=record.id, data=checkpoint.encode())
+    assert history.store_checkpoint() == records[-1].id
+    assert history.store_checkpoint() is None
+
+    for at in _times(20):
+        assert history.snapshot(at) == _replay(at)
+
+    # Replaying from the nearest checkpoint reads less history
+    with instrument.collect(keep=2) as sink:
+        history.checkpoint_at(records[690].id, checkpoints=[])
+        history.checkpoint_at(records[690].id)
+    first, second = sink.records[-2:]
+    assert second.rows < first.rows
+
+
+def _pages(limit, **kwargs):
+    """All the records from `history_for`, a page at a time."""
+    records, cursor = history.history_for(limit=limit, **kwargs)
+    pages = [records]
+    while cursor is not None:
+        records, cursor = history.history_for(after=cursor, limit=limit, **kwargs)
+        pages.append(records)
+    return pages
+
+
+def test_history_for_pages(db, fleet):
+    item = NodeHistory.select().where(NodeHistory.operation == "DEL").first().item_id
+
+    # The records of node 1 start with its assembly, all at the same time
+    for kwargs in ({"node": 1}, {"item": item}, {}):
+        expected = NodeHistory.select().order_by(NodeHistory.timestamp, NodeHistory.id)
+        for name, value in kwargs.items():
+            expected = expected.where(getattr(NodeHistory, name) == value)
+        expected = [record.id for record in expected]
+        assert len(expected) > 4
+
+        for newest_first in (True, False):
+            pages = _pages(4, newest_first=newest_first, **kwargs)
+            assert all(len(page) == 4 for page in pages[:-1])
+            assert 0 < len(pages[-1]) <= 4
+            records = [record.id for page in pages for record in page]
+            if newest_first:
+                records.reverse()
+            assert records == expected
+
+    assert [record.id for record in history.iter_history(node=1, page_size=3)] == [
+        record.id for page in _pages(50, node=1) for record in page
+    ]
+
+
+def test_snapshot_table_created_later(db, fleet):
+    """A process which found no NodeSnapshot table notices when it appears."""
+    NodeSnapshot.drop_table()
+    assert not history._snapshots_enabled(refresh=True)
+    assert history.stored_checkpoints(100) == []
+
+    # As `store_checkpoint` run in another process would do, without
+    # refreshing this process's check
+    NodeSnapshot.create_table()
+    checkpoint = history.Checkpoint(100, _replay(history_id=100))
+    NodeSnapshot.create(history_id=100, data=checkpoint.encode())
+
+    assert history._snapshots_enabled()
+    assert [found.history_id for found in history.stored_checkpoints(150)] == [100]
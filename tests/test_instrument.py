@@ -0,0 +1,22 @@
+"""Tests of the query instrumentation"""
+from chimedb.node import api, instrument, mac
+
+
+def test_operations(db):
+    ids, _ = api.create_components(
+        [{"type": "NIC", "serial": "N1", "macs": {"NIC0": "00:1b:21:00:00:01"}}]
+    )
+
+    with instrument.collect() as sink:
+        assert mac.get_mac("00:1b:21:00:00:01").item_id == ids[0]
+        query = mac.macs_by_oui("00:1b:21")
+        with instrument.operation("test.macs_by_oui"):
+            assert [row.item_id for row in query] == ids
+
+    totals = sink.totals()
+    assert totals["mac.get_mac"].queries == 1
+    assert totals["mac.get_mac"].rows == 1
+    # Only the lazy query's caller ran it
+    assert "mac.macs_by_oui" not in totals
+    assert totals["test.macs_by_oui"].queries == 1
+    assert totals["test.macs_by_oui"].rows == 1
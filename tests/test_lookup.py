@@ -0,0 +1,97 @@
+"""Tests of the bulk item-to-node lookups"""
+import sqlite3
+
+import pytest
+
+from chimedb.node import api, lookup
+from chimedb.node.orm import NodeItem, NodeAssembled, NODE_SLOTS
+
+
+def _expected():
+    """Map item id to (node id, slot), by reading every node."""
+    expected = dict()
+    for node in NodeAssembled.select():
+        for name in NodeAssembled.slot_fields():
+            item_id = getattr(node, name + "_id")
+            if item_id is not None:
+                expected[item_id] = (node.id, name)
+    return expected
+
+
+def test_find_nodes_parameter_limit(db, slot_index, fleet):
+    """The lookups fit the 999 parameters of older SQLite versions."""
+    db.connection().setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    expected = _expected()
+    assert len(expected) > 999 // len(NodeAssembled.slot_fields())
+
+    ids = [item.id for item in NodeItem.select(NodeItem.id)]
+    found = lookup.find_nodes(ids)
+    assert dict((id_, (node.id, slot)) for id_, (node, slot) in found.items()) == (
+        expected
+    )
+
+    keys = dict(
+        (id_, (type_, serial))
+        for id_, type_, serial in NodeItem.select(
+            NodeItem.id, NodeItem.type, NodeItem.serial
+        ).tuples()
+    )
+    found = lookup.find_nodes_by_serial(serial for _, serial in keys.values())
+    assert dict((key, (node.id, slot)) for key, (node, slot) in found.items()) == dict(
+        (keys[id_], location) for id_, location in expected.items()
+    )
+
+
+def test_find_item(db):
+    ids, _ = api.create_components(
+        [
+            {"type": "GPU", "serial": "S1", "model": "A100"},
+            {"type": "CPU", "serial": "S2"},
+            {"type": "GPU", "serial": "S2"},
+        ]
+    )
+    assert lookup.find_item("S1").id == ids[0]
+    assert lookup.find_item("S1", "GPU").model == "A100"
+    assert lookup.find_item("S1", "CPU") is None
+    assert lookup.find_item("S3") is None
+
+    # A serial shared by two types needs the type
+    assert lookup.find_item("S2", "CPU").id == ids[1]
+    assert lookup.find_item("S2", "GPU").id == ids[2]
+    with pytest.raises(ValueError):
+        lookup.find_item("S2")
+
+
+def _contents(nodes):
+    return [
+        (node["serial"], [node[name] and node[name]["id"] for name in NODE_SLOTS])
+        for node in nodes
+    ]
+
+
+def test_node_contents_chunks(db, slot_index, fleet, monkeypatch):
+    everything = lookup.node_contents(dicts=True)
+    assert len(everything) == NodeAssembled.select().count()
+    assert [node["serial"] for node in everything] == sorted(
+        node["serial"] for node in everything
+    )
+
+    # More node ids than fit in one statement, most of them unknown
+    db.connection().setlimit(sqlite3.SQLITE_LIMIT_VARIABLE_NUMBER, 999)
+    ids = list(range(3000, 0, -1))
+    assert _contents(lookup.node_contents(ids, dicts=True)) == _contents(everything)
+
+    # A subset of the nodes, across several chunks
+    monkeypatch.setattr(lookup, "LOOKUP_CHUNK_SIZE", 4)
+    subset = [node["id"] for node in everything[::2]]
+    assert _contents(lookup.node_contents(subset, dicts=True)) == _contents(
+        everything[::2]
+    )
+    nodes = lookup.node_contents(
+        NodeAssembled.select().where(NodeAssembled.id.in_(subset))
+    )
+    assert [
+        (node.serial, [getattr(node, name + "_id") for name in NODE_SLOTS])
+        for node in nodes
+    ] == _contents(everything[::2])
+    assert not any(node.dirty_fields for node in nodes)
@@ -0,0 +1,158 @@
+"""Tests of MAC address parsing and queries"""
+import pytest
+
+from chimedb.node import api, mac
+from chimedb.node.orm import NodeMAC
+
+VALUE = 0x001B213A4F5C
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "00:1b:21:3a:4f:5c",
+        "00-1B-21-3A-4F-5C",
+        "001b.213a.4f5c",
+        "001b213a4f5c",
+        " 0:1b:21:3a:4f:5c\n",
+        VALUE,
+    ],
+)
+def test_parse_mac(text):
+    assert mac.parse_mac(text) == VALUE
+
+
+@pytest.mark.parametrize(
+    "text",
+    [
+        "",
+        "00:1b:21:3a:4f",
+        "00:1b:21:3a:4f:5c:00",
+        "00::1b:21:3a:4f:5c",
+        "00:1b:21:3a:4f:5g",
+        "001b_213a_4f5c",
+        "0x1b213a4f5c",
+        "+01b213a4f5c",
+        "00:1b:21:3a:4f:_5",
+        -1,
+        1 << 48,
+        True,
+    ],
+)
+def test_parse_mac_invalid(text):
+    with pytest.raises(ValueError):
+        mac.parse_mac(text)
+
+
+def test_format_mac():
+    assert mac.format_mac(VALUE) == "00:1b:21:3a:4f:5c"
+    assert mac.format_mac(VALUE, sep="-", upper=True) == "00-1B-21-3A-4F-5C"
+    assert mac.format_mac(VALUE, sep=".") == "001b.213a.4f5c"
+    assert mac.format_mac(VALUE, sep="") == "001b213a4f5c"
+    assert mac.format_mac(1) == "00:00:00:00:00:01"
+    for sep in [":", "-", ".", ""]:
+        assert mac.parse_mac(mac.format_mac(VALUE, sep=sep)) == VALUE
+
+
+def test_parse_oui():
+    for text in ["00:1b:21", "00-1B-21", "001b21", "0:1b:21", 0x001B21]:
+        assert mac.parse_oui(text) == 0x001B21
+    for text in ["00:1b", "00:1b:21:3a", "00_1b21", "-01b21", 1 << 24, False]:
+        with pytest.raises(ValueError):
+            mac.parse_oui(text)
+
+
+def test_macs_in_range(db):
+    ids, failures = api.create_components(
+        [
+            {"type": "NIC", "serial": "N1", "macs": {"NIC0": "00:1b:21:ff:ff:ff"}},
+            {"type": "NIC", "serial": "N2", "macs": {"NIC0": "00:1b:22:00:00:00"}},
+            {"type": "NIC", "serial": "N3", "macs": {"NIC0": "00:1b:22:00:00:05"}},
+            {"type": "NIC", "serial": "N4", "macs": {"NIC0": "00:1b:22:ff:ff:ff"}},
+            {"type": "NIC", "serial": "N5", "macs": {"NIC0": "00:1b:23:00:00:00"}},
+        ]
+    )
+    assert not failures
+    values = sorted(NodeMAC.select(NodeMAC.value).tuples())
+
+    def expected(first, last):
+        return [value for (value,) in values if first <= value <= last]
+
+    for first, last in [
+        (0, mac.MAC_MAX),
+        ("00:1b:22:00:00:00", "00:1b:22:00:00:05"),
+        ("00:1b:22:00:00:01", "00:1b:22:00:00:04"),
+        ("00:1b:23:00:00:00", "00:1b:22:00:00:00"),
+    ]:
+        macs = mac.macs_in_range(first, last)
+        assert [row.value for row in macs] == expected(
+            mac.parse_mac(first), mac.parse_mac(last)
+        )
+
+    assert [row.item_id for row in mac.macs_by_oui("00:1b:22")] == ids[1:4]
+    assert mac.get_mac("00-1b-22-00-00-05").item_id == ids[2]
+    assert mac.get_mac("00:1b:22:00:00:06") is None
+
+
+def _check_resolver(resolver, values):
+    """The resolver's map agrees with locate_mac and a full reload."""
+    fresh = mac.MACResolver()
+    fresh.load()
+    for value in values:
+        assert resolver.resolve(value) == fresh.resolve(value)
+        assert resolver.resolve(value) == mac.locate_mac(value)
+
+
+def test_resolver_refresh(db, slot_index):
+    ids, _ = api.create_components(
+        [
+            {"type": "MB", "serial": "M1", "macs": {"NIC0": 1, "IPMI": 2}},
+            {"type": "NIC", "serial": "N1", "macs": {"NIC0": 3}},
+            {"type": "CPU", "serial": "RACK-A1"},
+            {"type": "CPU", "serial": "RACK-A2"},
+        ]
+    )
+    board, nic, rack_a1, rack_a2 = ids
+    node_a = api.create_node("cn001")
+    node_b = api.create_node("cn002")
+    api.install_component(node_a, "motherboard", board)
+    api.install_component(node_a, "rack_slot", rack_a1)
+
+    resolver = mac.MACResolver()
+    assert resolver.resolve(1) == mac.MACRecord(
+        board, "M1", "NIC0", node_a.id, "cn001", "RACK-A1", "motherboard"
+    )
+    assert resolver.resolve(3) == mac.MACRecord(
+        nic, "N1", "NIC0", None, None, None, None
+    )
+    assert mac.locate_mac(4) is None
+    assert resolver.refresh() == 0
+
+    # Installing the NIC reloads only its MAC
+    api.install_component(node_b, "nic", nic)
+    assert resolver.refresh() == 1
+    assert resolver.resolve(3).node_serial == "cn002"
+    _check_resolver(resolver, [1, 2, 3])
+
+    # Moving the motherboard to another node
+    api.remove_component(node_a, "motherboard")
+    api.install_component(node_b, "motherboard", board)
+    resolver.refresh()
+    assert resolver.resolve(2)[3:] == (node_b.id, "cn002", None, "motherboard")
+    _check_resolver(resolver, [1, 2, 3])
+
+    # Racking the node changes the location of every MAC in it, although
+    # the history record is about the rack item alone
+    api.remove_component(node_a, "rack_slot")
+    api.install_component(node_b, "rack_slot", rack_a1)
+    resolver.refresh()
+    assert set(resolver.resolve(value).rack_slot for value in [1, 2, 3]) == set(
+        ["RACK-A1"]
+    )
+    _check_resolver(resolver, [1, 2, 3])
+
+    api.swap_component(node_b, "rack_slot", rack_a2)
+    resolver.refresh()
+    assert resolver.resolve(3).rack_slot == "RACK-A2"
+    _check_resolver(resolver, [1, 2, 3])
+    assert len(resolver) == 3
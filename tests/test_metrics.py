@@ -0,0 +1,55 @@
+"""Tests of the Prometheus gauges"""
+import re
+import types
+
+import pytest
+
+from chimedb.node import metrics
+
+
+def test_render(db, fleet):
+    text = metrics.MetricsExporter().render()
+    assert "chimedb_node_components{" in text
+    assert 'chimedb_node_empty_slots{node_type="GPU",slot="rack_slot"}' in text
+    # Most of the synthetic nodes are racked
+    assert re.search(
+        r'^chimedb_node_nodes\{rack="rack000",node_type="GPU"\} \d+$', text, re.M
+    )
+
+
+def test_backoff(db, monkeypatch):
+    now = [1000.0]
+    calls = []
+    gauge = metrics.Gauge("test", "Test", (), [((), 1)])
+    up = [False]
+
+    def collect():
+        calls.append(now[0])
+        if not up[0]:
+            raise RuntimeError("database unavailable")
+        return [gauge]
+
+    monkeypatch.setattr(metrics, "collect", collect)
+    monkeypatch.setattr(
+        metrics, "time", types.SimpleNamespace(monotonic=lambda: now[0])
+    )
+    exporter = metrics.MetricsExporter(ttl=60)
+
+    # With nothing to serve, the error is raised, but only queried once per TTL
+    for offset in (0, 1, 59):
+        now[0] = 1000 + offset
+        with pytest.raises(RuntimeError):
+            exporter.gauges()
+    assert calls == [1000]
+
+    up[0] = True
+    now[0] = 1060
+    assert exporter.gauges()[0] == gauge
+
+    # A failure after that serves the old gauges, again backing off
+    up[0] = False
+    for offset in (120, 121, 179):
+        now[0] = 1000 + offset
+        assert exporter.gauges()[0] == gauge
+    assert calls == [1000, 1060, 1120]
+    assert (exporter.refreshes, exporter.failures) == (1, 2)
@@ -0,0 +1,70 @@
+"""Tests of the schema migration helpers"""
+import pytest
+from playhouse.migrate import SchemaMigrator, migrate as run_operations
+
+from chimedb.node import api, cli, migrate
+from chimedb.node.orm import NodeItem, NodeAssembled, NodeHistory
+
+# Columns added to the original schema
+NEW_COLUMNS = (
+    (NodeItem, "version"),
+    (NodeAssembled, "version"),
+    (NodeHistory, "slot"),
+)
+
+
+@pytest.fixture
+def baseline(db, monkeypatch):
+    """A database with the original schema: no new columns or indexes."""
+    migrator = SchemaMigrator.from_database(db)
+    for model in migrate.MODELS:
+        for index in migrate.deferrable_indexes(model):
+            run_operations(migrator.drop_index(model._meta.table_name, index._name))
+    for model, column in NEW_COLUMNS:
+        run_operations(migrator.drop_column(model._meta.table_name, column))
+
+    monkeypatch.setattr(migrate, "_schema_ok", False)
+    return db
+
+
+def test_api_requires_migration(baseline):
+    with pytest.raises(migrate.SchemaError):
+        api.create_node("cn001")
+
+    migrate.add_columns()
+    api.create_node("cn001")
+    assert NodeAssembled.get().version >= 0
+
+
+def _missing():
+    """The names of the missing columns and indexes."""
+    return [
+        (
+            [field.column_name for field in migrate.missing_columns(model)],
+            [index._name for index in migrate.missing_indexes(model)],
+        )
+        for model in migrate.MODELS
+    ]
+
+
+def test_dry_run(baseline, monkeypatch, capsys):
+    missing = _missing()
+    changed, skipped = migrate.migrate(dry_run=True)
+    assert not skipped
+    assert set(
+        "{0}.{1}".format(model._meta.table_name, column)
+        for model, column in NEW_COLUMNS
+    ) <= set(changed)
+    # Nothing was changed
+    assert _missing() == missing
+
+    monkeypatch.setattr(cli.db, "connect", lambda read_write=False: None)
+    assert cli.main(["migrate", "--dry-run"]) == 0
+    assert capsys.readouterr().out.splitlines() == [
+        "would add: {0}".format(name) for name in changed
+    ]
+    assert _missing() == missing
+
+    assert migrate.migrate() == (changed, [])
+    assert migrate.migrate(dry_run=True) == ([], [])
+    migrate.check_schema(refresh=True)
@@ -0,0 +1,144 @@
+"""Tests of the RMA analytics"""
+import datetime
+import math
+
+import pytest
+
+from chimedb.node import instrument, rma, slots
+from chimedb.node.orm import NodeItem, NodeAssembled, NodeRMA
+
+NOW = datetime.datetime(2020, 6, 1)
+
+
+@pytest.fixture
+def rmas(db, slot_index):
+    """A few RMAs and installed components."""
+    gpus = [
+        NodeItem.create(type="GPU", model="K80", serial="G{0}".format(i), location="")
+        for i in range(6)
+    ]
+    cpus = [
+        NodeItem.create(type="CPU", model="E5", serial="C{0}".format(i), location="")
+        for i in range(4)
+    ]
+    # Installed, but never sent for RMA
+    nic = NodeItem.create(type="NIC", model="X520", serial="N0", location="")
+    NodeAssembled.create(serial="node0", gpu0=gpus[0], gpu1=gpus[1], cpu0=cpus[0])
+    NodeAssembled.create(serial="node1", gpu0=gpus[2], cpu0=cpus[1], nic=nic)
+
+    day = datetime.timedelta(days=1)
+    rows = [
+        (gpus[0], "Acme", NOW - 100 * day, NOW - 90 * day),
+        (gpus[0], "Acme", NOW - 80 * day, NOW - 77 * day),
+        (gpus[3], "Acme", NOW - 60 * day, NOW - 59.5 * day),
+        (gpus[4], "Acme", NOW - 50 * day, NOW - 20 * day),
+        (gpus[5], "Acme", NOW - 40 * day, None),
+        (cpus[2], "Bolt", NOW - 30 * day, NOW - 23 * day),
+        (cpus[3], "Bolt", NOW - 10 * day, None),
+        (cpus[1], "Bolt", NOW - 2 * day, None),
+    ]
+    for item, company, send_time, recv_time in rows:
+        NodeRMA.create(
+            item=item, company=company, send_time=send_time, recv_time=recv_time
+        )
+    if slot_index:
+        slots.rebuild_slot_index()
+
+    return list(NodeRMA.select())
+
+
+def _percentile(values, fraction):
+    """The nearest-rank percentile of `values`."""
+    values = sorted(values)
+    return values[max(math.ceil(fraction * len(values)), 1) - 1]
+
+
+def test_turnaround(rmas):
+    since = NOW - datetime.timedelta(days=70)
+    for kwargs in [dict(), dict(since=since), dict(company="Bolt")]:
+        days = dict()
+        for record in rmas:
+            if record.recv_time is None:
+                continue
+            if "since" in kwargs and record.send_time < kwargs["since"]:
+                continue
+            if kwargs.get("company", record.company) != record.company:
+                continue
+            seconds = (record.recv_time - record.send_time).total_seconds()
+            days.setdefault(record.company, list()).append(seconds / 86400)
+
+        expected = [
+            (company, len(values), sum(values) / len(values))
+            + (_percentile(values, 0.5), _percentile(values, 0.9))
+            for company, values in sorted(days.items())
+        ]
+        stats = rma.turnaround(**kwargs)
+        assert [stat.company for stat in stats] == [row[0] for row in expected]
+        for stat, row in zip(stats, expected):
+            assert stat.count == row[1]
+            assert stat[2:] == pytest.approx(row[2:], abs=1e-6)
+
+
+def test_open_rmas(rmas):
+    for older_than in [0, 5, 35, 1000]:
+        cutoff = NOW - datetime.timedelta(days=older_than)
+        expected = sorted(
+            (
+                record
+                for record in rmas
+                if record.recv_time is None and record.send_time < cutoff
+            ),
+            key=lambda record: record.send_time,
+        )
+        assert rma.open_rmas(older_than, now=NOW) == expected
+
+        summary = dict()
+        for record in expected:
+            count, oldest = summary.get(record.company, (0, record.send_time))
+            summary[record.company] = (count + 1, min(oldest, record.send_time))
+        assert rma.open_rma_summary(older_than, now=NOW) == [
+            rma.OpenSummary(company, *value)
+            for company, value in sorted(summary.items())
+        ]
+
+
+def test_failure_rates(rmas):
+    installed = dict()
+    for node in NodeAssembled.select():
+        for field in NodeAssembled.slot_fields().values():
+            item = getattr(node, field.name)
+            if item is not None:
+                installed[item.model] = installed.get(item.model, 0) + 1
+
+    since = NOW - datetime.timedelta(days=45)
+    for cutoff in [None, since]:
+        failed = dict()
+        for record in rmas:
+            if cutoff is None or record.send_time >= cutoff:
+                failed.setdefault(record.item.model, set()).add(record.item_id)
+
+        expected = list()
+        for model in sorted(set(failed) | set(installed)):
+            failures = len(failed.get(model, ()))
+            count = installed.get(model, 0)
+            rate = float(failures) / count if count else None
+            expected.append(rma.FailureRate(model, failures, count, rate))
+
+        assert rma.failure_rates(since=cutoff) == expected
+
+    # The NIC model is installed, but has never failed
+    assert rma.failure_rates()[-1] == rma.FailureRate("X520", 0, 1, 0.0)
+
+
+def test_instrumented(rmas):
+    with instrument.collect() as sink:
+        rma.turnaround()
+        rma.open_rmas(now=NOW)
+        rma.open_rma_summary(now=NOW)
+        rma.failure_rates()
+    assert sorted(sink.totals()) == [
+        "rma.failure_rates",
+        "rma.open_rma_summary",
+        "rma.open_rmas",
+        "rma.turnaround",
+    ]
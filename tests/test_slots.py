@@ -0,0 +1,22 @@
+"""Tests of the NodeSlot index"""
+from chimedb.node import api, slots
+from chimedb.node.orm import NodeSlot
+
+
+def test_index_created_by_another_process(db):
+    """A process which found no NodeSlot table notices when it appears."""
+    node = api.create_node("cn001")
+    ids, _ = api.create_components([{"type": "GPU", "serial": "G1"}])
+    assert not slots.slot_index_enabled()
+
+    # As `chimedb-node slots rebuild` run elsewhere would do, without
+    # refreshing this process's check
+    NodeSlot.create_table()
+    NodeSlot.insert_from(
+        slots.assembled_slots(), [NodeSlot.node, NodeSlot.slot_name, NodeSlot.item]
+    ).execute()
+
+    api.install_component(node, "gpu0", ids[0])
+
+    assert slots.slot_index_enabled()
+    assert slots.verify_slot_index() == (set(), set())
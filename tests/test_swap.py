@@ -0,0 +1,110 @@
+"""Tests of installing, removing and swapping components"""
+import pytest
+
+from chimedb.core.exceptions import ValidationError
+
+from chimedb.node import api, lookup
+from chimedb.node.orm import NodeItem, NodeAssembled, NodeRMA
+
+
+def _items(*types):
+    ids, failures = api.create_components(
+        [{"type": type_, "serial": "S{0}".format(i)} for i, type_ in enumerate(types)]
+    )
+    assert not failures
+    return ids
+
+
+def _location(item):
+    """Return (node id, slot) for an installed item, or None."""
+    node, slot = lookup.find_node(item)
+    return None if node is None else (node.id, slot)
+
+
+def test_swap_and_rma(db, slot_index):
+    node = api.create_node("cn001")
+    old, new = _items("GPU", "GPU")
+    api.install_component(node, "gpu0", old)
+
+    assert api.swap_component(node, "gpu0", new, rma=True) == old
+    assert _location(new) == (node.id, "gpu0")
+    assert _location(old) is None
+    assert NodeItem.get_by_id(old).status == "RMA"
+    assert NodeRMA.select().where(NodeRMA.item == old).count() == 1
+
+
+def test_install_in_two_slots(db, slot_index):
+    node_a = api.create_node("cn001")
+    node_b = api.create_node("cn002")
+    (gpu,) = _items("GPU")
+    api.install_component(node_a, "gpu0", gpu)
+
+    # A different column, so no unique index can catch it
+    with pytest.raises(ValidationError):
+        api.install_component(node_b, "gpu1", gpu)
+    with pytest.raises(ValidationError):
+        api.install_component(node_a, "gpu1", gpu)
+
+    assert NodeAssembled.get_by_id(node_b.id).gpu1_id is None
+    assert list(lookup.find_nodes([gpu])) == [gpu]
+    assert _location(gpu) == (node_a.id, "gpu0")
+
+
+def test_swap_in_installed_item(db, slot_index):
+    node_a = api.create_node("cn001")
+    node_b = api.create_node("cn002")
+    gpu_a, gpu_b = _items("GPU", "GPU")
+    api.install_component(node_a, "gpu0", gpu_a)
+    api.install_component(node_b, "gpu1", gpu_b)
+
+    with pytest.raises(ValidationError):
+        api.swap_component(node_a, "gpu0", gpu_b)
+
+    assert NodeAssembled.get_by_id(node_a.id).gpu0_id == gpu_a
+
+
+def test_swap_with_itself(db, slot_index):
+    node = api.create_node("cn001")
+    (gpu,) = _items("GPU")
+    api.install_component(node, "gpu0", gpu)
+
+    with pytest.raises(ValidationError):
+        api.swap_component(node, "gpu0", gpu, rma=True)
+    with pytest.raises(ValidationError):
+        api.swap_component(node, "gpu0", gpu, rma=True, old_item=gpu)
+
+    assert NodeItem.get_by_id(gpu).status == "OK"
+    assert NodeRMA.select().count() == 0
+    assert _location(gpu) == (node.id, "gpu0")
+
+
+def test_install_wrong_type(db, slot_index):
+    node = api.create_node("cn001")
+    gpu, ram = _items("GPU", "RAM")
+
+    with pytest.raises(ValidationError):
+        api.install_component(node, "cpu0", gpu)
+    api.install_component(node, "ram3", ram)
+
+    (spare,) = _items("NIC")
+    with pytest.raises(ValidationError):
+        api.swap_component(node, "ram3", spare)
+
+    assert NodeAssembled.get_by_id(node.id).cpu0_id is None
+    assert NodeAssembled.get_by_id(node.id).ram3_id == ram
+
+
+def test_index_clash_is_validation_error(db):
+    """A clash found by the NodeSlot unique index is a ValidationError."""
+    from chimedb.node import slots
+
+    slots.rebuild_slot_index()
+    node_a = api.create_node("cn001")
+    node_b = api.create_node("cn002")
+    (gpu,) = _items("GPU")
+    api.install_component(node_a, "gpu0", gpu)
+
+    # Skip the up-front check, as a racing transaction would
+    with pytest.raises(ValidationError):
+        with db.atomic():
+            api._set_slot(node_b.id, "gpu1", None, gpu)
@@ -0,0 +1,76 @@
+"""Tests of row versions and compare-and-set updates"""
+import pytest
+
+from chimedb.core.exceptions import ValidationError
+
+from chimedb.node import api
+from chimedb.node.orm import NodeItem, NodeAssembled, NodeHistory
+
+
+def test_update_item_conflict(db):
+    ids, _ = api.create_components([{"type": "GPU", "serial": "G1"}])
+    mine = NodeItem.get_by_id(ids[0])
+    theirs = NodeItem.get_by_id(ids[0])
+
+    assert api.update_item(theirs, location="shelf 2") == mine.version + 1
+    with pytest.raises(api.ConflictError):
+        api.update_item(mine, status="RMA")
+
+    item = NodeItem.get_by_id(ids[0])
+    assert (item.location, item.status) == ("shelf 2", "OK")
+    # Only the successful update is in the history
+    assert NodeHistory.select().where(NodeHistory.operation == "NOP").count() == 1
+
+    # Retrying with the current version works
+    api.update_item(item, status="RMA")
+    assert NodeItem.get_by_id(ids[0]).status == "RMA"
+
+
+def test_node_version_conflict(db):
+    node = api.create_node("cn001")
+    ids, _ = api.create_components(
+        [{"type": "GPU", "serial": "G1"}, {"type": "GPU", "serial": "G2"}]
+    )
+    version = NodeAssembled.get_by_id(node.id).version
+
+    # Slot changes bump the node's version
+    api.install_component(node, "gpu0", ids[0], version=version)
+    with pytest.raises(api.ConflictError):
+        api.install_component(node, "gpu1", ids[1], version=version)
+    with pytest.raises(api.ConflictError):
+        api.update_node(node.id, version=version, node_type="FRB")
+
+    # The slot isn't empty
+    with pytest.raises(api.ConflictError):
+        api.install_component(node, "gpu0", ids[1])
+    # The slot doesn't hold the expected item
+    with pytest.raises(api.ConflictError):
+        api.swap_component(node, "gpu0", ids[1], old_item=ids[1] + 100)
+
+    node = NodeAssembled.get_by_id(node.id)
+    assert (node.gpu0_id, node.gpu1_id, node.version) == (ids[0], None, version + 1)
+
+
+def test_update_validation(db):
+    ids, _ = api.create_components(
+        [{"type": "GPU", "serial": "G1"}, {"type": "GPU", "serial": "G2"}]
+    )
+    node = api.create_node("cn001")
+
+    with pytest.raises(ValueError):
+        api.update_item(ids[0], status="BROKEN")
+    with pytest.raises(ValueError):
+        api.update_node(node, node_type="CPU")
+
+    # The type + serial of another component
+    with pytest.raises(ValidationError):
+        api.update_item(ids[1], serial="G1")
+    # Neither the row nor the history changed
+    item = NodeItem.get_by_id(ids[1])
+    assert (item.serial, item.version, item.status) == ("G2", 0, "OK")
+    assert not (
+        NodeHistory.select()
+        .where((NodeHistory.operation == "NOP") & (NodeHistory.item == ids[1]))
+        .exists()
+    )
+    assert NodeAssembled.get_by_id(node.id).node_type == "GPU"